@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成请求准入控制与公平调度
+
+在生成前加一个有界等待队列：同时生成的请求数不超过并发上限。排队请求分两级轮转放行：
+先在分组（客户端IP）之间轮转，再在同一分组内的租户（session_id）之间轮转，
+不断更换或省略会话ID的客户端也只能占到所在IP的一份；每个租户和每个分组的排队数都有上限。
+每个租户另有请求数和生成token数两个令牌桶限流；附加的限流键（客户端IP）使用单独的、
+宽松得多的限额，同一出口IP后的大量访客（讲座、展览现场）不会被当作一个用户限流。超过排队时限、队列已满或触发限流时快速拒绝，
+并给出建议的 Retry-After 秒数。backend/app.py 与 api/main.py 共用。
+"""
+
+import math
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from cancellation import GenerationCancelled
+
+# 用于统计等待时间分位数的样本数
+WAIT_SAMPLE_SIZE = 1000
+# 每个租户保留的延迟样本数
+TENANT_SAMPLE_SIZE = 200
+# 空闲超过该秒数的租户统计和令牌桶会被清理
+TENANT_IDLE_TTL = 600
+# 未提供租户标识时使用的默认租户
+DEFAULT_TENANT = "anonymous"
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入，status_code 为建议返回的HTTP状态码"""
+
+    status_code = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(AdmissionRejected):
+    """等待队列已满"""
+    status_code = 429
+
+
+class QueueTimeoutError(AdmissionRejected):
+    """排队超过时限"""
+    status_code = 503
+
+
+class RateLimitedError(AdmissionRejected):
+    """租户超出请求数或token数限额"""
+    status_code = 429
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    idx = min(int(math.ceil(q * len(sorted_values))) - 1, len(sorted_values) - 1)
+    return sorted_values[max(idx, 0)]
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充量，capacity 为突发上限；余额可被事后扣成负数"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount=1):
+        self._refill()
+        if self.level >= amount:
+            self.level -= amount
+            return True
+        return False
+
+    def debit(self, amount):
+        """事后扣减（如实际生成的token数），允许透支"""
+        self._refill()
+        self.level -= amount
+
+    def available(self):
+        self._refill()
+        return self.level
+
+    def seconds_until(self, amount=1):
+        self._refill()
+        if self.level >= amount or not self.rate:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class Lease:
+    """一次准入的凭据，生成结束后填写 completion_tokens 再释放"""
+
+    __slots__ = ("tenant", "group", "rate_keys", "waited", "arrived", "started", "completion_tokens")
+
+    def __init__(self, tenant, group, rate_keys, arrived):
+        self.tenant = tenant
+        self.group = group
+        self.rate_keys = rate_keys
+        self.arrived = arrived
+        self.started = None
+        self.waited = 0.0
+        self.completion_tokens = 0
+
+
+class _TenantStats:
+    __slots__ = ("requests", "rejected", "latencies", "last_seen")
+
+    def __init__(self):
+        self.requests = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=TENANT_SAMPLE_SIZE)
+        self.last_seen = time.monotonic()
+
+
+class AdmissionController:
+    """
+    有界公平准入队列
+
+    用法:
+        with controller.slot(tenant=f"session:{session_id}", rate_keys=[f"ip:{ip}"], group=f"ip:{ip}") as lease:
+            response = generate_response(...)
+            lease.completion_tokens = n
+    """
+
+    def __init__(self, max_concurrency=1, max_queue=8, queue_timeout=60.0,
+                 max_queue_per_tenant=2, max_queue_per_group=None,
+                 requests_per_minute=None, request_burst=None,
+                 tokens_per_minute=None, token_burst=None,
+                 ip_requests_per_minute=None, ip_request_burst=None,
+                 ip_tokens_per_minute=None, ip_token_burst=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_queue_per_tenant = max_queue_per_tenant
+        # 单个分组（客户端IP）最多排队数，None 表示只受 max_queue 限制
+        self.max_queue_per_group = max_queue_per_group
+
+        # 限流配置，None 表示不限
+        self.requests_per_minute = requests_per_minute
+        self.request_burst = request_burst or requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.token_burst = token_burst or tokens_per_minute
+        # 附加限流键（rate_keys，如客户端IP）的限额，None 表示不限
+        self.ip_requests_per_minute = ip_requests_per_minute
+        self.ip_request_burst = ip_request_burst or ip_requests_per_minute
+        self.ip_tokens_per_minute = ip_tokens_per_minute
+        self.ip_token_burst = ip_token_burst or ip_tokens_per_minute
+
+        self._cond = threading.Condition()
+        self._active = 0
+        # 分组 -> (租户 -> 等待中的 Lease 队列)；两级 OrderedDict 的顺序即轮转顺序
+        self._queues = OrderedDict()
+        self._waiting = 0
+
+        self._request_buckets = {}
+        self._token_buckets = {}
+        self._tenants = {}
+        self._last_prune = time.monotonic()
+
+        # 统计信息
+        self._admitted = 0
+        self._rejected_full = 0
+        self._rejected_timeout = 0
+        self._cancelled_waiting = 0
+        self._rejected_rate = 0
+        self._wait_samples = deque(maxlen=WAIT_SAMPLE_SIZE)
+        self._service_seconds = None  # 生成耗时的指数滑动平均
+
+    # ---------- 限流 ----------
+    def _bucket(self, buckets, key, per_minute, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(per_minute / 60.0, burst)
+        return bucket
+
+    def _limits(self, key, tenant):
+        """(每分钟请求数, 请求突发, 每分钟token数, token突发)：租户用租户限额，其余键用IP限额"""
+        if key == tenant:
+            return self.requests_per_minute, self.request_burst, self.tokens_per_minute, self.token_burst
+        return self.ip_requests_per_minute, self.ip_request_burst, self.ip_tokens_per_minute, self.ip_token_burst
+
+    def _check_rate_limits(self, keys, tenant):
+        """检查各限流键的请求桶和token桶，全部通过才扣减请求桶"""
+        request_buckets = []
+        for key in keys:
+            requests_per_minute, request_burst, tokens_per_minute, token_burst = self._limits(key, tenant)
+            if tokens_per_minute:
+                tokens = self._bucket(self._token_buckets, key, tokens_per_minute, token_burst)
+                if tokens.available() <= 0:
+                    raise RateLimitedError(
+                        "生成token数超出限额",
+                        max(1, int(math.ceil(tokens.seconds_until(1))))
+                    )
+            if requests_per_minute:
+                request_buckets.append(
+                    self._bucket(self._request_buckets, key, requests_per_minute, request_burst)
+                )
+        for bucket in request_buckets:
+            if bucket.available() < 1:
+                raise RateLimitedError(
+                    "请求过于频繁",
+                    max(1, int(math.ceil(bucket.seconds_until(1))))
+                )
+        for bucket in request_buckets:
+            bucket.try_consume(1)
+
+    def _prune_idle_tenants(self, now):
+        """定期清理长时间空闲的租户状态，保证内存有界"""
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        cutoff = now - TENANT_IDLE_TTL
+        queued = self._queued_counts()
+        for tenant in [t for t, s in self._tenants.items() if s.last_seen < cutoff and t not in queued]:
+            del self._tenants[tenant]
+        for buckets in (self._request_buckets, self._token_buckets):
+            for key in [k for k, b in buckets.items() if b.updated < cutoff]:
+                del buckets[key]
+
+    # ---------- 调度 ----------
+    def retry_after(self):
+        """按当前排队长度和平均生成耗时估算建议的重试等待秒数"""
+        service = self._service_seconds or 10.0
+        rounds = (self._waiting + self._active) / max(self.max_concurrency, 1)
+        return max(1, int(math.ceil(service * max(rounds, 1))))
+
+    def _next_lease(self):
+        """轮转顺序中第一个分组里第一个租户的队首请求"""
+        for tenants in self._queues.values():
+            for queue in tenants.values():
+                return queue[0]
+        return None
+
+    def _dequeue(self, lease, admitted):
+        tenants = self._queues[lease.group]
+        queue = tenants[lease.tenant]
+        queue.remove(lease)
+        self._waiting -= 1
+        if not queue:
+            del tenants[lease.tenant]
+        elif admitted:
+            # 已放行的租户移到分组内轮转末尾
+            tenants.move_to_end(lease.tenant)
+        if not tenants:
+            del self._queues[lease.group]
+        elif admitted:
+            # 已放行的分组移到轮转末尾
+            self._queues.move_to_end(lease.group)
+
+    def _queued_counts(self):
+        """租户 -> 排队数"""
+        return {
+            tenant: len(queue)
+            for tenants in self._queues.values()
+            for tenant, queue in tenants.items()
+        }
+
+    def _tenant_stats(self, tenant, now):
+        stats = self._tenants.get(tenant)
+        if stats is None:
+            stats = self._tenants[tenant] = _TenantStats()
+        stats.last_seen = now
+        return stats
+
+    def acquire(self, tenant=None, rate_keys=None, group=None, cancel_token=None, poll_interval=0.1):
+        """
+        等待一个生成槽位，返回 Lease
+
+        group 为租户所属分组（客户端IP），省略时租户自成一组。
+        触发限流抛出 RateLimitedError，队列已满抛出 QueueFullError，
+        超过 queue_timeout 抛出 QueueTimeoutError。cancel_token（见 cancellation.py）
+        在排队期间每 poll_interval 秒检查一次，客户端断开或超过截止时间时退出队列并抛出 GenerationCancelled。
+        """
+        tenant = tenant or DEFAULT_TENANT
+        group = group or tenant
+        rate_keys = [tenant] + [k for k in (rate_keys or []) if k and k != tenant]
+        start = time.monotonic()
+        lease = Lease(tenant, group, rate_keys, start)
+
+        with self._cond:
+            self._prune_idle_tenants(start)
+            tenant_stats = self._tenant_stats(tenant, start)
+            tenant_stats.requests += 1
+
+            try:
+                self._check_rate_limits(rate_keys, tenant)
+            except RateLimitedError:
+                self._rejected_rate += 1
+                tenant_stats.rejected += 1
+                raise
+
+            if self._active < self.max_concurrency and not self._waiting:
+                return self._admit(lease, start)
+
+            group_tenants = self._queues.get(group)
+            if group_tenants is None:
+                group_tenants = OrderedDict()
+            tenant_queue = group_tenants.get(tenant)
+            group_waiting = sum(len(queue) for queue in group_tenants.values())
+            if self._waiting >= self.max_queue or (
+                    tenant_queue is not None and len(tenant_queue) >= self.max_queue_per_tenant) or (
+                    self.max_queue_per_group and group_waiting >= self.max_queue_per_group):
+                self._rejected_full += 1
+                tenant_stats.rejected += 1
+                raise QueueFullError("请求过多，等待队列已满", self.retry_after())
+
+            self._queues.setdefault(group, group_tenants)
+            if tenant_queue is None:
+                tenant_queue = group_tenants[tenant] = deque()
+            tenant_queue.append(lease)
+            self._waiting += 1
+
+            deadline = start + self.queue_timeout
+            admitted = False
+            try:
+                while not (self._next_lease() is lease and self._active < self.max_concurrency):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._rejected_timeout += 1
+                        tenant_stats.rejected += 1
+                        raise QueueTimeoutError("排队等待超时", self.retry_after())
+                    if cancel_token is not None:
+                        if cancel_token.cancelled:
+                            self._cancelled_waiting += 1
+                            raise GenerationCancelled(cancel_token.reason)
+                        remaining = min(remaining, poll_interval)
+                    self._cond.wait(remaining)
+                admitted = True
+            finally:
+                self._dequeue(lease, admitted)
+                # 队首变化，唤醒其余等待者重新检查
+                self._cond.notify_all()
+
+            return self._admit(lease, time.monotonic())
+
+    def _admit(self, lease, now):
+        self._active += 1
+        self._admitted += 1
+        lease.started = now
+        lease.waited = now - lease.arrived
+        self._wait_samples.append(lease.waited)
+        return lease
+
+    def release(self, lease):
+        """释放槽位，记录延迟并按实际生成token数扣减租户的token桶"""
+        now = time.monotonic()
+        with self._cond:
+            self._active -= 1
+            service_seconds = now - lease.started
+            if self._service_seconds is None:
+                self._service_seconds = service_seconds
+            else:
+                self._service_seconds = 0.8 * self._service_seconds + 0.2 * service_seconds
+
+            self._tenant_stats(lease.tenant, now).latencies.append(now - lease.arrived)
+            if lease.completion_tokens:
+                for key in lease.rate_keys:
+                    _, _, tokens_per_minute, token_burst = self._limits(key, lease.tenant)
+                    if tokens_per_minute:
+                        self._bucket(self._token_buckets, key, tokens_per_minute, token_burst).debit(
+                            lease.completion_tokens
+                        )
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, tenant=None, rate_keys=None, group=None, cancel_token=None):
+        """获取槽位并在退出时释放"""
+        lease = self.acquire(tenant, rate_keys, group, cancel_token=cancel_token)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    # ---------- 指标 ----------
+    def tenant_stats(self, limit=20):
+        """请求数最多的若干租户的延迟分位数"""
+        with self._cond:
+            tenants = sorted(self._tenants.items(), key=lambda item: item[1].requests, reverse=True)[:limit]
+            queued = self._queued_counts()
+            result = {}
+            for tenant, stats in tenants:
+                latencies = sorted(stats.latencies)
+                result[tenant] = {
+                    "requests": stats.requests,
+                    "rejected": stats.rejected,
+                    "queued": queued.get(tenant, 0),
+                    "latency_seconds_p50": _percentile(latencies, 0.50),
+                    "latency_seconds_p99": _percentile(latencies, 0.99)
+                }
+            return result
+
+    def stats(self):
+        """队列深度、等待时间等指标，用于容量规划"""
+        with self._cond:
+            waits = sorted(self._wait_samples)
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "max_queue_per_tenant": self.max_queue_per_tenant,
+                "max_queue_per_group": self.max_queue_per_group,
+                "queue_timeout": self.queue_timeout,
+                "active": self._active,
+                "queue_depth": self._waiting,
+                "queued_tenants": sum(len(tenants) for tenants in self._queues.values()),
+                "queued_groups": len(self._queues),
+                "admitted": self._admitted,
+                "rejected_queue_full": self._rejected_full,
+                "rejected_timeout": self._rejected_timeout,
+                "rejected_rate_limited": self._rejected_rate,
+                "cancelled_waiting": self._cancelled_waiting,
+                "wait_seconds_p50": _percentile(waits, 0.50),
+                "wait_seconds_p95": _percentile(waits, 0.95),
+                "wait_seconds_max": waits[-1] if waits else 0.0,
+                "avg_service_seconds": self._service_seconds
+            }
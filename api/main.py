@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Request, Response, Cookie
+from fastapi import FastAPI, HTTPException, Request, Response, Cookie, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
@@ -7,8 +7,13 @@ from pathlib import Path
 import sys
 import logging
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
 from datetime import datetime
 import json
+import os
+import time
 
 # 配置日志
 logging.basicConfig(
@@ -23,7 +28,12 @@ project_root = current_dir.parent
 sys.path.insert(0, str(project_root))
 sys.path.insert(0, str(project_root / "scripts"))
 
-from llm_rag import initialize_components, HybridQA
+from inference_client import InferenceClient, RemoteHybridQA
+from admission_control import AdmissionController, AdmissionRejected
+from metrics import StageTimer, render_prometheus, observe_request, server_timing_header, CONTENT_TYPE
+from worker_health import workers_summary
+from conversation_db import read_history, delete_history, attach_conversation_db
+from cancellation import CancelToken, GenerationCancelled
 
 class Config:
     API_TITLE = "公共艺术智能问答系统API"
@@ -32,6 +42,33 @@ class Config:
     HOST = "0.0.0.0"
     PORT = 8000
     COOKIE_MAX_AGE = 86400  # 24小时
+    # 推理核心进程地址，设置后本服务作为瘦客户端，不加载模型
+    INFERENCE_SERVER = os.environ.get("INFERENCE_SERVER")
+    # 离线模拟后端（fake_backend.py），无需模型权重和Ollama
+    FAKE_BACKEND = os.environ.get("RAG_FAKE_BACKEND", "0") == "1"
+    # 生成准入控制
+    MAX_CONCURRENCY = int(os.environ.get("CHAT_MAX_CONCURRENCY", 1))
+    MAX_QUEUE = int(os.environ.get("CHAT_MAX_QUEUE", 8))
+    QUEUE_TIMEOUT = float(os.environ.get("CHAT_QUEUE_TIMEOUT", 60))
+    # 先按客户端IP、再按会话的公平调度与限流
+    MAX_QUEUE_PER_TENANT = int(os.environ.get("CHAT_MAX_QUEUE_PER_TENANT", 2))
+    MAX_QUEUE_PER_IP = int(os.environ.get("CHAT_MAX_QUEUE_PER_IP", 6))
+    REQUESTS_PER_MINUTE = float(os.environ.get("CHAT_REQUESTS_PER_MINUTE", 12))
+    REQUEST_BURST = float(os.environ.get("CHAT_REQUEST_BURST", 4))
+    TOKENS_PER_MINUTE = float(os.environ.get("CHAT_TOKENS_PER_MINUTE", 6000))
+    TOKEN_BURST = float(os.environ.get("CHAT_TOKEN_BURST", 4000))
+    # 单个客户端IP的限额，远高于会话限额：讲座、展览现场的访客常共用一个出口IP，
+    # 同时防止不断更换会话ID绕过会话限额（0为不限）
+    IP_REQUESTS_PER_MINUTE = float(os.environ.get("CHAT_IP_REQUESTS_PER_MINUTE", 120))
+    IP_REQUEST_BURST = float(os.environ.get("CHAT_IP_REQUEST_BURST", 30))
+    IP_TOKENS_PER_MINUTE = float(os.environ.get("CHAT_IP_TOKENS_PER_MINUTE", 60000))
+    IP_TOKEN_BURST = float(os.environ.get("CHAT_IP_TOKEN_BURST", 30000))
+    # 单个请求（含排队）的截止时间（秒），超时或客户端断开后停止生成，0为不限
+    REQUEST_DEADLINE = float(os.environ.get("CHAT_DEADLINE", 300))
+    DISCONNECT_POLL_INTERVAL = 0.5
+    # 阻塞调用的线程池：生成（含排队等待）与历史读写分开，互不阻塞
+    GENERATION_THREADS = int(os.environ.get("API_GENERATION_THREADS", MAX_CONCURRENCY + MAX_QUEUE))
+    IO_THREADS = int(os.environ.get("API_IO_THREADS", 4))
 
 app = FastAPI(
     title=Config.API_TITLE,
@@ -51,20 +88,119 @@ app.add_middleware(
 
 # 全局变量
 qa_system = None
+admission = AdmissionController(
+    max_concurrency=Config.MAX_CONCURRENCY,
+    max_queue=Config.MAX_QUEUE,
+    queue_timeout=Config.QUEUE_TIMEOUT,
+    max_queue_per_tenant=Config.MAX_QUEUE_PER_TENANT,
+    max_queue_per_group=Config.MAX_QUEUE_PER_IP,
+    requests_per_minute=Config.REQUESTS_PER_MINUTE,
+    request_burst=Config.REQUEST_BURST,
+    tokens_per_minute=Config.TOKENS_PER_MINUTE,
+    token_burst=Config.TOKEN_BURST,
+    ip_requests_per_minute=Config.IP_REQUESTS_PER_MINUTE,
+    ip_request_burst=Config.IP_REQUEST_BURST,
+    ip_tokens_per_minute=Config.IP_TOKENS_PER_MINUTE,
+    ip_token_burst=Config.IP_TOKEN_BURST
+)
+generation_executor = ThreadPoolExecutor(max_workers=Config.GENERATION_THREADS, thread_name_prefix="generation")
+io_executor = ThreadPoolExecutor(max_workers=Config.IO_THREADS, thread_name_prefix="history-io")
+
+async def run_blocking(executor, func, *args, **kwargs):
+    """在指定线程池中执行同步调用，不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+async def watch_disconnect(request: Request, cancel_token: CancelToken):
+    """轮询客户端连接，断开时取消生成"""
+    while not cancel_token.cancelled:
+        if await request.is_disconnected():
+            logger.info("客户端已断开连接，取消生成")
+            cancel_token.cancel("disconnect")
+            return
+        await asyncio.sleep(Config.DISCONNECT_POLL_INTERVAL)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """记录接口耗时，并通过 Server-Timing 头返回本次请求各阶段耗时"""
+    start = time.perf_counter()
+    request.state.stage_timings = {}
+    response = await call_next(request)
+    total = time.perf_counter() - start
+    route = request.scope.get("route")
+    observe_request(route.path if route else "unmatched", response.status_code, total)
+    timings = dict(request.state.stage_timings)
+    timings["total"] = total
+    response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
+def load_qa_system():
+    """创建问答系统（同步）；production_server.py 在 fork worker 前调用以共享模型"""
+    if Config.INFERENCE_SERVER:
+        logger.info(f"使用推理核心进程: {Config.INFERENCE_SERVER}")
+        return RemoteHybridQA(InferenceClient(Config.INFERENCE_SERVER))
+    if Config.FAKE_BACKEND:
+        from fake_backend import FakeHybridQA
+        logger.warning("使用离线模拟后端（RAG_FAKE_BACKEND=1）")
+        return FakeHybridQA()
+    logger.info("正在初始化模型组件...")
+    from llm_rag import initialize_components, HybridQA
+    components = initialize_components()
+    # 每轮问答记入 ConversationDB，历史接口分页读取
+    qa_system = attach_conversation_db(HybridQA(components))
+    logger.info("模型初始化完成")
+    return qa_system
+
+def worker_status():
+    """本worker的心跳内容（多worker部署，见 production_server.py）"""
+    queue_stats = admission.stats()
+    return {
+        "ready": qa_system is not None,
+        "active": queue_stats["active"],
+        "queue_depth": queue_stats["queue_depth"],
+        "admitted": queue_stats["admitted"]
+    }
+
+def answer_with_admission(question, session_id, client_ip, cancel_token):
+    """
+    在生成线程中排队、回答并释放槽位，返回 (回答, 各阶段耗时)
+
+    获取和释放槽位在同一个同步调用内，等待它的协程被取消也不会遗留未释放的槽位
+    """
+    lease = admission.acquire(
+        f"session:{session_id}", [f"ip:{client_ip}"], group=f"ip:{client_ip}", cancel_token=cancel_token
+    )
+    try:
+        timer = StageTimer("hybrid_qa")
+        timer.add("queue", lease.waited)
+        ask_kwargs = {"cancel_token": cancel_token} if getattr(qa_system, "supports_cancellation", False) else {}
+        cancel_token.raise_if_cancelled()
+        with timer.stage("ask"):
+            answer = qa_system.ask(question, session_id, **ask_kwargs)
+        # HybridQA 不返回token数，按字符数近似计入token限额
+        lease.completion_tokens = len(answer)
+        return answer, timer.timings
+    finally:
+        admission.release(lease)
 
 @app.on_event("startup")
 async def startup_event():
-    """启动时初始化模型"""
+    """启动时初始化模型；已在主进程预加载时直接复用"""
     global qa_system
+    if qa_system is not None:
+        return
     try:
-        logger.info("正在初始化模型组件...")
-        components = initialize_components()
-        qa_system = HybridQA(components)
-        logger.info("模型初始化完成")
+        qa_system = await run_blocking(io_executor, load_qa_system)
     except Exception as e:
         logger.error(f"模型初始化失败: {e}")
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭线程池"""
+    generation_executor.shutdown(wait=False)
+    io_executor.shutdown(wait=False)
+
 class QuestionRequest(BaseModel):
     question: str
     session_id: str = None
@@ -93,8 +229,42 @@ async def ask_question(
         # 优先使用请求中的session_id，否则使用Cookie中的，否则创建新的
         session_id = data.get("session_id") or session_id or str(uuid4())
         
-        # 调用问答系统
-        answer = qa_system.ask(question, session_id)
+        # 客户端断开或超过截止时间时取消生成（问答系统支持时在解码中途停止）
+        cancel_token = CancelToken.with_timeout(Config.REQUEST_DEADLINE)
+        watcher = asyncio.create_task(watch_disconnect(request, cancel_token))
+        
+        # 调用问答系统（受准入队列限制，先按客户端IP、再按会话轮转调度；会话和IP各有限额；
+        # 排队、生成和释放槽位在同一个生成线程中完成，不阻塞事件循环）
+        client_ip = request.client.host if request.client else "unknown"
+        try:
+            answer, stage_timings = await run_blocking(
+                generation_executor, answer_with_admission, question, session_id, client_ip, cancel_token
+            )
+        except AdmissionRejected as e:
+            logger.warning(f"请求被拒绝: {e}，队列状态: {admission.stats()}")
+            return JSONResponse(
+                status_code=e.status_code,
+                content={
+                    "success": False,
+                    "error": "服务繁忙，请稍后重试",
+                    "detail": str(e),
+                    "retry_after": e.retry_after
+                },
+                headers={"Retry-After": str(e.retry_after)}
+            )
+        except GenerationCancelled as e:
+            logger.warning(f"会话 {session_id} 的生成已取消: {e.reason}")
+            return JSONResponse(
+                status_code=504 if e.reason == "deadline" else 499,
+                content={"success": False, "error": "生成超时" if e.reason == "deadline" else "请求已取消"}
+            )
+        except asyncio.CancelledError:
+            # 协程被取消（客户端断开、服务关闭）：生成线程仍在运行，通知它尽快结束并释放槽位
+            cancel_token.cancel("disconnect")
+            raise
+        finally:
+            watcher.cancel()
+        request.state.stage_timings = stage_timings
         
         # 设置响应
         resp_data = {
@@ -129,20 +299,27 @@ async def ask_question(
         )
 
 @app.get("/api/history")
-async def get_history(session_id: str = Cookie(default=None)):
-    """获取对话历史"""
+async def get_history(
+    session_id: str = Cookie(default=None),
+    limit: int = Query(default=20, ge=1, le=200),
+    offset: int = Query(default=0, ge=0)
+):
+    """获取对话历史，按轮分页：offset 为从最新一轮往前跳过的轮数"""
     if not session_id:
         return {"success": False, "error": "无效的会话ID"}
     
     try:
-        history = qa_system.get_conversation_history(session_id)
+        history = await run_blocking(io_executor, read_history, qa_system, session_id, limit=limit, offset=offset)
         return {
             "success": True,
             "history": {
                 "user_queries": history.user_queries,
                 "bot_responses": history.bot_responses,
                 "created_at": history.created_at.isoformat(),
-                "updated_at": history.updated_at.isoformat()
+                "updated_at": history.updated_at.isoformat(),
+                "total_turns": history.total_turns,
+                "limit": limit,
+                "offset": offset
             }
         }
     except Exception as e:
@@ -163,7 +340,7 @@ async def clear_history(response: Response, session_id: str = Cookie(default=Non
         return {"success": False, "error": "无效的会话ID"}
     
     try:
-        qa_system.db.delete_conversation(session_id)
+        await run_blocking(io_executor, delete_history, qa_system, session_id)
         # 清除Cookie
         response.delete_cookie("session_id")
         return {"success": True, "message": "对话历史已清除"}
@@ -178,14 +355,27 @@ async def clear_history(response: Response, session_id: str = Cookie(default=Non
             }
         )
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus指标"""
+    return Response(content=render_prometheus(), media_type=CONTENT_TYPE)
+
 @app.get("/health")
 async def health_check():
     """健康检查"""
-    return {
+    health = {
         "status": "healthy",
         "version": Config.API_VERSION,
-        "model_loaded": qa_system is not None
+        "model_loaded": qa_system is not None,
+        "queue": admission.stats(),
+        "tenants": admission.tenant_stats(),
+        "worker_pid": os.getpid(),
+        "workers": workers_summary()
     }
+    if isinstance(qa_system, RemoteHybridQA):
+        health["model_loaded"] = await run_blocking(io_executor, qa_system.client.is_ready)
+        health["inference_server"] = Config.INFERENCE_SERVER
+    return health
 
 if __name__ == "__main__":
     logger.info("\n服务启动信息:")
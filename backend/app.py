@@ -1,16 +1,28 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from flask_cors import CORS
 import sys
 import os
 import logging
 import traceback
+import threading
+import time
+import hmac
+from uuid import uuid4
 from datetime import datetime
 
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # 导入大模型相关模块
-from 组合5 import initialize_system, generate_response
+from 组合5 import initialize_system, generate_response, get_system_status
+from inference_client import InferenceClient, InferenceServerError
+from admission_control import AdmissionController, AdmissionRejected
+from session_store import SessionStore
+from metrics import render_prometheus, observe_request, record_cache, server_timing_header, CONTENT_TYPE
+from sampling_profiler import profiler, ProfilerBusyError
+from worker_health import workers_summary
+from coalescing import SingleFlight, request_fingerprint
+from cancellation import CancelToken, GenerationCancelled, disconnect_watcher, wsgi_socket
 
 # 配置日志
 logging.basicConfig(
@@ -22,9 +34,13 @@ logger = logging.getLogger('Backend_API')
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
+# 推理核心进程地址（如 unix:///tmp/rag-inference.sock），设置后本进程不加载模型
+INFERENCE_SERVER = os.environ.get('INFERENCE_SERVER')
+inference_client = InferenceClient(INFERENCE_SERVER) if INFERENCE_SERVER else None
+
 # 全局变量存储系统组件
 system_components = None
-conversation_history = []
+initialization_thread = None
 
 # 对话历史配置
 HISTORY_CONFIG = {
@@ -34,40 +50,153 @@ HISTORY_CONFIG = {
     "max_total_length": 50000     # 总历史记录最大长度
 }
 
+# 会话存储配置（每个会话独立的历史，空闲过期并限制总内存）
+SESSION_CONFIG = {
+    "ttl_seconds": float(os.environ.get('SESSION_TTL', 3600)),                # 会话空闲过期时间（秒）
+    "max_sessions": int(os.environ.get('SESSION_MAX_SESSIONS', 1000)),       # 内存中最多保留的会话数
+    "max_total_chars": int(os.environ.get('SESSION_MAX_TOTAL_CHARS', 20_000_000)),  # 所有会话消息总字符数上限
+    "db_path": os.environ.get('SESSION_DB_PATH') or None,                     # 设置后异步持久化到SQLite
+    "shared": os.environ.get('SESSION_SHARED', '0') == '1'                    # 多worker部署时以SQLite为准（需要db_path）
+}
+session_store = SessionStore(
+    max_messages=HISTORY_CONFIG["max_messages"],
+    max_total_length=HISTORY_CONFIG["max_total_length"],
+    **SESSION_CONFIG
+)
+SESSION_COOKIE_MAX_AGE = 86400
+
+# 管理接口令牌，未设置时管理接口不可用
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+def wait_for_inference_server(poll_interval=2):
+    """等待推理核心进程就绪，返回其健康检查信息"""
+    logger.info(f"使用推理核心进程: {INFERENCE_SERVER}")
+    while True:
+        try:
+            health = inference_client.health()
+        except InferenceServerError as e:
+            logger.warning(f"推理核心进程暂不可用: {e}")
+            health = None
+        if health and health.get('ready'):
+            return health
+        if health and health.get('error'):
+            raise RuntimeError(f"推理核心进程初始化失败: {health['error']}")
+        time.sleep(poll_interval)
+
+# 生成准入控制配置
+ADMISSION_CONFIG = {
+    "max_concurrency": int(os.environ.get('CHAT_MAX_CONCURRENCY', 1)),   # 同时生成的请求数
+    "max_queue": int(os.environ.get('CHAT_MAX_QUEUE', 8)),               # 最大排队请求数
+    "queue_timeout": float(os.environ.get('CHAT_QUEUE_TIMEOUT', 60)),    # 排队时限（秒）
+    "max_queue_per_tenant": int(os.environ.get('CHAT_MAX_QUEUE_PER_TENANT', 2)),   # 单个会话最多排队数
+    "max_queue_per_group": int(os.environ.get('CHAT_MAX_QUEUE_PER_IP', 6)),        # 单个客户端IP最多排队数
+    "requests_per_minute": float(os.environ.get('CHAT_REQUESTS_PER_MINUTE', 12)),  # 单个会话每分钟请求数
+    "request_burst": float(os.environ.get('CHAT_REQUEST_BURST', 4)),
+    "tokens_per_minute": float(os.environ.get('CHAT_TOKENS_PER_MINUTE', 6000)),    # 单个会话每分钟生成token数
+    "token_burst": float(os.environ.get('CHAT_TOKEN_BURST', 4000)),
+    # 单个客户端IP的限额，远高于会话限额：讲座、展览现场的访客常共用一个出口IP，
+    # 同时防止不断更换会话ID绕过会话限额（0为不限）
+    "ip_requests_per_minute": float(os.environ.get('CHAT_IP_REQUESTS_PER_MINUTE', 120)),
+    "ip_request_burst": float(os.environ.get('CHAT_IP_REQUEST_BURST', 30)),
+    "ip_tokens_per_minute": float(os.environ.get('CHAT_IP_TOKENS_PER_MINUTE', 60000)),
+    "ip_token_burst": float(os.environ.get('CHAT_IP_TOKEN_BURST', 30000))
+}
+admission = AdmissionController(**ADMISSION_CONFIG)
+
+# 相同请求合并配置：会话第一轮的相同问题只生成一次，其余请求共享结果
+COALESCE_CONFIG = {
+    "enabled": os.environ.get('CHAT_COALESCE', '1') == '1',
+    "wait_timeout": float(os.environ.get('CHAT_COALESCE_TIMEOUT', 300))   # 等待进行中请求的时限（秒）
+}
+coalescer = SingleFlight(
+    retry_on=(AdmissionRejected, GenerationCancelled), wait_timeout=COALESCE_CONFIG["wait_timeout"]
+)
+
+# 单个聊天请求（含排队）的截止时间（秒），超时或客户端断开后停止生成，0为不限
+CHAT_DEADLINE = float(os.environ.get('CHAT_DEADLINE', 300))
+
 def initialize_backend():
     """初始化系统组件"""
     global system_components
     try:
         logger.info("正在初始化后端系统...")
-        system_components = initialize_system()
+        if inference_client is not None:
+            health = wait_for_inference_server()
+            system_components = {'load_timings': health.get('load_timings', {})}
+        else:
+            system_components = initialize_system()
         logger.info("后端系统初始化完成")
     except Exception as e:
         logger.error(f"系统初始化失败: {e}")
         logger.error(traceback.format_exc())
 
+def start_background_initialization():
+    """在后台线程中初始化系统，HTTP服务可以立即启动并报告加载进度"""
+    global initialization_thread
+    if initialization_thread is not None and initialization_thread.is_alive():
+        return initialization_thread
+    initialization_thread = threading.Thread(
+        target=initialize_backend,
+        name="backend-init",
+        daemon=True
+    )
+    initialization_thread.start()
+    return initialization_thread
+
+def worker_status():
+    """本worker的心跳内容（多worker部署，见 production_server.py）"""
+    queue_stats = admission.stats()
+    return {
+        'ready': system_components is not None,
+        'active': queue_stats['active'],
+        'queue_depth': queue_stats['queue_depth'],
+        'admitted': queue_stats['admitted']
+    }
+
+def run_generate_response(messages, user_message, generation_stats=None, session_id=None, cancel_token=None):
+    """在本进程或推理核心进程中生成回复"""
+    if inference_client is not None:
+        return inference_client.generate_response(
+            messages, user_message, generation_stats=generation_stats, session_id=session_id,
+            cancel_token=cancel_token
+        )
+    return generate_response(
+        system_components, messages, user_message, generation_stats=generation_stats, session_id=session_id,
+        cancel_token=cancel_token
+    )
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.stage_timings = {}
+
+@app.after_request
+def record_request_metrics(response):
+    """记录接口耗时，并通过 Server-Timing 头返回本次请求各阶段耗时"""
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return response
+    total = time.perf_counter() - start
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe_request(endpoint, response.status_code, total)
+    timings = dict(getattr(g, 'stage_timings', {}))
+    timings['total'] = total
+    response.headers['Server-Timing'] = server_timing_header(timings)
+    return response
+
 def truncate_message(message, max_length):
     """截断过长的消息"""
     if len(message) > max_length:
         return message[:max_length-100] + "...[消息已截断]"
     return message
 
-def manage_history_size():
-    """管理历史记录大小"""
-    global conversation_history
-    
-    # 检查总长度
-    total_length = sum(len(msg.get('content', '')) for msg in conversation_history)
-    if total_length > HISTORY_CONFIG["max_total_length"]:
-        # 如果总长度超限，删除最旧的消息
-        while total_length > HISTORY_CONFIG["max_total_length"] and len(conversation_history) > 4:
-            removed_msg = conversation_history.pop(0)
-            total_length -= len(removed_msg.get('content', ''))
-        logger.info(f"历史记录总长度超限，已删除旧消息，当前长度: {total_length}")
-    
-    # 检查消息数量
-    if len(conversation_history) > HISTORY_CONFIG["max_messages"]:
-        conversation_history[:] = conversation_history[-HISTORY_CONFIG["max_messages"]:]
-        logger.info(f"历史记录数量超限，已截断，当前数量: {len(conversation_history)}")
+def resolve_session_id(data=None):
+    """从请求体、查询参数或Cookie中获取会话ID"""
+    return (data or {}).get('session_id') or request.args.get('session_id') or request.cookies.get('session_id')
+
+def with_session_cookie(resp, session_id):
+    resp.set_cookie('session_id', session_id, max_age=SESSION_COOKIE_MAX_AGE, httponly=True, samesite='Lax')
+    return resp
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
@@ -102,17 +231,60 @@ def chat():
             "content": "你是一个公共艺术专家，请根据提供的文献资料，用专业且详细的方式回答问题。"
         })
         
-        # 添加历史对话记录 - 增加保留的对话轮次
-        for msg in conversation_history[-HISTORY_CONFIG["max_rounds"]*2:]:  # 保留更多轮对话
-            messages.append(msg)
+        # 添加本会话的历史对话记录
+        session_id = resolve_session_id(data) or str(uuid4())
+        history = session_store.get_messages(session_id, limit=HISTORY_CONFIG["max_rounds"]*2)
+        messages.extend(history)
         
         # 添加当前用户消息
         messages.append({"role": "user", "content": user_message})
         
         logger.info(f"当前对话历史包含 {len(messages)} 条消息")
         
-        # 生成响应
-        response = generate_response(system_components, messages, user_message)
+        # 生成响应（受准入队列限制，先按客户端IP、再按会话轮转调度；会话和IP各有限额）
+        client_ip = request.remote_addr or 'unknown'
+        # 客户端断开或超过截止时间时取消排队后的生成
+        cancel_token = CancelToken.with_timeout(CHAT_DEADLINE)
+        client_socket = wsgi_socket(request.environ)
+        
+        def generate():
+            with admission.slot(f"session:{session_id}", [f"ip:{client_ip}"], group=f"ip:{client_ip}",
+                                cancel_token=cancel_token) as lease:
+                if lease.waited:
+                    logger.info(f"请求排队等待 {lease.waited:.2f}s")
+                generation_stats = {}
+                response = run_generate_response(messages, user_message, generation_stats, session_id, cancel_token)
+                lease.completion_tokens = generation_stats.get('completion_tokens', 0)
+            return response, {'queue': lease.waited, **generation_stats.get('stage_seconds', {})}
+        
+        # 第一轮提问与进行中的相同问题合并，不再排队和生成
+        coalesce_key = request_fingerprint(user_message, history) if COALESCE_CONFIG["enabled"] else None
+        try:
+            wait_start = time.perf_counter()
+            # 排队、等待合并的相同请求和生成期间都检测客户端断开
+            with disconnect_watcher.watch(client_socket, cancel_token):
+                (response, stage_timings), shared = coalescer.run(coalesce_key, generate, cancel_token)
+            if coalesce_key is not None:
+                record_cache('coalesce', shared)
+            if shared:
+                logger.info(f"与进行中的相同问题合并，等待 {time.perf_counter() - wait_start:.2f}s")
+                stage_timings = {'coalesced': time.perf_counter() - wait_start}
+            g.stage_timings = stage_timings
+        except AdmissionRejected as e:
+            logger.warning(f"请求被拒绝: {e}，队列状态: {admission.stats()}")
+            resp = jsonify({
+                'success': False,
+                'error': f'服务繁忙，请稍后重试（{e}）',
+                'retry_after': e.retry_after
+            })
+            resp.headers['Retry-After'] = str(e.retry_after)
+            return resp, e.status_code
+        except GenerationCancelled as e:
+            logger.warning(f"会话 {session_id} 的生成已取消: {e.reason}")
+            if e.reason == 'deadline':
+                return jsonify({'success': False, 'error': '生成超时，请稍后重试'}), 504
+            # 客户端已断开，响应不会被读取
+            return jsonify({'success': False, 'error': '请求已取消'}), 499
         
         # 截断过长的响应
         response = truncate_message(response, HISTORY_CONFIG["max_message_length"])
@@ -120,27 +292,19 @@ def chat():
         # 添加助手响应到历史
         messages.append({"role": "assistant", "content": response})
         
-        # 更新全局对话历史（只保存用户和助手的对话，不包含系统消息）
-        conversation_history.extend([
-            {"role": "user", "content": user_message},
-            {"role": "assistant", "content": response}
-        ])
-        
-        # 管理历史记录大小
-        manage_history_size()
+        # 更新会话历史（只保存用户和助手的对话，不包含系统消息），超限时自动裁剪
+        history_info = session_store.append_turn(session_id, user_message, response)
         
         logger.info(f"生成响应完成，长度: {len(response)}")
-        logger.info(f"当前历史记录: {len(conversation_history)} 条消息")
+        logger.info(f"会话 {session_id} 当前历史记录: {history_info['message_count']} 条消息")
         
-        return jsonify({
+        return with_session_cookie(jsonify({
             'success': True,
             'response': response,
+            'session_id': session_id,
             'timestamp': datetime.now().isoformat(),
-            'history_info': {
-                'message_count': len(conversation_history),
-                'total_length': sum(len(msg.get('content', '')) for msg in conversation_history)
-            }
-        })
+            'history_info': history_info
+        }), session_id)
         
     except Exception as e:
         logger.error(f"处理聊天请求时出错: {e}")
@@ -150,20 +314,151 @@ def chat():
             'error': f'服务器内部错误: {str(e)}'
         }), 500
 
+def index_status():
+    """向量索引版本和切换状态；使用推理核心进程时取其状态"""
+    if inference_client is not None:
+        try:
+            return inference_client.health().get('index')
+        except InferenceServerError:
+            return None
+    manager = system_components.get('index_manager') if system_components else None
+    return manager.stats() if manager is not None else None
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """健康检查接口"""
+    """健康检查接口，包含各组件就绪状态和加载耗时"""
+    if inference_client is not None:
+        try:
+            components = inference_client.health().get('components', {})
+        except InferenceServerError as e:
+            components = {'inference_server': {'state': 'failed', 'seconds': None, 'error': str(e)}}
+    else:
+        components = get_system_status()
+    initializing = initialization_thread is not None and initialization_thread.is_alive()
+    failed = any(status['state'] == 'failed' for name, status in components.items() if name != 'warmup')
     return jsonify({
-        'status': 'healthy',
+        'status': 'unhealthy' if failed and not initializing else 'healthy',
         'system_initialized': system_components is not None,
+        'initializing': initializing,
+        'components': components,
+        'load_timings': system_components.get('load_timings', {}) if system_components else {},
+        'queue': admission.stats(),
+        'tenants': admission.tenant_stats(),
+        'coalescing': coalescer.stats(),
+        'index': index_status(),
+        'sessions': session_store.stats(),
+        'worker_pid': os.getpid(),
+        'workers': workers_summary(),
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus指标（本进程；使用推理核心进程时生成相关指标见其 /metrics）"""
+    return Response(render_prometheus(), content_type=CONTENT_TYPE)
+
+def is_admin_request():
+    """校验请求头 X-Admin-Token"""
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+@app.route('/api/admin/profile', methods=['POST'])
+def admin_profile():
+    """
+    对本进程所有线程做限时采样分析，返回折叠栈文件（可用 flamegraph.pl / speedscope 打开）
+    
+    参数: seconds（默认10，最大60）、interval（采样间隔秒数，默认0.005）
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({'success': False, 'error': '管理接口未启用（未设置 ADMIN_TOKEN）'}), 404
+    if not is_admin_request():
+        return jsonify({'success': False, 'error': '无权访问'}), 403
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 0.005))
+    except ValueError:
+        return jsonify({'success': False, 'error': '参数格式错误'}), 400
+    
+    logger.info(f"开始采样分析: {seconds}s，间隔 {interval}s")
+    try:
+        collapsed, profile_stats = profiler.profile(seconds, interval)
+    except ProfilerBusyError as e:
+        return jsonify({'success': False, 'error': str(e)}), 409
+    logger.info(f"采样分析完成: {profile_stats}")
+    
+    filename = f"profile-{os.getpid()}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed"
+    resp = Response(collapsed, content_type='text/plain; charset=utf-8')
+    resp.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    resp.headers['X-Profile-Samples'] = str(profile_stats['samples'])
+    resp.headers['X-Profile-Duration'] = f"{profile_stats['duration_seconds']:.3f}"
+    return resp
+
+@app.route('/api/admin/reload-index', methods=['POST'])
+def admin_reload_index():
+    """
+    重新加载向量索引（不停服切换到 CURRENT 指向的版本或指定版本）
+    
+    参数: version（默认读取 CURRENT；指定时须为已通过校验的版本，加载成功后 CURRENT 随之更新）、
+    wait（为 1 时等待加载和预热完成再返回，否则返回202）
+    多worker部署时本接口只切换处理请求的worker，其余worker由 RAG_INDEX_WATCH_INTERVAL 的轮询跟进
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({'success': False, 'error': '管理接口未启用（未设置 ADMIN_TOKEN）'}), 404
+    if not is_admin_request():
+        return jsonify({'success': False, 'error': '无权访问'}), 403
+    data = request.get_json(silent=True) or {}
+    version = data.get('version') or request.args.get('version')
+    wait = str(data.get('wait', request.args.get('wait', '0'))).lower() in ('1', 'true')
+    
+    if inference_client is not None:
+        try:
+            index = inference_client.reload_index(version, wait=wait)
+        except InferenceServerError as e:
+            return jsonify({'success': False, 'error': str(e)}), e.status or 502
+        return jsonify({'success': True, 'index': index}), 200 if wait else 202
+    
+    manager = system_components.get('index_manager') if system_components else None
+    if manager is None:
+        return jsonify({'success': False, 'error': '系统未就绪或当前后端不支持索引热切换'}), 409
+    if version is not None:
+        try:
+            manager.validate_version(version)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+    logger.info(f"重新加载向量索引: {version or 'CURRENT'}")
+    if not wait:
+        manager.reload_in_background(version)
+        return jsonify({'success': True, 'index': manager.stats()}), 202
+    try:
+        manager.reload(version)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e), 'index': manager.stats()}), 500
+    return jsonify({'success': True, 'index': manager.stats()})
+
 @app.route('/api/clear-history', methods=['POST'])
 def clear_history():
-    """清空对话历史"""
-    global conversation_history
-    conversation_history.clear()
+    """清空当前会话的对话历史"""
+    session_id = resolve_session_id(request.get_json(silent=True))
+    if not session_id:
+        return jsonify({
+            'success': False,
+            'error': '无效的会话ID'
+        }), 400
+    session_store.clear(session_id)
+    # 滚动摘要和历史轮次向量在模型所在进程中，一并清除，否则下一轮仍会带上旧摘要和旧轮次
+    if inference_client is not None:
+        try:
+            inference_client.reset_session(session_id)
+        except InferenceServerError as e:
+            logger.error(f"清除推理核心进程中的会话状态失败: {e}")
+            return jsonify({
+                'success': False,
+                'error': f'清除会话状态失败: {str(e)}'
+            }), 502
+    elif system_components:
+        for name in ('history_compactor', 'turn_retriever'):
+            if system_components.get(name):
+                system_components[name].reset(session_id)
     return jsonify({
         'success': True,
         'message': '对话历史已清空'
@@ -171,14 +466,21 @@ def clear_history():
 
 @app.route('/api/history', methods=['GET'])
 def get_history():
-    """获取对话历史"""
-    total_length = sum(len(msg.get('content', '')) for msg in conversation_history)
+    """获取当前会话的对话历史"""
+    session_id = resolve_session_id()
+    if not session_id:
+        return jsonify({
+            'success': False,
+            'error': '无效的会话ID'
+        }), 400
+    messages = session_store.get_messages(session_id)
     return jsonify({
         'success': True,
-        'history': conversation_history,
+        'session_id': session_id,
+        'history': messages,
         'history_info': {
-            'message_count': len(conversation_history),
-            'total_length': total_length,
+            'message_count': len(messages),
+            'total_length': sum(len(message.get('content', '')) for message in messages),
             'max_messages': HISTORY_CONFIG["max_messages"],
             'max_total_length': HISTORY_CONFIG["max_total_length"],
             'max_rounds': HISTORY_CONFIG["max_rounds"]
@@ -186,9 +488,8 @@ def get_history():
     })
 
 if __name__ == '__main__':
-    # 在应用启动时初始化系统
-    with app.app_context():
-        initialize_backend()
+    # 在后台初始化系统，服务启动后即可响应健康检查
+    start_background_initialization()
     
     # 开发模式配置
     app.run(
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+按会话隔离的对话历史存储
+
+每个会话的消息保存在 deque 中，并维护消息总长度的计数，追加和裁剪都是 O(1)，
+不再每次请求重新扫描整段历史。空闲超过 TTL 的会话被清理；所有会话的消息总字符数
+超过上限时按最近最少使用顺序淘汰整个会话。可选地将消息异步批量写入SQLite，
+被淘汰的会话再次访问时从数据库恢复最近的消息。多进程部署时（shared=True）以
+SQLite为准：读取历史时重新读取，写入同步落盘，各worker看到一致的历史。
+数据库读写都在存储锁之外进行，一个会话的读盘不会阻塞其他会话；过期会话由后台线程定期清理。
+"""
+
+import os
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict, deque
+
+logger = logging.getLogger('Session_Store')
+
+
+class SessionHistory:
+    """单个会话的消息队列"""
+
+    __slots__ = ("messages", "total_length", "last_access")
+
+    def __init__(self):
+        self.messages = deque()
+        self.total_length = 0
+        self.last_access = time.monotonic()
+
+    def append(self, message):
+        self.messages.append(message)
+        self.total_length += len(message.get('content', ''))
+
+    def popleft(self):
+        message = self.messages.popleft()
+        self.total_length -= len(message.get('content', ''))
+        return message
+
+
+class SessionStore:
+    """
+    会话历史存储
+
+    max_messages / max_total_length 限制单个会话，max_sessions / max_total_chars
+    限制全部会话，ttl_seconds 为会话空闲过期时间，后台线程每 evict_interval 秒清理一次
+    （默认取 TTL 的四分之一，最长60秒）。设置 db_path 后启用SQLite写后持久化；
+    shared=True 时（需要 db_path）改为同步写入，get_messages/info 从数据库重新读取，
+    供多个worker进程共用同一份会话历史。
+    """
+
+    def __init__(self, max_messages=60, max_total_length=50000, min_messages=4,
+                 ttl_seconds=3600, max_sessions=1000, max_total_chars=20_000_000,
+                 db_path=None, flush_interval=1.0, shared=False, evict_interval=None):
+        if shared and not db_path:
+            raise ValueError("shared=True 需要设置 db_path")
+        self.max_messages = max_messages
+        self.max_total_length = max_total_length
+        self.min_messages = min_messages
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_total_chars = max_total_chars
+        self.shared = shared
+
+        self._lock = threading.RLock()
+        # 会话ID -> SessionHistory，顺序即最近访问顺序（最旧的在前）
+        self._sessions = OrderedDict()
+        self._total_chars = 0
+        self._evicted_ttl = 0
+        self._evicted_memory = 0
+
+        self.db_path = db_path
+        self._write_queue = None
+        self._write_lock = None
+        self._flush_interval = flush_interval
+        self._evict_interval = evict_interval or min(max(ttl_seconds / 4, flush_interval), 60.0)
+        if db_path:
+            self._init_db()
+            self._write_queue = queue.Queue()
+            # 保证后台线程和 flush() 按入队顺序写入
+            self._write_lock = threading.Lock()
+        self._start_background()
+        # 预加载后 fork 出的worker不能沿用父进程的锁和后台线程
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reinit_after_fork)
+
+    def _start_background(self):
+        name = "session-writer" if self.db_path else "session-evictor"
+        self._writer = threading.Thread(target=self._background_loop, name=name, daemon=True)
+        self._writer.start()
+
+    def _reinit_after_fork(self):
+        """子进程中重建锁和后台线程；父进程中待写的数据由父进程负责写入"""
+        self._lock = threading.RLock()
+        if self.db_path:
+            self._write_queue = queue.Queue()
+            self._write_lock = threading.Lock()
+        self._start_background()
+
+    # ---------- 会话访问 ----------
+    def _load(self, session_id, reload=False):
+        """
+        在锁外从数据库读取会话的消息，供随后的 _get 使用
+
+        内存中已有该会话（且不要求 reload）或未启用数据库时不读取，返回 None
+        """
+        if not self.db_path:
+            return None
+        if not reload:
+            with self._lock:
+                if session_id in self._sessions:
+                    return None
+        return self._load_from_db(session_id)
+
+    def _get(self, session_id, loaded=None, create=True):
+        """
+        取会话并标记为最近访问，须持有 self._lock
+
+        loaded 为 _load 读出的消息：内存中没有该会话，或 shared 模式下以数据库为准时用它重建。
+        create 为假（只读访问）时，内存和数据库中都没有的会话返回 None 且不创建，
+        随机或过期的会话ID不会占用内存
+        """
+        history = self._sessions.get(session_id)
+        if loaded is not None and (history is None or self.shared):
+            if history is not None:
+                # 其他worker可能已修改该会话，以数据库为准
+                self._drop(session_id)
+            if not create and not loaded:
+                return None
+            history = SessionHistory()
+            for message in loaded:
+                history.append(message)
+            self._trim(history)
+            self._sessions[session_id] = history
+            self._total_chars += history.total_length
+            if not create:
+                # 写入路径在追加后淘汰，只读路径恢复会话后在此淘汰
+                self._evict(keep=session_id)
+        elif history is None:
+            if not create:
+                return None
+            history = SessionHistory()
+            self._sessions[session_id] = history
+        else:
+            self._sessions.move_to_end(session_id)
+        history.last_access = time.monotonic()
+        return history
+
+    def _trim(self, history):
+        """按单会话上限从最旧的消息开始裁剪，返回删除的消息数"""
+        removed = 0
+        while history.total_length > self.max_total_length and len(history.messages) > self.min_messages:
+            history.popleft()
+            removed += 1
+        while len(history.messages) > self.max_messages:
+            history.popleft()
+            removed += 1
+        return removed
+
+    def get_messages(self, session_id, limit=None):
+        """返回会话最近的 limit 条消息（副本）"""
+        loaded = self._load(session_id, reload=self.shared)
+        with self._lock:
+            history = self._get(session_id, loaded, create=False)
+            if history is None:
+                return []
+            messages = history.messages
+            if limit is not None and len(messages) > limit:
+                return [messages[i] for i in range(len(messages) - limit, len(messages))]
+            return list(messages)
+
+    def append_turn(self, session_id, user_message, assistant_message):
+        """
+        追加一轮问答并按上限裁剪，返回追加后的 info()
+
+        shared 模式下不重新读取数据库：本次请求读取历史时已同步过
+        """
+        new_messages = [
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": assistant_message}
+        ]
+        loaded = self._load(session_id)
+        with self._lock:
+            history = self._get(session_id, loaded)
+            before = history.total_length
+            for message in new_messages:
+                history.append(message)
+            removed = self._trim(history)
+            if removed:
+                logger.info(f"会话 {session_id} 历史超限，已删除 {removed} 条旧消息，当前长度: {history.total_length}")
+            self._total_chars += history.total_length - before
+            self._evict(keep=session_id)
+            info = {'message_count': len(history.messages), 'total_length': history.total_length}
+
+        if self._write_queue is not None:
+            self._write_queue.put(("append", session_id, new_messages, time.time()))
+            if self.shared:
+                self.flush()
+        return info
+
+    def clear(self, session_id):
+        """清空会话历史"""
+        with self._lock:
+            history = self._sessions.pop(session_id, None)
+            if history is not None:
+                self._total_chars -= history.total_length
+        if self._write_queue is not None:
+            self._write_queue.put(("delete", session_id, None, None))
+            if self.shared:
+                self.flush()
+
+    def info(self, session_id):
+        """会话的消息数和总长度"""
+        loaded = self._load(session_id, reload=self.shared)
+        with self._lock:
+            history = self._get(session_id, loaded, create=False)
+            if history is None:
+                return {'message_count': 0, 'total_length': 0}
+            return {
+                'message_count': len(history.messages),
+                'total_length': history.total_length
+            }
+
+    # ---------- 淘汰 ----------
+    def _drop(self, session_id):
+        history = self._sessions.pop(session_id)
+        self._total_chars -= history.total_length
+
+    def _evict(self, keep=None):
+        """清理过期会话，并在超出会话数或总字符数上限时淘汰最久未访问的会话"""
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._sessions:
+            session_id, history = next(iter(self._sessions.items()))
+            if history.last_access >= cutoff or session_id == keep:
+                break
+            self._drop(session_id)
+            self._evicted_ttl += 1
+
+        while len(self._sessions) > 1 and (
+                len(self._sessions) > self.max_sessions or self._total_chars > self.max_total_chars):
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                break
+            self._drop(session_id)
+            self._evicted_memory += 1
+
+    def evict_expired(self):
+        """清理过期会话（后台线程定期调用）"""
+        with self._lock:
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'total_chars': self._total_chars,
+                'max_sessions': self.max_sessions,
+                'max_total_chars': self.max_total_chars,
+                'ttl_seconds': self.ttl_seconds,
+                'evicted_ttl': self._evicted_ttl,
+                'evicted_memory': self._evicted_memory,
+                'pending_writes': self._write_queue.qsize() if self._write_queue is not None else 0,
+                'persistent': self.db_path is not None,
+                'shared': self.shared
+            }
+
+    # ---------- SQLite 写后持久化 ----------
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS session_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_session_messages_session ON session_messages(session_id, id)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _load_from_db(self, session_id):
+        """读取会话最近的消息；先落盘待写队列，保证读到最新数据"""
+        if not self.db_path:
+            return []
+        self.flush()
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT role, content FROM session_messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, self.max_messages)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def _apply(self, conn, ops):
+        for op, session_id, messages, created_at in ops:
+            if op == "append":
+                conn.executemany(
+                    "INSERT INTO session_messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                    [(session_id, m["role"], m["content"], created_at) for m in messages]
+                )
+            elif op == "delete":
+                conn.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+        conn.commit()
+
+    def _drain(self):
+        ops = []
+        while True:
+            try:
+                ops.append(self._write_queue.get_nowait())
+            except queue.Empty:
+                return ops
+
+    def flush(self):
+        """立即把待写操作写入数据库"""
+        if self._write_queue is None:
+            return
+        with self._write_lock:
+            ops = self._drain()
+            if not ops:
+                return
+            conn = self._connect()
+            try:
+                self._apply(conn, ops)
+            finally:
+                conn.close()
+
+    def _background_loop(self):
+        """批量写入待写操作，并定期清理过期会话"""
+        conn = self._connect() if self.db_path else None
+        next_evict = time.monotonic() + self._evict_interval
+        while True:
+            time.sleep(min(self._flush_interval, self._evict_interval))
+            if conn is not None:
+                with self._write_lock:
+                    ops = self._drain()
+                    if ops:
+                        try:
+                            self._apply(conn, ops)
+                        except sqlite3.Error as e:
+                            logger.error(f"写入会话历史失败: {e}")
+            if time.monotonic() >= next_evict:
+                next_evict = time.monotonic() + self._evict_interval
+                self.evict_expired()
@@ -32,9 +32,10 @@ def check_dependencies():
         logger.error(f"找不到模型文件: {model_file}")
         return False
     
-    # 检查向量数据库目录
-    db_dir = project_root / "chroma_db_deepseek_1.5b"
-    if not db_dir.exists():
+    # 检查向量数据库目录（CURRENT 指向的版本，旧布局时为根目录本身）
+    from index_manager import resolve_index_directory
+    _, db_dir = resolve_index_directory(project_root / "chroma_db_deepseek_1.5b")
+    if not os.path.exists(db_dir):
         logger.error(f"找不到向量数据库目录: {db_dir}")
         return False
     
@@ -61,13 +62,12 @@ def main():
     
     try:
         # 导入Flask应用
-        from app import app, initialize_backend
+        from app import app, start_background_initialization
         
-        # 在应用上下文中初始化系统
-        with app.app_context():
-            initialize_backend()
+        # 在后台线程中初始化系统，加载进度可通过 /api/health 查看
+        start_background_initialization()
         
-        logger.info("后端服务启动成功")
+        logger.info("后端服务启动成功，模型正在后台加载")
         logger.info("服务地址: http://localhost:5000")
         logger.info("API文档:")
         logger.info("  - POST /api/chat - 聊天接口")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成请求的协作式取消
+
+每个请求持有一个 CancelToken：客户端断开连接或超过服务端截止时间时被触发，
+generation_stopping.CancelTokenCriteria 在每个解码步检查它，model.generate() 随即
+结束，模型尽快让给排队中的请求。只依赖标准库。
+
+断开检测:
+    FastAPI    轮询 request.is_disconnected()（见 api/main.py）
+    Flask/WSGI DisconnectWatcher 用一个后台线程轮询请求套接字，对端关闭时触发令牌
+               （gunicorn 的 environ["gunicorn.socket"] 或 Werkzeug 的 environ["werkzeug.socket"]）
+"""
+
+import time
+import socket
+import select
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationCancelled(RuntimeError):
+    """生成被取消，reason 为 disconnect/deadline，wasted_tokens 为已生成但未返回的token数"""
+
+    def __init__(self, reason, wasted_tokens=0):
+        super().__init__(f"生成已取消: {reason}")
+        self.reason = reason
+        self.wasted_tokens = wasted_tokens
+
+
+class CancelToken:
+    """
+    取消令牌
+
+    deadline 为 time.monotonic() 时刻，到期后 cancelled 为真、reason 为 "deadline"。
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @classmethod
+    def with_timeout(cls, seconds):
+        """seconds 为空或非正数时不设截止时间"""
+        return cls(time.monotonic() + seconds if seconds and seconds > 0 else None)
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"取消回调执行失败: {e}")
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        return self._event.is_set()
+
+    def remaining(self):
+        """距截止时间的秒数，没有截止时间时返回 None"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def on_cancel(self, callback):
+        """注册取消时的回调（如关闭下游连接）；已取消时立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self, wasted_tokens=0):
+        if self.cancelled:
+            raise GenerationCancelled(self.reason, wasted_tokens)
+
+
+def acquire_cancellable(lock, cancel_token=None, poll_interval=0.1):
+    """获取锁，等待期间令牌被取消时抛出 GenerationCancelled"""
+    if cancel_token is None:
+        lock.acquire()
+        return
+    while not lock.acquire(timeout=poll_interval):
+        cancel_token.raise_if_cancelled()
+
+
+def peer_closed(sock):
+    """对端是否已关闭连接（可读且窥视到EOF，或连接出错）"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (BlockingIOError, InterruptedError):
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+class DisconnectWatcher:
+    """用一个后台线程轮询所有登记的请求套接字，对端关闭时取消对应令牌"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._watched = {}
+        self._thread = None
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = list(self._watched.items())
+            for key, (sock, token) in watched:
+                if not token.cancelled and peer_closed(sock):
+                    logger.info("客户端已断开连接，取消生成")
+                    token.cancel("disconnect")
+
+    @contextmanager
+    def watch(self, sock, token):
+        """在 with 块内监视 sock；sock 为空时不做检测"""
+        if sock is None:
+            yield token
+            return
+        key = id(token)
+        with self._lock:
+            self._watched[key] = (sock, token)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="disconnect-watcher", daemon=True)
+                self._thread.start()
+        try:
+            yield token
+        finally:
+            with self._lock:
+                self._watched.pop(key, None)
+
+
+def wsgi_socket(environ):
+    """取WSGI请求的底层套接字，服务器不提供时返回 None"""
+    return environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+
+
+disconnect_watcher = DisconnectWatcher()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+相同请求合并（single-flight）
+
+讲座、展览的二维码会让大量访客同时提出同一个问题。对结果不依赖会话历史的请求
+（目前为会话的第一轮提问）按问题内容计算指纹，指纹相同的请求只有第一个（leader）
+真正执行检索和生成，其余请求（follower）等待并共享其结果，不占用准入队列和模型。
+
+leader 因自身原因失败（如被准入控制拒绝）时，等待中的 follower 不会一起失败，
+而是重新竞争成为新的 leader 自行执行；其他异常原样抛给所有 follower。
+follower 等待期间检查自己的取消令牌：自己的客户端断开或截止时间已过时不再等待，也不再重试。
+"""
+
+import re
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def request_fingerprint(question, history=()):
+    """
+    计算可合并请求的指纹，不可合并时返回 None
+
+    history 为本轮之前的消息（不含当前问题）；其中有用户或助手消息时回答依赖历史，不合并。
+    问题只做空白归一化，大小写和标点不同视为不同问题。
+    """
+    if any(msg.get("role") in ("user", "assistant") for msg in history):
+        return None
+    normalized = re.sub(r"\s+", " ", question).strip()
+    if not normalized:
+        return None
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "followers", "started")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+        self.started = time.monotonic()
+
+
+class SingleFlight:
+    """
+    按键合并并发调用
+
+    用法:
+        coalescer = SingleFlight(retry_on=(AdmissionRejected,))
+        result, shared = coalescer.run(key, fn, cancel_token)
+
+    key 为 None 时直接执行 fn。wait_timeout 秒内 leader 未完成时 follower 放弃等待，
+    自行执行 fn。cancel_token（见 cancellation.py）为本请求的令牌，follower 每 poll_interval 秒
+    检查一次，被取消时抛出 GenerationCancelled。
+    """
+
+    def __init__(self, retry_on=(), wait_timeout=300.0, poll_interval=0.1):
+        self.retry_on = tuple(retry_on)
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._leaders = 0
+        self._coalesced = 0
+        self._retried = 0
+        self._abandoned = 0
+
+    def run(self, key, fn, cancel_token=None):
+        """返回 (结果, 是否共享了其他请求的结果)"""
+        if key is None:
+            return fn(), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._leaders += 1
+            else:
+                call.followers += 1
+
+        if leader:
+            try:
+                call.result = fn()
+                return call.result, False
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if not self._wait(call, cancel_token):
+            logger.warning(f"等待相同请求超过 {self.wait_timeout}s，改为自行执行")
+            return fn(), False
+        if call.error is not None:
+            if isinstance(call.error, self.retry_on):
+                # 自己的截止时间已过就不再重新执行
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                with self._lock:
+                    self._retried += 1
+                return self.run(key, fn, cancel_token)
+            raise call.error
+        with self._lock:
+            self._coalesced += 1
+        return call.result, True
+
+    def _wait(self, call, cancel_token):
+        """等待 leader 完成，返回是否在 wait_timeout 内完成；本请求被取消时抛出 GenerationCancelled"""
+        if cancel_token is None:
+            return call.done.wait(self.wait_timeout)
+        deadline = time.monotonic() + self.wait_timeout
+        while not call.done.wait(min(self.poll_interval, max(deadline - time.monotonic(), 0))):
+            if cancel_token.cancelled:
+                with self._lock:
+                    call.followers -= 1
+                    self._abandoned += 1
+                cancel_token.raise_if_cancelled()
+            if time.monotonic() >= deadline:
+                return False
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "waiting_followers": sum(call.followers for call in self._calls.values()),
+                "leaders": self._leaders,
+                "coalesced": self._coalesced,
+                "retried": self._retried,
+                "abandoned": self._abandoned
+            }
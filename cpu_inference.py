@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CPU推理优化
+
+无GPU节点上的对话模型服务：配置线程数、对线性层做动态int8权重量化，
+并可选用 torch.compile 编译解码步。由 调用代码.py 在 CPU 模式下调用。
+"""
+
+import os
+import sys
+import time
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def configure_cpu_threads(num_threads=None, interop_threads=None):
+    """设置算子内/算子间线程数，需在模型首次计算前调用"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # 并行任务启动后不能再修改算子间线程数
+            logger.warning(f"无法设置算子间线程数: {e}")
+    logger.info(
+        f"CPU线程配置: intra-op={torch.get_num_threads()}, "
+        f"inter-op={torch.get_num_interop_threads()}"
+    )
+
+
+def quantize_linear_int8(model):
+    """
+    对所有 nn.Linear 做动态int8权重量化（激活保持float32）
+
+    原地替换各线性层：默认会先深拷贝整个模型，8B模型的float32副本约需32GB额外内存
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model,
+        {torch.nn.Linear},
+        dtype=torch.qint8,
+        inplace=True
+    )
+
+
+def compile_decode_step(model):
+    """编译模型的 forward，generate 的每个解码步都会走编译后的图"""
+    try:
+        model.forward = torch.compile(model.forward, dynamic=True)
+        logger.info("已启用 torch.compile 编译解码步")
+    except Exception as e:
+        logger.warning(f"torch.compile 不可用，使用eager模式: {e}")
+    return model
+
+
+def prepare_cpu_model(model, cpu_config):
+    """
+    将已加载的模型转换为CPU推理形态，返回 (model, 各阶段耗时)
+
+    LoRA适配器会先合并进基础权重，否则量化后仍需额外计算适配器分支。
+    """
+    timings = {}
+
+    if hasattr(model, "merge_and_unload"):
+        start = time.perf_counter()
+        model = model.merge_and_unload()
+        timings["merge_lora"] = time.perf_counter() - start
+
+    # 动态量化只支持float32权重
+    model = model.float()
+
+    if cpu_config.get("quantize_int8", True):
+        start = time.perf_counter()
+        model = quantize_linear_int8(model)
+        timings["quantize_int8"] = time.perf_counter() - start
+        logger.info("线性层已完成动态int8量化")
+
+    if cpu_config.get("compile", False):
+        start = time.perf_counter()
+        model = compile_decode_step(model)
+        timings["compile"] = time.perf_counter() - start
+
+    model.eval()
+    return model, timings
+
+
+def empty_device_cache():
+    """仅在有GPU时释放显存缓存"""
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def peak_memory_mb():
+    """当前进程的峰值常驻内存（MB）"""
+    try:
+        import resource
+    except ImportError:
+        # Windows 下没有 resource 模块
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().peak_wset / 1024 / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为KB，macOS 为字节
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线性能测试用的模拟模型与嵌入
+
+设置 RAG_FAKE_BACKEND=1 后，调用代码.initialize_system、inference_server.py 和
+api/main.py 使用本模块代替 Ollama 嵌入、Qwen3-8B 和 Chroma 向量库：
+    FakeEmbeddings   确定性的字符二元组哈希向量，可配置单次延迟
+    FakeTokenizer    按字符切分的分词器
+    FakeChatModel    按配置的首token延迟和解码速度"生成"确定性回答
+    FixtureIndex     由问答对语料前若干条构成的小型内存索引
+只依赖标准库，整个服务栈可以在没有GPU、模型权重和Ollama的开发机或CI上压测和分析。
+"""
+
+import os
+import sys
+import time
+import math
+import hashlib
+import logging
+import tempfile
+import threading
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+# 模拟参数，均可用环境变量覆盖
+fake_backend_config = {
+    "embed_dim": int(os.environ.get("RAG_FAKE_EMBED_DIM", 256)),
+    "embed_latency": float(os.environ.get("RAG_FAKE_EMBED_LATENCY", 0.005)),       # 单次嵌入耗时（秒）
+    "prefill_latency": float(os.environ.get("RAG_FAKE_PREFILL_LATENCY", 0.1)),     # 首token基础延迟（秒）
+    "prefill_tokens_per_sec": float(os.environ.get("RAG_FAKE_PREFILL_TPS", 4000)),  # prompt处理速度
+    "decode_tokens_per_sec": float(os.environ.get("RAG_FAKE_DECODE_TPS", 40)),     # 解码速度
+    "response_tokens": int(os.environ.get("RAG_FAKE_RESPONSE_TOKENS", 120)),       # 回答长度（token）
+    "batch_decode_overhead": float(os.environ.get("RAG_FAKE_BATCH_OVERHEAD", 0.05)),  # 批量解码时每多一条序列单步耗时增加的比例
+    "fixture_size": int(os.environ.get("RAG_FAKE_FIXTURE_SIZE", 200)),            # 索引中的片段数
+}
+
+
+def fake_backend_enabled():
+    return os.environ.get("RAG_FAKE_BACKEND", "0") == "1"
+
+
+def _stable_hash(text):
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "little")
+
+
+# ================== 嵌入 ==================
+class FakeEmbeddings:
+    """与 OllamaEmbeddings 接口一致：字符二元组哈希到固定维度后归一化"""
+
+    def __init__(self, dim=None, latency=None):
+        self.dim = dim or fake_backend_config["embed_dim"]
+        self.latency = fake_backend_config["embed_latency"] if latency is None else latency
+
+    def _vector(self, text):
+        vector = [0.0] * self.dim
+        text = "".join(text.split())
+        for i in range(max(len(text) - 1, 1)):
+            h = _stable_hash(text[i:i + 2])
+            vector[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_query(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._vector(text)
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency * len(texts))
+        return [self._vector(text) for text in texts]
+
+
+# ================== 索引 ==================
+class FixtureIndex:
+    """小型内存向量索引，提供 调用代码.generate_response 用到的检索接口"""
+
+    def __init__(self, documents, embeddings):
+        self.documents = documents
+        self.embeddings = embeddings
+        self.vectors = [embeddings._vector(doc.page_content) for doc in documents]
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        scored = sorted(
+            range(len(self.documents)),
+            key=lambda i: -sum(a * b for a, b in zip(self.vectors[i], embedding))
+        )
+        return [self.documents[i] for i in scored[:k]]
+
+    def as_retriever(self, search_kwargs=None):
+        return FixtureRetriever(self, search_kwargs or {"k": 4})
+
+
+class FixtureRetriever:
+    def __init__(self, vectorstore, search_kwargs):
+        self.vectorstore = vectorstore
+        self.search_kwargs = search_kwargs
+
+    def get_relevant_documents(self, query):
+        vector = self.vectorstore.embeddings.embed_query(query)
+        return self.vectorstore.similarity_search_by_vector(vector, k=self.search_kwargs["k"])
+
+
+def build_fixture_documents(size=None):
+    """用问答对语料前 size 条构造片段，来源记为对应论文，与真实知识库的元数据格式一致"""
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+    from qa_corpus import iter_qa_pairs
+
+    size = size or fake_backend_config["fixture_size"]
+    documents = []
+    for pair in iter_qa_pairs():
+        if len(documents) >= size:
+            break
+        documents.append(SimpleNamespace(
+            page_content=f"问题：{pair.question}\n回答：{pair.answer}",
+            metadata={"source": f"{pair.title}_{pair.author}.pdf", "page": 1, "type": "fixture"}
+        ))
+    return documents
+
+
+# ================== 分词器与模型 ==================
+class _FakeIds(list):
+    """token序列，提供生成代码用到的 .to(device) 和 .shape"""
+
+    def to(self, device):
+        return self
+
+    @property
+    def shape(self):
+        return (1, len(self))
+
+
+class FakeTokenizer:
+    """按字符切分；截断方向与真实分词器一致（从左侧截断）"""
+
+    eos_token = "[|im_end|]"
+    truncation_side = "left"
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(ch) for ch in text]
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(chr(i) for i in ids)
+
+    def __call__(self, text, max_length=None, truncation=False, **kwargs):
+        ids = self.encode(text)
+        if truncation and max_length and len(ids) > max_length:
+            ids = ids[-max_length:]
+        return SimpleNamespace(input_ids=_FakeIds(ids), attention_mask=_FakeIds([1] * len(ids)))
+
+
+class FakeChatModel:
+    """
+    模拟对话模型
+
+    耗时 = prefill_latency + prompt长度 / prefill_tokens_per_sec + 回答长度 / decode_tokens_per_sec，
+    回答内容由prompt哈希确定，并引用prompt中出现的第一个文献名。批量生成时prefill按总prompt
+    长度计，解码受显存带宽限制，单步耗时只随批大小按 batch_decode_overhead 小幅增加。
+    """
+
+    device = "cpu"
+
+    def __init__(self, tokenizer, **overrides):
+        config = {**fake_backend_config, **overrides}
+        self.tokenizer = tokenizer
+        self.prefill_latency = config["prefill_latency"]
+        self.prefill_tokens_per_sec = config["prefill_tokens_per_sec"]
+        self.decode_tokens_per_sec = config["decode_tokens_per_sec"]
+        self.response_tokens = config["response_tokens"]
+        self.batch_decode_overhead = config["batch_decode_overhead"]
+
+    def _answer(self, prompt, length):
+        start = prompt.find("《")
+        end = prompt.find("》", start)
+        source = prompt[start:end + 1] if start != -1 and end != -1 else "《公共艺术文献》"
+        seed = _stable_hash(prompt) % 1000
+        body = f"根据{source}，这是编号{seed}的模拟回答。"
+        return (body * (length // len(body) + 1))[:length]
+
+    def _sleep_cancellable(self, seconds, cancel_token):
+        """分片等待，cancel_token 被取消时提前返回实际等待的秒数"""
+        start = time.perf_counter()
+        end = start + seconds
+        while True:
+            now = time.perf_counter()
+            if now >= end or (cancel_token is not None and cancel_token.cancelled):
+                return now - start
+            time.sleep(min(0.02, end - now))
+
+    def generate_text(self, input_ids, attention_mask=None, max_new_tokens=None, cancel_token=None, **kwargs):
+        """返回 (回答文本, 统计信息)，统计字段与 generate_with_stop_markers 一致"""
+        prompt = self.tokenizer.decode(input_ids)
+        completion_tokens = min(self.response_tokens, max_new_tokens or self.response_tokens)
+
+        prefill_seconds = self.prefill_latency + len(input_ids) / self.prefill_tokens_per_sec
+        decode_seconds = max(completion_tokens - 1, 0) / self.decode_tokens_per_sec
+        elapsed = self._sleep_cancellable(prefill_seconds + decode_seconds, cancel_token)
+        cancelled = cancel_token.reason if cancel_token is not None and cancel_token.cancelled else None
+        if cancelled:
+            # 取消时只"生成"了已经过时间对应的token
+            decode_seconds = max(elapsed - prefill_seconds, 0.0)
+            produced = int(decode_seconds * self.decode_tokens_per_sec) + 1 if elapsed >= prefill_seconds else 0
+            completion_tokens = min(completion_tokens, produced)
+            prefill_seconds = min(prefill_seconds, elapsed)
+
+        return self._answer(prompt, completion_tokens), {
+            "prompt_tokens": len(input_ids),
+            "completion_tokens": completion_tokens,
+            "max_new_tokens": max_new_tokens,
+            "stopped_on_marker": completion_tokens < (max_new_tokens or 0),
+            "tokens_saved": max((max_new_tokens or 0) - completion_tokens, 0),
+            "prefill_seconds": prefill_seconds,
+            "decode_seconds": decode_seconds,
+            "decode_tokens_per_sec": self.decode_tokens_per_sec,
+            "cancelled": cancelled,
+        }
+
+    def generate_batch(self, input_texts, max_length=None, max_new_tokens=None, **kwargs):
+        """返回 (回答文本列表, 统计信息)，统计字段与 generate_batch_with_stop_markers 一致"""
+        prompts = []
+        for text in input_texts:
+            ids = self.tokenizer(text, max_length=max_length, truncation=bool(max_length)).input_ids
+            prompts.append(self.tokenizer.decode(ids))
+        prompt_tokens = [len(prompt) for prompt in prompts]
+        completion_tokens = min(self.response_tokens, max_new_tokens or self.response_tokens)
+
+        step_seconds = (1 + self.batch_decode_overhead * (len(prompts) - 1)) / self.decode_tokens_per_sec
+        prefill_seconds = self.prefill_latency + sum(prompt_tokens) / self.prefill_tokens_per_sec
+        decode_seconds = max(completion_tokens - 1, 0) * step_seconds
+        time.sleep(prefill_seconds + decode_seconds)
+
+        return [self._answer(prompt, completion_tokens) for prompt in prompts], {
+            "batch_size": len(prompts),
+            "prompt_tokens": prompt_tokens,
+            "padded_prompt_tokens": max(prompt_tokens, default=0),
+            "completion_tokens": [completion_tokens] * len(prompts),
+            "decode_steps": completion_tokens,
+            "max_new_tokens": max_new_tokens,
+            "prefill_seconds": prefill_seconds,
+            "decode_seconds": decode_seconds,
+            "decode_tokens_per_sec": (completion_tokens - 1) * len(prompts) / decode_seconds if decode_seconds > 0 else 0.0,
+        }
+
+
+# ================== 调用代码.initialize_system 使用 ==================
+def init_fake_vector_store(k=4):
+    """与 调用代码._init_vector_store 返回结构一致"""
+    embeddings = FakeEmbeddings()
+    index = FixtureIndex(build_fixture_documents(), embeddings)
+    logger.info(f"模拟向量库就绪，包含 {len(index.documents)} 个片段")
+    return {"retriever": index.as_retriever({"k": k}), "embeddings": embeddings}
+
+
+def init_fake_model():
+    """与 调用代码._init_model 返回结构一致，额外提供 generate_fn"""
+    tokenizer = FakeTokenizer()
+    model = FakeChatModel(tokenizer)
+    logger.info(
+        f"模拟模型就绪: 首token {model.prefill_latency:.2f}s + prompt/{model.prefill_tokens_per_sec:.0f}tps，"
+        f"解码 {model.decode_tokens_per_sec:.0f} tokens/s"
+    )
+    return {
+        "model": model,
+        "tokenizer": tokenizer,
+        "draft_model": None,
+        "generate_fn": model.generate_text,
+        "generate_batch_fn": model.generate_batch,
+        "load_timings": {"total": 0.0}
+    }
+
+
+# ================== api/main.py 的 HybridQA 替身 ==================
+class FakeHybridQA:
+    """
+    HybridQA 的离线替身：检索 + 模拟生成，历史保存在临时 ConversationDB 中
+    接口与 api/main.py 使用的部分一致
+    """
+
+    # ask() 接受 cancel_token
+    supports_cancellation = True
+
+    def __init__(self, components=None, db_path=None):
+        import importlib
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+        from conversation_db import ConversationDB
+
+        self._core = importlib.import_module("调用代码")
+        self.components = components or self._core.initialize_system()
+        if db_path is None:
+            db_path = os.path.join(tempfile.mkdtemp(prefix="fake-hybridqa-"), "conversations.db")
+        self.db = ConversationDB(db_path)
+        self._lock = threading.Lock()
+
+    def ask(self, question, session_id, cancel_token=None):
+        turns = self.db.get_recent_turns(session_id, 5)
+        history = []
+        for user_query, bot_response in turns:
+            history.append({"role": "user", "content": user_query})
+            history.append({"role": "assistant", "content": bot_response})
+        history.append({"role": "user", "content": question})
+        answer = self._core.generate_response(
+            self.components, history, question, session_id=session_id, cancel_token=cancel_token
+        )
+        self.db.add_turn(session_id, question, answer)
+        return answer
+
+    def get_conversation_history(self, session_id):
+        return self.db.get_conversation_history(session_id)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基于对话标记的生成停止条件
+
+模型输出 [|im_end|] 等对话标记后立即结束解码，而不是生成到 max_new_tokens
+之后再切分文本。调用代码.py、scripts/大模型多轮对话.py 和
+scripts/finetune_lora.py 的 test_model 共用此模块。
+"""
+
+import time
+import logging
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+logger = logging.getLogger(__name__)
+
+# 项目提示格式中使用的对话标记
+CHAT_STOP_MARKERS = (
+    "[|im_end|]",
+    "[|im_start|]",
+    "<|im_end|>",
+    "<|im_start|>",
+    "|im_end|",
+    "|im_start|",
+)
+
+# 每步只解码末尾若干token用于匹配标记
+TAIL_TOKENS = 16
+
+
+class ChatMarkerStoppingCriteria(StoppingCriteria):
+    """检测新生成内容末尾是否出现对话标记"""
+
+    def __init__(self, tokenizer, prompt_length, markers=CHAT_STOP_MARKERS, tail_tokens=TAIL_TOKENS):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.markers = tuple(m for m in markers if m)
+        self.tail_tokens = tail_tokens
+        self.triggered = False
+        # 第一次被调用即第一个token生成完成的时刻，用于区分prefill和decode耗时
+        self.first_token_time = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        start = max(self.prompt_length, input_ids.shape[1] - self.tail_tokens)
+        done = []
+        for row in input_ids[:, start:]:
+            tail = self.tokenizer.decode(row, skip_special_tokens=False)
+            done.append(any(marker in tail for marker in self.markers))
+        if any(done):
+            self.triggered = True
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class CancelTokenCriteria(StoppingCriteria):
+    """每个解码步检查取消令牌（见 cancellation.py），被取消时所有序列立即结束"""
+
+    def __init__(self, cancel_token):
+        self.cancel_token = cancel_token
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],), self.cancel_token.cancelled, dtype=torch.bool, device=input_ids.device
+        )
+
+
+def stop_markers_for(tokenizer, markers=CHAT_STOP_MARKERS):
+    """在项目标记基础上加入分词器自身的结束符"""
+    eos_token = getattr(tokenizer, "eos_token", None)
+    if eos_token and eos_token not in markers:
+        return tuple(markers) + (eos_token,)
+    return tuple(markers)
+
+
+def strip_chat_markers(text, markers=CHAT_STOP_MARKERS):
+    """截取第一个对话标记之前的内容"""
+    cut = len(text)
+    for marker in markers:
+        idx = text.find(marker)
+        if idx != -1:
+            cut = min(cut, idx)
+    return text[:cut].strip()
+
+
+def _resolve_max_new_tokens(generate_kwargs):
+    if generate_kwargs.get("max_new_tokens") is not None:
+        return generate_kwargs["max_new_tokens"]
+    generation_config = generate_kwargs.get("generation_config")
+    return getattr(generation_config, "max_new_tokens", None)
+
+
+def generate_with_stop_markers(model, tokenizer, input_ids, attention_mask=None,
+                               markers=CHAT_STOP_MARKERS, cancel_token=None, **generate_kwargs):
+    """
+    带对话标记停止条件的生成
+
+    输入: 已放到模型设备上的 input_ids / attention_mask，其余参数透传给 model.generate；
+          cancel_token 被取消时在下一个解码步结束，统计信息中 cancelled 为取消原因
+    输出: (清理后的回复文本, 生成统计信息)
+    """
+    markers = stop_markers_for(tokenizer, markers)
+    prompt_length = input_ids.shape[1]
+    criteria = ChatMarkerStoppingCriteria(tokenizer, prompt_length, markers)
+
+    stopping_criteria = StoppingCriteriaList([criteria])
+    if cancel_token is not None:
+        stopping_criteria.append(CancelTokenCriteria(cancel_token))
+    extra_criteria = generate_kwargs.pop("stopping_criteria", None)
+    if extra_criteria:
+        stopping_criteria.extend(extra_criteria)
+
+    if attention_mask is not None:
+        generate_kwargs["attention_mask"] = attention_mask
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids,
+            stopping_criteria=stopping_criteria,
+            **generate_kwargs
+        )
+    end = time.perf_counter()
+
+    new_tokens = outputs[0, prompt_length:]
+    text = tokenizer.decode(new_tokens, skip_special_tokens=False)
+    response = strip_chat_markers(text, markers)
+
+    completion_tokens = int(new_tokens.shape[0])
+    max_new_tokens = _resolve_max_new_tokens(generate_kwargs)
+    tokens_saved = 0
+    if criteria.triggered and max_new_tokens:
+        tokens_saved = max(max_new_tokens - completion_tokens, 0)
+
+    first_token_time = criteria.first_token_time or end
+    decode_seconds = end - first_token_time
+    stats = {
+        "prompt_tokens": int(prompt_length),
+        "completion_tokens": completion_tokens,
+        "max_new_tokens": max_new_tokens,
+        "stopped_on_marker": criteria.triggered,
+        "tokens_saved": tokens_saved,
+        # prefill 含第一个token的生成，即首token延迟
+        "prefill_seconds": first_token_time - start,
+        "decode_seconds": decode_seconds,
+        "decode_tokens_per_sec": (completion_tokens - 1) / decode_seconds if decode_seconds > 0 else 0.0,
+        "cancelled": cancel_token.reason if cancel_token is not None and cancel_token.cancelled else None,
+    }
+    logger.info(
+        f"生成 {completion_tokens} 个token"
+        f"{'，检测到对话标记提前结束' if criteria.triggered else ''}，"
+        f"节省 {tokens_saved} 个token"
+    )
+    return response, stats
+
+
+def generate_batch_with_stop_markers(model, tokenizer, input_ids, attention_mask,
+                                     markers=CHAT_STOP_MARKERS, **generate_kwargs):
+    """
+    批量生成，每条序列检测到对话标记后单独结束，全部结束后停止解码
+
+    输入: 左侧填充的 input_ids / attention_mask（已放到模型设备上）
+    输出: (回复文本列表, 生成统计信息)，统计中的 completion_tokens 为逐条列表
+    """
+    markers = stop_markers_for(tokenizer, markers)
+    prompt_length = input_ids.shape[1]
+    criteria = ChatMarkerStoppingCriteria(tokenizer, prompt_length, markers)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    generate_kwargs.setdefault("pad_token_id", pad_token_id)
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            stopping_criteria=StoppingCriteriaList([criteria]),
+            **generate_kwargs
+        )
+    end = time.perf_counter()
+
+    new_tokens = outputs[:, prompt_length:]
+    responses = [
+        strip_chat_markers(tokenizer.decode(row, skip_special_tokens=False), markers)
+        for row in new_tokens
+    ]
+    # 提前结束的序列在其余序列解码期间被填充为 pad_token_id
+    completion_tokens = [int((row != pad_token_id).sum()) for row in new_tokens]
+
+    first_token_time = criteria.first_token_time or end
+    decode_seconds = end - first_token_time
+    stats = {
+        "batch_size": int(input_ids.shape[0]),
+        "prompt_tokens": [int(mask.sum()) for mask in attention_mask],
+        "padded_prompt_tokens": int(prompt_length),
+        "completion_tokens": completion_tokens,
+        "decode_steps": int(new_tokens.shape[1]),
+        "max_new_tokens": _resolve_max_new_tokens(generate_kwargs),
+        "prefill_seconds": first_token_time - start,
+        "decode_seconds": decode_seconds,
+        "decode_tokens_per_sec": (sum(completion_tokens) - len(completion_tokens)) / decode_seconds
+        if decode_seconds > 0 else 0.0,
+    }
+    logger.info(
+        f"批量生成 {len(responses)} 条，共 {sum(completion_tokens)} 个token，"
+        f"解码 {stats['decode_steps']} 步"
+    )
+    return responses, stats
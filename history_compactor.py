@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按token预算压缩对话历史
+
+最近的消息原样保留，更早的消息折叠进每个会话一份的滚动摘要。摘要在回复生成后
+由后台线程增量更新（旧摘要 + 新移出窗口的消息 -> 新摘要），不占用请求路径。
+拼接历史时按token预算从最新消息往前取，不再把整段历史分词后再截断。
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+ROLE_LABELS = {"user": "用户", "assistant": "助手"}
+# 分词结果缓存的条目上限
+TOKEN_CACHE_SIZE = 4096
+
+
+def message_key(message):
+    """消息的稳定标识，用于定位摘要覆盖到的位置"""
+    digest = hashlib.sha1(f"{message['role']}\n{message['content']}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def format_message(message):
+    return f"{ROLE_LABELS[message['role']]}: {message['content']}\n"
+
+
+class _SummaryState:
+    __slots__ = ("summary", "summary_tokens", "last_key")
+
+    def __init__(self):
+        self.summary = ""
+        self.summary_tokens = 0
+        self.last_key = None  # 摘要覆盖到的最后一条消息
+
+
+class HistoryCompactor:
+    """
+    对话历史压缩器
+
+    summarize_fn(previous_summary, messages, max_new_tokens) -> str 负责生成摘要，
+    通常调用对话模型本身。token_budget 为拼接后的历史（含摘要）的token上限，
+    keep_recent_messages 条最新消息永远不会被折叠进摘要。fold_tokens 为每次调用
+    summarize_fn 时新增消息的token上限，积压较多时分多次折叠，摘要提示词长度有界。
+    """
+
+    def __init__(self, tokenizer, summarize_fn, token_budget=1024, summary_tokens=256,
+                 keep_recent_messages=4, max_sessions=1000, fold_tokens=None):
+        self.tokenizer = tokenizer
+        self.summarize_fn = summarize_fn
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.max_sessions = max_sessions
+        self.fold_tokens = fold_tokens or token_budget
+
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+        self._pending = set()
+        self._token_cache = OrderedDict()
+        # 摘要生成串行执行，避免与请求争抢更多显存
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+
+    # ---------- token计数 ----------
+    def count_tokens(self, text):
+        """带缓存的token计数，同一条消息只分词一次"""
+        with self._lock:
+            cached = self._token_cache.get(text)
+            if cached is not None:
+                self._token_cache.move_to_end(text)
+        record_cache("history_tokens", cached is not None)
+        if cached is not None:
+            return cached
+        count = len(self.tokenizer.encode(text, add_special_tokens=False))
+        with self._lock:
+            self._token_cache[text] = count
+            if len(self._token_cache) > TOKEN_CACHE_SIZE:
+                self._token_cache.popitem(last=False)
+        return count
+
+    # ---------- 会话状态 ----------
+    def _state(self, session_id):
+        state = self._states.get(session_id)
+        if state is None:
+            state = self._states[session_id] = _SummaryState()
+            while len(self._states) > self.max_sessions:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(session_id)
+        return state
+
+    def reset(self, session_id):
+        """清空会话摘要（会话历史被清除时调用）"""
+        with self._lock:
+            self._states.pop(session_id, None)
+
+    def _unsummarized_start(self, state, messages):
+        """返回摘要尚未覆盖的第一条消息下标"""
+        if state.last_key is None:
+            return 0
+        for i in range(len(messages) - 1, -1, -1):
+            if message_key(messages[i]) == state.last_key:
+                return i + 1
+        # 找不到摘要的结束位置：历史很短说明会话已被清空重开，丢弃旧摘要；
+        # 否则是旧消息被存储层裁掉，摘要仍然有效
+        if len(messages) <= self.keep_recent_messages + 1:
+            state.summary, state.summary_tokens, state.last_key = "", 0, None
+        return 0
+
+    # ---------- 拼接历史 ----------
+    def render(self, session_id, history, token_budget=None):
+        """
+        拼接提示词中的对话历史
+
+        token_budget 为本次提示词中历史可用的token数（如扣除模板、文献和问题后的剩余），
+        与 self.token_budget 取较小值；连摘要都放不下时省略摘要。
+        输出: (历史文本, 统计信息)，历史文本 = 摘要 + 预算内最新的原文消息
+        """
+        limit = self.token_budget if token_budget is None else min(self.token_budget, token_budget)
+        messages = [m for m in history if m["role"] in ROLE_LABELS]
+        with self._lock:
+            state = self._state(session_id)
+            start = self._unsummarized_start(state, messages)
+            summary, summary_tokens = state.summary, state.summary_tokens
+        if summary_tokens > limit:
+            logger.info(f"会话 {session_id} 的摘要（{summary_tokens} tokens）超出本次历史预算 {limit}，本次省略")
+            summary, summary_tokens = "", 0
+
+        budget = limit - summary_tokens
+        kept = []
+        for message in reversed(messages[start:]):
+            line = format_message(message)
+            tokens = self.count_tokens(line)
+            if tokens > budget:
+                break
+            kept.append(line)
+            budget -= tokens
+        kept.reverse()
+
+        dropped = len(messages) - start - len(kept)
+        if dropped:
+            logger.info(f"会话 {session_id} 有 {dropped} 条旧消息超出历史token预算且尚未摘要，本次未纳入")
+
+        history_str = ""
+        if summary:
+            history_str += f"早前对话摘要: {summary}\n"
+        history_str += "".join(kept)
+        return history_str, {
+            "summary_tokens": summary_tokens,
+            "verbatim_messages": len(kept),
+            "dropped_messages": dropped,
+            "history_tokens": limit - budget
+        }
+
+    # ---------- 后台摘要 ----------
+    def schedule_update(self, session_id, history):
+        """
+        回复生成后调用：若摘要之外的消息已占用过多预算，则在后台把
+        最新 keep_recent_messages 条之前的消息折叠进摘要
+        """
+        messages = [m for m in history if m["role"] in ROLE_LABELS]
+        with self._lock:
+            if session_id in self._pending:
+                return None
+            state = self._state(session_id)
+            start = self._unsummarized_start(state, messages)
+            end = len(messages) - self.keep_recent_messages
+            if end <= start:
+                return None
+            to_fold = messages[start:end]
+        # 未摘要部分还能放进预算时不做摘要
+        unsummarized = sum(self.count_tokens(format_message(m)) for m in messages[start:])
+        if unsummarized + self.summary_tokens <= self.token_budget:
+            return None
+
+        with self._lock:
+            if session_id in self._pending:
+                return None
+            self._pending.add(session_id)
+        return self._executor.submit(self._fold, session_id, to_fold)
+
+    def _clip(self, message):
+        """单条消息超过 fold_tokens 时只保留开头部分用于摘要"""
+        ids = self.tokenizer.encode(message["content"], add_special_tokens=False)
+        if len(ids) <= self.fold_tokens:
+            return message
+        return {**message, "content": self.tokenizer.decode(ids[:self.fold_tokens]) + "……"}
+
+    def _chunks(self, to_fold):
+        """按 fold_tokens 把待折叠消息切成若干段"""
+        chunk, chunk_tokens = [], 0
+        for message in to_fold:
+            tokens = self.count_tokens(format_message(message))
+            if chunk and chunk_tokens + tokens > self.fold_tokens:
+                yield chunk
+                chunk, chunk_tokens = [], 0
+            chunk.append(message)
+            chunk_tokens += tokens
+        if chunk:
+            yield chunk
+
+    def _fold(self, session_id, to_fold):
+        """
+        逐段折叠：每段与上一段得到的摘要合并，完成一段就更新状态，
+        段与段之间模型可以处理其他请求；会话在此期间被清空时停止
+        """
+        try:
+            with self._lock:
+                state = self._state(session_id)
+            folded = 0
+            for chunk in self._chunks(to_fold):
+                with self._lock:
+                    if self._states.get(session_id) is not state:
+                        logger.info(f"会话 {session_id} 已被清空，停止折叠摘要")
+                        return
+                    previous = state.summary
+                chunk_input = [self._clip(message) for message in chunk]
+                summary = self.summarize_fn(previous, chunk_input, self.summary_tokens).strip()
+                if not summary:
+                    return
+                summary_tokens = self.count_tokens(f"早前对话摘要: {summary}\n")
+                with self._lock:
+                    if self._states.get(session_id) is not state:
+                        return
+                    state.summary = summary
+                    state.summary_tokens = summary_tokens
+                    state.last_key = message_key(chunk[-1])
+                folded += len(chunk)
+                logger.debug(f"会话 {session_id} 已折叠 {folded}/{len(to_fold)} 条消息")
+            logger.info(f"会话 {session_id} 已将 {folded} 条消息折叠进摘要（{summary_tokens} tokens）")
+        except Exception as e:
+            logger.warning(f"会话 {session_id} 生成历史摘要失败: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._states),
+                "pending_summaries": len(self._pending),
+                "token_budget": self.token_budget,
+                "summary_tokens": self.summary_tokens
+            }
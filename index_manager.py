@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+向量索引的版本目录与热切换
+
+目录布局（根目录即 调用代码.db_directory）:
+    chroma_db_deepseek_1.5b/
+        CURRENT                  当前版本名（一行文本，原子替换）
+        versions/<版本名>/       各版本的Chroma持久化目录
+            BUILD_INFO.json      构建和校验信息，校验通过的版本才有
+根目录下没有 CURRENT 时按旧布局处理：根目录本身就是索引。
+
+IndexManager 持有当前检索器。重新加载时在后台打开新版本、执行预热查询，然后在锁内
+原子替换；正在使用旧索引的请求（通过 lease() 取得检索器）结束后才释放旧索引。
+可由管理接口触发，也可由后台线程轮询 CURRENT 自动切换。只依赖标准库。
+"""
+
+import os
+import gc
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+POINTER_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+BUILD_INFO_FILE = "BUILD_INFO.json"
+
+
+# ================== 版本目录 ==================
+def versions_directory(root):
+    return os.path.join(root, VERSIONS_DIR)
+
+
+def version_directory(root, version):
+    return os.path.join(root, VERSIONS_DIR, version)
+
+
+def read_current_version(root):
+    """当前版本名，旧布局时返回 None"""
+    try:
+        with open(os.path.join(root, POINTER_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_current_version(root, version):
+    """原子地切换 CURRENT：先写临时文件再替换，读者只会看到旧值或新值"""
+    if not os.path.isdir(version_directory(root, version)):
+        raise FileNotFoundError(f"索引版本不存在: {version}")
+    tmp_path = os.path.join(root, f"{POINTER_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, POINTER_FILE))
+
+
+def list_versions(root):
+    """按名称（即创建时间）排序的版本列表"""
+    directory = versions_directory(root)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name)))
+
+
+def read_build_info(root, version):
+    """版本的构建信息，未完成构建或未通过校验时返回 None"""
+    try:
+        with open(os.path.join(version_directory(root, version), BUILD_INFO_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_build_info(root, version, info):
+    with open(os.path.join(version_directory(root, version), BUILD_INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def resolve_index_directory(root):
+    """返回 (版本名, 索引目录)；旧布局时版本名为 None、目录为根目录"""
+    version = read_current_version(root)
+    if version is None:
+        return None, root
+    return version, version_directory(root, version)
+
+
+# ================== 热切换 ==================
+class IndexHandle:
+    """一个已打开的索引版本及其使用计数"""
+
+    __slots__ = ("version", "directory", "retriever", "leases", "retired", "opened_at")
+
+    def __init__(self, version, directory, retriever):
+        self.version = version
+        self.directory = directory
+        self.retriever = retriever
+        self.leases = 0
+        self.retired = False
+        self.opened_at = time.time()
+
+
+class IndexManager:
+    """
+    持有当前索引并支持不停服切换
+
+    open_fn(directory) 打开索引目录并返回检索器；warmup_fn(retriever) 在切换前对新索引
+    执行预热查询；on_swap(retriever) 在切换后调用（如更新组件字典）。
+    watch_interval 大于0时后台轮询 CURRENT，版本变化后自动重新加载。
+    """
+
+    def __init__(self, root, open_fn, warmup_fn=None, on_swap=None,
+                 version=None, directory=None, retriever=None, watch_interval=0):
+        self.root = root
+        self.open_fn = open_fn
+        self.warmup_fn = warmup_fn
+        self.on_swap = on_swap
+        self.watch_interval = watch_interval
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._current = None
+        self._retired = []
+        self._last_reload = {"state": "idle", "version": None, "seconds": None, "error": None}
+        self._watcher = None
+
+        if retriever is None:
+            version, directory = resolve_index_directory(root)
+            retriever = open_fn(directory)
+        self._current = IndexHandle(version, directory or root, retriever)
+
+        if watch_interval > 0:
+            self._start_watcher()
+        # 预加载后 fork 出的worker需要重建锁和监视线程
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reinit_after_fork)
+
+    # ---------- 使用 ----------
+    @property
+    def retriever(self):
+        return self._current.retriever
+
+    @property
+    def version(self):
+        return self._current.version
+
+    @contextmanager
+    def lease(self):
+        """取得当前检索器；with 块结束前即使发生切换，旧索引也不会被释放"""
+        with self._lock:
+            handle = self._current
+            handle.leases += 1
+        try:
+            yield handle.retriever
+        finally:
+            with self._lock:
+                handle.leases -= 1
+                release = handle.retired and handle.leases == 0
+                if release:
+                    self._retired.remove(handle)
+            if release:
+                self._release(handle)
+
+    # ---------- 切换 ----------
+    def reload(self, version=None):
+        """
+        打开并预热指定版本（默认 CURRENT 指向的版本），然后原子切换
+
+        指定版本时只接受 versions/ 下已通过校验（有 BUILD_INFO.json）的版本，
+        加载成功后同时把 CURRENT 改为该版本，后台轮询和其他worker随之切换，不会被切回。
+        返回切换后的版本名；与当前版本相同时不做任何事。同一时间只进行一次重新加载。
+        """
+        with self._reload_lock:
+            explicit = version is not None
+            if explicit:
+                self.validate_version(version)
+                directory = version_directory(self.root, version)
+            else:
+                version, directory = resolve_index_directory(self.root)
+            if version is None:
+                raise RuntimeError("索引使用旧目录布局（没有 CURRENT），无法热切换，请用 rebuild_vector_db.py 重建")
+            if version == self._current.version:
+                if explicit and read_current_version(self.root) != version:
+                    write_current_version(self.root, version)
+                return version
+
+            logger.info(f"正在加载索引版本 {version}: {directory}")
+            self._last_reload = {"state": "loading", "version": version, "seconds": None, "error": None}
+            start = time.perf_counter()
+            try:
+                retriever = self.open_fn(directory)
+                if self.warmup_fn is not None:
+                    self.warmup_fn(retriever)
+            except Exception as e:
+                self._last_reload = {
+                    "state": "failed", "version": version, "seconds": time.perf_counter() - start, "error": str(e)
+                }
+                logger.error(f"加载索引版本 {version} 失败，继续使用 {self._current.version}: {e}")
+                raise
+
+            if explicit and read_current_version(self.root) != version:
+                write_current_version(self.root, version)
+            new_handle = IndexHandle(version, directory, retriever)
+            with self._lock:
+                old_handle, self._current = self._current, new_handle
+                old_handle.retired = True
+                release = old_handle.leases == 0
+                if not release:
+                    self._retired.append(old_handle)
+            if self.on_swap is not None:
+                self.on_swap(retriever)
+            if release:
+                self._release(old_handle)
+
+            seconds = time.perf_counter() - start
+            self._last_reload = {"state": "ready", "version": version, "seconds": seconds, "error": None}
+            logger.info(f"索引已切换: {old_handle.version} -> {version}，加载和预热耗时 {seconds:.2f}s")
+            return version
+
+    def validate_version(self, version):
+        """检查版本名是 versions/ 下已通过校验的版本（也防止 ../ 之类的路径），否则抛出 ValueError"""
+        if version not in list_versions(self.root):
+            raise ValueError(f"索引版本不存在: {version}")
+        if read_build_info(self.root, version) is None:
+            raise ValueError(f"索引版本 {version} 未完成构建或未通过校验")
+
+    def reload_in_background(self, version=None):
+        """在后台线程中重新加载，立即返回线程"""
+        thread = threading.Thread(target=self._reload_quietly, args=(version,), name="index-reload", daemon=True)
+        thread.start()
+        return thread
+
+    def _reload_quietly(self, version=None):
+        try:
+            self.reload(version)
+        except Exception:
+            # 错误已记录在 _last_reload 和日志中
+            pass
+
+    @staticmethod
+    def _release(handle):
+        """
+        释放旧索引
+
+        langchain 的 Chroma 没有关闭接口，丢弃引用后由垃圾回收释放HNSW索引内存；
+        不同版本位于不同目录，新旧客户端互不影响
+        """
+        logger.info(f"释放索引版本 {handle.version}")
+        handle.retriever = None
+        gc.collect()
+
+    # ---------- 自动切换 ----------
+    def _start_watcher(self):
+        self._watcher = threading.Thread(target=self._watch_loop, name="index-watcher", daemon=True)
+        self._watcher.start()
+
+    def _watch_loop(self):
+        while True:
+            time.sleep(self.watch_interval)
+            version = read_current_version(self.root)
+            if version is not None and version != self._current.version and not self._reload_lock.locked():
+                if self._last_reload["state"] == "failed" and self._last_reload["version"] == version:
+                    # 同一版本加载失败后不反复重试，需人工处理或等待新版本
+                    continue
+                logger.info(f"检测到索引版本变化: {self._current.version} -> {version}")
+                self._reload_quietly()
+
+    def _reinit_after_fork(self):
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        if self.watch_interval > 0:
+            self._start_watcher()
+
+    def stats(self):
+        with self._lock:
+            current = self._current
+            return {
+                "version": current.version,
+                "directory": current.directory,
+                "opened_at": current.opened_at,
+                "active_leases": current.leases,
+                "retired_pending": [(handle.version, handle.leases) for handle in self._retired],
+                "available_versions": list_versions(self.root),
+                "last_reload": dict(self._last_reload),
+                "watching": self.watch_interval > 0
+            }
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+推理核心进程客户端
+
+backend/app.py 和 api/main.py 在设置 INFERENCE_SERVER 环境变量后通过本模块
+调用 inference_server.py，自身不加载模型。只依赖标准库。
+
+生成请求携带取消令牌时，剩余的截止时间随请求发送给推理核心进程；令牌被取消
+（如前端客户端断开）时关闭到推理核心进程的连接，推理核心进程检测到断开后停止解码。
+"""
+
+import json
+import socket
+import http.client
+from datetime import datetime
+from types import SimpleNamespace
+from urllib.parse import urlparse, quote
+
+from cancellation import GenerationCancelled
+
+
+class InferenceServerError(RuntimeError):
+    """推理核心进程返回错误或不可达"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """通过Unix套接字发送HTTP请求"""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class InferenceClient:
+    """推理核心进程的HTTP客户端，地址格式 unix:///path.sock 或 http://host:port"""
+
+    def __init__(self, address, timeout=300):
+        self.address = address
+        self.timeout = timeout
+        self._parsed = urlparse(address)
+
+    def _connection(self, timeout):
+        if self._parsed.scheme == "unix":
+            return UnixHTTPConnection(self._parsed.path, timeout=timeout)
+        return http.client.HTTPConnection(
+            self._parsed.hostname or "127.0.0.1",
+            self._parsed.port or 7000,
+            timeout=timeout
+        )
+
+    @staticmethod
+    def _abort(conn):
+        """从其他线程中断进行中的请求"""
+        sock = conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _request(self, method, path, payload=None, timeout=None, cancel_token=None):
+        body = None
+        headers = {}
+        if payload is not None:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            headers["Content-Type"] = "application/json; charset=utf-8"
+
+        conn = self._connection(timeout or self.timeout)
+        if cancel_token is not None:
+            cancel_token.on_cancel(lambda: self._abort(conn))
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = json.loads(resp.read().decode("utf-8") or "{}")
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise GenerationCancelled(cancel_token.reason) from e
+            raise InferenceServerError(f"无法连接推理核心进程 {self.address}: {e}") from e
+        finally:
+            conn.close()
+
+        if data.get("cancelled"):
+            raise GenerationCancelled(data["cancelled"], data.get("wasted_tokens", 0))
+        if resp.status >= 400:
+            raise InferenceServerError(data.get("error", f"HTTP {resp.status}"), status=resp.status)
+        return data
+
+    def health(self, timeout=5):
+        return self._request("GET", "/health", timeout=timeout)
+
+    def is_ready(self):
+        try:
+            return bool(self.health().get("ready"))
+        except InferenceServerError:
+            return False
+
+    @staticmethod
+    def _deadline_payload(cancel_token):
+        if cancel_token is None or cancel_token.deadline is None:
+            return {}
+        # 截止时间已过就不再发请求（服务端把非正数当作不设截止时间）
+        cancel_token.raise_if_cancelled()
+        return {"deadline_seconds": max(cancel_token.remaining(), 0.001)}
+
+    def generate_response(self, history, question, generation_stats=None, session_id=None, cancel_token=None):
+        """与 调用代码.generate_response 对应"""
+        data = self._request(
+            "POST", "/v1/generate",
+            {"history": history, "question": question, "session_id": session_id,
+             **self._deadline_payload(cancel_token)},
+            cancel_token=cancel_token
+        )
+        if generation_stats is not None:
+            generation_stats.update(data.get("stats", {}))
+        return data["response"]
+
+    def ask(self, question, session_id, cancel_token=None):
+        """与 HybridQA.ask 对应"""
+        data = self._request(
+            "POST", "/v1/ask",
+            {"question": question, "session_id": session_id, **self._deadline_payload(cancel_token)},
+            cancel_token=cancel_token
+        )
+        return data["answer"]
+
+    def reset_session(self, session_id):
+        """清除推理核心进程中会话的滚动摘要和历史轮次向量（会话历史被清空时调用）"""
+        return self._request("POST", "/v1/reset-session", {"session_id": session_id}).get("reset", [])
+
+    def reload_index(self, version=None, wait=False):
+        """让推理核心进程重新加载向量索引，返回索引状态"""
+        data = self._request("POST", "/v1/admin/reload-index", {"version": version, "wait": wait})
+        return data["index"]
+
+    def get_history(self, session_id, limit=None, offset=0):
+        path = f"/v1/history?session_id={quote(session_id)}&offset={int(offset)}"
+        if limit is not None:
+            path += f"&limit={int(limit)}"
+        return self._request("GET", path)["history"]
+
+    def delete_history(self, session_id):
+        self._request("DELETE", f"/v1/history?session_id={quote(session_id)}")
+
+
+def _history_from_dict(session_id, history):
+    return SimpleNamespace(
+        session_id=session_id,
+        user_queries=history["user_queries"],
+        bot_responses=history["bot_responses"],
+        created_at=datetime.fromisoformat(history["created_at"]),
+        updated_at=datetime.fromisoformat(history["updated_at"]),
+        total_turns=history.get("total_turns", len(history["user_queries"]))
+    )
+
+
+class _RemoteConversationDB:
+    def __init__(self, client):
+        self._client = client
+
+    def get_conversation_history(self, session_id, limit=None, offset=0):
+        return _history_from_dict(session_id, self._client.get_history(session_id, limit, offset))
+
+    def delete_conversation(self, session_id):
+        self._client.delete_history(session_id)
+
+
+class RemoteHybridQA:
+    """HybridQA 的远程代理，接口与 api/main.py 中使用的部分一致"""
+
+    # ask() 接受 cancel_token
+    supports_cancellation = True
+
+    def __init__(self, client):
+        self.client = client
+        self.db = _RemoteConversationDB(client)
+
+    def ask(self, question, session_id, cancel_token=None):
+        return self.client.ask(question, session_id, cancel_token=cancel_token)
+
+    def get_conversation_history(self, session_id):
+        return _history_from_dict(session_id, self.client.get_history(session_id))
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+推理核心进程
+
+独立进程持有大模型、检索器和生成调度，通过本地HTTP（TCP或Unix套接字）提供服务。
+Flask后端（backend/app.py）和FastAPI服务（api/main.py）设置 INFERENCE_SERVER
+环境变量后作为瘦客户端调用本进程，Web进程数量不再决定模型内存占用。
+
+用法:
+    python inference_server.py --listen unix:///tmp/rag-inference.sock
+    python inference_server.py --listen http://127.0.0.1:7000 --engine hybrid
+
+接口:
+    GET    /health                   就绪状态和组件加载耗时
+    GET    /metrics                  Prometheus指标（各阶段耗时、token数、解码速度）
+    POST   /v1/generate              {"history": [...], "question": "...", "session_id": "..."} -> {"response": "...", "stats": {...}}
+    POST   /v1/ask                   {"question": "...", "session_id": "..."} -> {"answer": "..."}（hybrid引擎）
+    GET    /v1/history?session_id=&limit=&offset=   会话历史，按轮分页（hybrid引擎）
+    DELETE /v1/history?session_id=   删除会话历史（hybrid引擎）
+    POST   /v1/reset-session         {"session_id": "..."} 清除会话的滚动摘要和历史轮次向量（rag引擎）
+
+生成请求可带 "deadline_seconds"；超过截止时间或调用方断开连接时停止解码，
+返回 499 {"cancelled": "deadline"/"disconnect", "wasted_tokens": n}。
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import traceback
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# 添加项目根目录和scripts目录到Python路径
+project_root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, "scripts"))
+
+from metrics import StageTimer, render_prometheus, CONTENT_TYPE
+from conversation_db import read_history, delete_history, attach_conversation_db
+from cancellation import CancelToken, GenerationCancelled, acquire_cancellable, disconnect_watcher
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger('Inference_Server')
+
+DEFAULT_LISTEN = "unix:///tmp/rag-inference.sock"
+
+
+class InferenceEngine:
+    """
+    推理引擎：在后台加载组件，同一时间只有一个请求在模型上解码
+
+    rag 引擎使用 调用代码.py 的 initialize_system/generate_response，
+    hybrid 引擎使用 llm_rag 的 initialize_components/HybridQA。
+    """
+
+    def __init__(self, engine="rag"):
+        self.engine = engine
+        self.components = None
+        self.qa_system = None
+        self.error = None
+        self.started_at = time.time()
+        self.ready_seconds = None
+        # rag 引擎只在解码时持有 components["generation_lock"]，检索、提示词构建等可以并发；
+        # llm_rag.HybridQA 没有这样的锁，hybrid 引擎整个 ask 串行执行
+        self._ask_lock = threading.Lock()
+        self._core = None
+
+    def load(self):
+        start = time.perf_counter()
+        try:
+            if self.engine == "hybrid" and os.environ.get("RAG_FAKE_BACKEND", "0") == "1":
+                from fake_backend import FakeHybridQA
+                self.qa_system = FakeHybridQA()
+            elif self.engine == "hybrid":
+                from llm_rag import initialize_components, HybridQA
+                self.qa_system = attach_conversation_db(HybridQA(initialize_components()))
+            else:
+                import importlib
+                self._core = importlib.import_module("调用代码")
+                self.components = self._core.initialize_system()
+            self.ready_seconds = time.perf_counter() - start
+            logger.info(f"推理引擎 {self.engine} 就绪，耗时 {self.ready_seconds:.2f}s")
+        except Exception as e:
+            self.error = str(e)
+            logger.error(f"推理引擎初始化失败: {e}")
+            logger.error(traceback.format_exc())
+
+    def start_loading(self):
+        thread = threading.Thread(target=self.load, name="inference-init", daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def ready(self):
+        return self.components is not None or self.qa_system is not None
+
+    def health(self):
+        status = {
+            "engine": self.engine,
+            "ready": self.ready,
+            "error": self.error,
+            "ready_seconds": self.ready_seconds,
+            "uptime_seconds": time.time() - self.started_at,
+            "pid": os.getpid()
+        }
+        if self._core is not None:
+            status["components"] = self._core.get_system_status()
+        if self.components is not None:
+            status["load_timings"] = self.components.get("load_timings", {})
+        manager = self.index_manager()
+        if manager is not None:
+            status["index"] = manager.stats()
+        return status
+
+    def index_manager(self):
+        """rag 引擎的向量索引管理器，未就绪或不支持热切换时返回 None"""
+        if self.components is None:
+            return None
+        return self.components.get("index_manager")
+
+    def reload_index(self, version=None, wait=False):
+        """重新加载向量索引；wait 为假时在后台加载并立即返回"""
+        manager = self.index_manager()
+        if manager is None:
+            raise RuntimeError("当前引擎不支持索引热切换")
+        if wait:
+            manager.reload(version)
+        else:
+            manager.reload_in_background(version)
+        return manager.stats()
+
+    def generate(self, history, question, session_id=None, cancel_token=None):
+        """返回 (回复文本, 生成统计信息)"""
+        if self.components is None:
+            raise RuntimeError("rag 引擎未就绪")
+        stats = {}
+        response = self._core.generate_response(
+            self.components, history, question, generation_stats=stats, session_id=session_id,
+            cancel_token=cancel_token
+        )
+        return response, stats
+
+    def ask(self, question, session_id, cancel_token=None):
+        if self.qa_system is None:
+            raise RuntimeError("hybrid 引擎未就绪")
+        kwargs = {"cancel_token": cancel_token} if getattr(self.qa_system, "supports_cancellation", False) else {}
+        timer = StageTimer("hybrid_qa")
+        acquire_cancellable(self._ask_lock, cancel_token)
+        try:
+            with timer.stage("ask"):
+                return self.qa_system.ask(question, session_id, **kwargs)
+        finally:
+            self._ask_lock.release()
+
+    def reset_session(self, session_id):
+        """清除本进程中会话的滚动摘要和历史轮次向量，返回被清除的组件名"""
+        if self.components is None:
+            return []
+        reset = []
+        for name in ("history_compactor", "turn_retriever"):
+            if self.components.get(name):
+                self.components[name].reset(session_id)
+                reset.append(name)
+        return reset
+
+    def get_history(self, session_id, limit=None, offset=0):
+        if self.qa_system is None:
+            raise RuntimeError("hybrid 引擎未就绪")
+        history = read_history(self.qa_system, session_id, limit=limit, offset=offset)
+        return {
+            "user_queries": history.user_queries,
+            "bot_responses": history.bot_responses,
+            "created_at": history.created_at.isoformat(),
+            "updated_at": history.updated_at.isoformat(),
+            "total_turns": history.total_turns
+        }
+
+    def delete_history(self, session_id):
+        if self.qa_system is None:
+            raise RuntimeError("hybrid 引擎未就绪")
+        delete_history(self.qa_system, session_id)
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """JSON请求处理"""
+
+    engine = None
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix套接字没有客户端地址
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status, text, content_type):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode("utf-8"))
+
+    def _query(self, name, default=None):
+        query = parse_qs(urlparse(self.path).query)
+        return query.get(name, [default])[0]
+
+    def _session_id(self):
+        return self._query("session_id")
+
+    def _handle(self, handler):
+        try:
+            status, payload = handler()
+        except GenerationCancelled as e:
+            logger.info(f"生成已取消 {self.path}: {e.reason}")
+            status, payload = 499, {
+                "success": False, "error": str(e), "cancelled": e.reason, "wasted_tokens": e.wasted_tokens
+            }
+        except Exception as e:
+            logger.error(f"处理请求失败 {self.command} {self.path}: {e}")
+            logger.error(traceback.format_exc())
+            status, payload = 500, {"success": False, "error": str(e)}
+        try:
+            self._send_json(status, payload)
+        except OSError as e:
+            # 调用方已断开
+            logger.info(f"响应未能发送 {self.path}: {e}")
+            self.close_connection = True
+
+    def _cancel_token(self, data):
+        """按请求中的截止时间创建取消令牌；调用方断开连接时同样取消"""
+        seconds = data.get("deadline_seconds")
+        if seconds is not None and seconds <= 0:
+            # 调用方的截止时间在请求到达前已过
+            return CancelToken(time.monotonic())
+        return CancelToken.with_timeout(seconds)
+
+    def _not_ready(self):
+        return 503, {"success": False, "error": "推理引擎未就绪", "health": self.engine.health()}
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._handle(lambda: (200, self.engine.health()))
+        elif path == "/metrics":
+            self._send_text(200, render_prometheus(), CONTENT_TYPE)
+        elif path == "/v1/history":
+            def get_history():
+                if not self.engine.ready:
+                    return self._not_ready()
+                limit = self._query("limit")
+                history = self.engine.get_history(
+                    self._session_id(),
+                    limit=int(limit) if limit is not None else None,
+                    offset=int(self._query("offset", 0))
+                )
+                return 200, {"success": True, "history": history}
+            self._handle(get_history)
+        else:
+            self._send_json(404, {"success": False, "error": f"未知路径: {path}"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == "/v1/generate":
+            def generate():
+                if not self.engine.ready:
+                    return self._not_ready()
+                data = self._read_json()
+                token = self._cancel_token(data)
+                with disconnect_watcher.watch(self.connection, token):
+                    response, stats = self.engine.generate(
+                        data.get("history", []), data["question"], data.get("session_id"), cancel_token=token
+                    )
+                return 200, {"success": True, "response": response, "stats": stats}
+            self._handle(generate)
+        elif path == "/v1/ask":
+            def ask():
+                if not self.engine.ready:
+                    return self._not_ready()
+                data = self._read_json()
+                token = self._cancel_token(data)
+                with disconnect_watcher.watch(self.connection, token):
+                    answer = self.engine.ask(data["question"], data.get("session_id"), cancel_token=token)
+                return 200, {"success": True, "answer": answer}
+            self._handle(ask)
+        elif path == "/v1/reset-session":
+            def reset_session():
+                if not self.engine.ready:
+                    return self._not_ready()
+                data = self._read_json()
+                return 200, {"success": True, "reset": self.engine.reset_session(data["session_id"])}
+            self._handle(reset_session)
+        elif path == "/v1/admin/reload-index":
+            def reload_index():
+                if not self.engine.ready:
+                    return self._not_ready()
+                if self.engine.index_manager() is None:
+                    return 409, {"success": False, "error": "当前引擎不支持索引热切换"}
+                data = self._read_json()
+                wait = bool(data.get("wait"))
+                if data.get("version") is not None:
+                    try:
+                        self.engine.index_manager().validate_version(data["version"])
+                    except ValueError as e:
+                        return 400, {"success": False, "error": str(e)}
+                index = self.engine.reload_index(data.get("version"), wait=wait)
+                return (200 if wait else 202), {"success": True, "index": index}
+            self._handle(reload_index)
+        else:
+            self._send_json(404, {"success": False, "error": f"未知路径: {path}"})
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        if path == "/v1/history":
+            def delete_history():
+                if not self.engine.ready:
+                    return self._not_ready()
+                self.engine.delete_history(self._session_id())
+                return 200, {"success": True}
+            self._handle(delete_history)
+        else:
+            self._send_json(404, {"success": False, "error": f"未知路径: {path}"})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """基于Unix套接字的多线程HTTP服务"""
+    daemon_threads = True
+
+
+def create_server(listen, engine):
+    """根据监听地址创建HTTP服务: unix:///path.sock 或 http://host:port"""
+    handler = type("BoundInferenceRequestHandler", (InferenceRequestHandler,), {"engine": engine})
+    parsed = urlparse(listen)
+    if parsed.scheme == "unix":
+        if os.path.exists(parsed.path):
+            os.remove(parsed.path)
+        return ThreadingUnixHTTPServer(parsed.path, handler)
+    return ThreadingHTTPServer((parsed.hostname or "127.0.0.1", parsed.port or 7000), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="公共艺术RAG推理核心进程")
+    parser.add_argument("--listen", default=os.environ.get("INFERENCE_SERVER", DEFAULT_LISTEN),
+                        help="监听地址，unix:///path.sock 或 http://host:port")
+    parser.add_argument("--engine", choices=["rag", "hybrid"], default="rag",
+                        help="rag: 调用代码.py 的RAG对话；hybrid: llm_rag.HybridQA")
+    args = parser.parse_args()
+
+    engine = InferenceEngine(args.engine)
+    server = create_server(args.listen, engine)
+    engine.start_loading()
+
+    logger.info(f"推理核心进程已启动: {args.listen}（引擎: {args.engine}，模型后台加载中）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("收到停止信号，正在关闭推理核心进程...")
+    finally:
+        server.server_close()
+        parsed = urlparse(args.listen)
+        if parsed.scheme == "unix" and os.path.exists(parsed.path):
+            os.remove(parsed.path)
+
+
+if __name__ == "__main__":
+    main()
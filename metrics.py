@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+轻量级延迟与吞吐指标
+
+只依赖标准库：进程内的计数器和直方图，按Prometheus文本格式输出，供
+backend/app.py、api/main.py 和 inference_server.py 的 /metrics 接口使用。
+StageTimer 记录一次请求各阶段（嵌入、检索、提示词、prefill、decode等）的耗时，
+既计入直方图，也可以生成 Server-Timing 响应头。离线脚本可用 write_textfile
+把指标写成 node_exporter textfile 格式。
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 秒级延迟的默认分桶
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKENS_PER_SEC_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320)
+
+
+def _label_str(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """单调递增计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labelnames, key, None, value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """累积分桶直方图"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # 标签值 -> [各桶计数, 总和, 样本数]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    result.append((f"{self.name}_bucket", self.labelnames, key, ("le", _format_value(bound)), cumulative))
+                result.append((f"{self.name}_sum", self.labelnames, key, None, total))
+                result.append((f"{self.name}_count", self.labelnames, key, None, count))
+        return result
+
+
+class MetricsRegistry:
+    """指标注册表，同名指标只创建一次"""
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        """Prometheus文本格式"""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelnames, values, extra, value in metric.samples():
+                lines.append(f"{name}{_label_str(labelnames, values, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_seconds", "各处理阶段耗时（秒）", ("component", "stage")
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "rag_request_seconds", "接口请求总耗时（秒）", ("endpoint", "status")
+)
+TOKENS_TOTAL = REGISTRY.counter(
+    "rag_tokens_total", "prompt/completion token 累计数", ("kind",)
+)
+TOKENS_PER_SEC = REGISTRY.histogram(
+    "rag_decode_tokens_per_second", "解码速度（tokens/s）", buckets=TOKENS_PER_SEC_BUCKETS
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "rag_cache_requests_total", "缓存查询次数，result 为 hit/miss", ("cache", "result")
+)
+GENERATION_CANCELLED = REGISTRY.counter(
+    "rag_generation_cancelled_total", "被取消的生成次数，reason 为 disconnect/deadline", ("reason",)
+)
+WASTED_TOKENS = REGISTRY.counter(
+    "rag_wasted_tokens_total", "已生成但因取消没有返回给用户的token数", ("reason",)
+)
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_generation(stats):
+    """根据 generate_with_stop_markers 返回的统计信息记录token数和解码速度"""
+    TOKENS_TOTAL.inc(stats.get("prompt_tokens", 0), kind="prompt")
+    TOKENS_TOTAL.inc(stats.get("completion_tokens", 0), kind="completion")
+    if stats.get("decode_tokens_per_sec"):
+        TOKENS_PER_SEC.observe(stats["decode_tokens_per_sec"])
+
+
+def record_cancellation(reason, wasted_tokens=0):
+    GENERATION_CANCELLED.inc(reason=reason)
+    WASTED_TOKENS.inc(wasted_tokens, reason=reason)
+
+
+def observe_request(endpoint, status, seconds):
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint, status=str(status))
+
+
+class StageTimer:
+    """
+    记录一次请求各阶段耗时
+
+    用法:
+        timer = StageTimer("rag")
+        with timer.stage("search"):
+            ...
+        response.headers["Server-Timing"] = timer.server_timing()
+    """
+
+    def __init__(self, component="rag"):
+        self.component = component
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """记录外部测得的阶段耗时（如 prefill/decode）"""
+        if seconds is None:
+            return
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, component=self.component, stage=name)
+
+    def server_timing(self):
+        return server_timing_header(self.timings)
+
+
+def server_timing_header(timings):
+    """{阶段: 秒} -> Server-Timing 头（毫秒）"""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def render_prometheus():
+    return REGISTRY.render()
+
+
+def write_textfile(path=None):
+    """离线脚本结束时把指标写成 node_exporter textfile，未指定路径时读取 METRICS_TEXTFILE"""
+    path = path or os.environ.get("METRICS_TEXTFILE")
+    if not path:
+        return None
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+    return path
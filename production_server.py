@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生产环境多worker启动器
+
+backend/start_server.py 使用Werkzeug开发服务器，api/main.py 的 __main__ 使用带
+reload 的 uvicorn，都只适合开发调试。本脚本用 gunicorn 托管多个worker进程：
+主进程先加载一次模型、向量库和问答系统（preload），再 fork 出各worker，模型权重
+和索引以写时复制方式在worker间共享，不会每个worker各占一份内存。
+
+    python production_server.py --app flask --workers 4 --bind 0.0.0.0:5000
+    python production_server.py --app fastapi --workers 4 --bind 0.0.0.0:8000
+
+运维信号（发给主进程，PID见日志或 --pid 文件）：
+    HUP   平滑重启所有worker：新worker从已预加载的主进程 fork，旧worker处理完当前请求后退出
+    USR2  启动新的主进程（重新加载代码、模型和索引），确认正常后向旧主进程发送 QUIT
+    TTIN / TTOU  增加 / 减少一个worker
+
+每个worker定期把状态写入心跳目录（见 worker_health.py），任一worker的健康检查
+接口都会在 workers 字段中汇报全部worker的状态。
+
+准入队列、令牌桶限流和相同请求合并都是每个worker进程各一份，不跨worker共享。
+未显式设置时，排队上限和限流额度的默认值按worker数平分（见 PER_WORKER_LIMIT_DEFAULTS），
+整个服务的总额度与单进程部署大致相同；显式设置的环境变量按每个worker的值生效。
+
+注意：CUDA上下文不能跨 fork 使用。GPU部署时先单独启动 inference_server.py，
+再设置 INFERENCE_SERVER 让这里的worker只负责HTTP、会话和排队；模型在主进程中
+预加载只适用于CPU推理（inference_device=cpu）和离线模拟后端。
+"""
+
+import os
+import gc
+import sys
+import math
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parent
+sys.path.insert(0, str(project_root))
+
+logger = logging.getLogger("Production_Server")
+
+# 启动参数，均可用环境变量或命令行覆盖
+production_config = {
+    "app": os.environ.get("PROD_APP", "flask"),                          # flask（backend/app.py）或 fastapi（api/main.py）
+    "bind": os.environ.get("PROD_BIND"),                                 # 默认 flask 为 0.0.0.0:5000，fastapi 为 0.0.0.0:8000
+    "workers": int(os.environ.get("PROD_WORKERS", 2)),                   # worker进程数
+    "threads": int(os.environ.get("PROD_THREADS", 8)),                   # flask每个worker的请求线程数
+    "timeout": int(os.environ.get("PROD_TIMEOUT", 300)),                 # worker无响应多久后被重启（秒），需大于最长生成时间
+    "graceful_timeout": int(os.environ.get("PROD_GRACEFUL_TIMEOUT", 120)),  # 平滑重启时等待当前请求完成的时间（秒）
+    "keepalive": int(os.environ.get("PROD_KEEPALIVE", 5)),
+    "max_requests": int(os.environ.get("PROD_MAX_REQUESTS", 0)),         # worker处理多少请求后自动重启，0为不限
+    "max_requests_jitter": int(os.environ.get("PROD_MAX_REQUESTS_JITTER", 0)),
+    "preload": os.environ.get("PROD_PRELOAD", "1") == "1",               # 在主进程中预加载模型后再 fork
+    "torch_threads": int(os.environ.get("PROD_TORCH_THREADS", 0)),       # 每个worker的torch线程数，0为CPU核数/worker数
+    "pid_file": os.environ.get("PROD_PID_FILE"),
+    "access_log": os.environ.get("PROD_ACCESS_LOG"),                     # 访问日志路径，"-" 为标准输出
+}
+
+DEFAULT_BINDS = {"flask": "0.0.0.0:5000", "fastapi": "0.0.0.0:8000"}
+
+# 单进程部署时的排队和限流默认值（与 backend/app.py、api/main.py 一致），多worker时按worker数平分
+PER_WORKER_LIMIT_DEFAULTS = {
+    "CHAT_MAX_QUEUE": 8,
+    "CHAT_MAX_QUEUE_PER_TENANT": 2,
+    "CHAT_MAX_QUEUE_PER_IP": 6,
+    "CHAT_REQUESTS_PER_MINUTE": 12,
+    "CHAT_REQUEST_BURST": 4,
+    "CHAT_TOKENS_PER_MINUTE": 6000,
+    "CHAT_TOKEN_BURST": 4000,
+    "CHAT_IP_REQUESTS_PER_MINUTE": 120,
+    "CHAT_IP_REQUEST_BURST": 30,
+    "CHAT_IP_TOKENS_PER_MINUTE": 60000,
+    "CHAT_IP_TOKEN_BURST": 30000,
+}
+
+
+# ================== 各应用的加载方式 ==================
+def _prepare_environment(config):
+    """导入应用前设置多worker需要的环境变量（应用在导入时读取配置）"""
+    port = config["bind"].rsplit(":", 1)[-1]
+    os.environ.setdefault(
+        "WORKER_HEARTBEAT_DIR", os.path.join(tempfile.gettempdir(), f"rag-workers-{config['app']}-{port}")
+    )
+    if config["workers"] > 1:
+        _scale_worker_limits(config["workers"])
+    if config["app"] == "flask" and config["workers"] > 1:
+        # 会话历史在worker间共享，以SQLite为准
+        os.environ.setdefault("SESSION_DB_PATH", str(project_root / "backend" / "sessions.db"))
+        os.environ.setdefault("SESSION_SHARED", "1")
+
+
+def _scale_worker_limits(workers):
+    """
+    准入控制和限流状态在每个worker进程中各一份，N个worker时实际限额是设置值的N倍；
+    未设置的变量按worker数平分默认值（向上取整，至少为1）
+    """
+    scaled = {}
+    for name, default in PER_WORKER_LIMIT_DEFAULTS.items():
+        if name in os.environ:
+            continue
+        os.environ[name] = scaled[name] = str(max(math.ceil(default / workers), 1))
+    if scaled:
+        logger.info(f"{workers} 个worker各自排队和限流，每个worker的默认限额: {scaled}")
+
+
+def _load_flask(preload):
+    sys.path.insert(0, str(project_root / "backend"))
+    import app as module
+
+    if preload:
+        module.initialize_backend()
+        if module.system_components is None:
+            raise RuntimeError("系统初始化失败，详见日志")
+    return module, module.app
+
+
+def _load_fastapi(preload):
+    sys.path.insert(0, str(project_root / "api"))
+    import main as module
+
+    if preload:
+        module.qa_system = module.load_qa_system()
+    return module, module.app
+
+
+APP_LOADERS = {"flask": _load_flask, "fastapi": _load_fastapi}
+WORKER_CLASSES = {"flask": "gthread", "fastapi": "uvicorn.workers.UvicornWorker"}
+
+
+def _check_fork_safe():
+    """CUDA上下文在子进程中不可用，预加载了GPU模型时拒绝 fork"""
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        raise RuntimeError(
+            "主进程已初始化CUDA，fork 出的worker无法使用GPU模型。"
+            "请先启动 inference_server.py 并设置 INFERENCE_SERVER，或使用 --no-preload 且 --workers 1"
+        )
+
+
+# ================== gunicorn 钩子 ==================
+def make_hooks(config, state):
+    """state["module"] 为已导入的应用模块（backend/app.py 或 api/main.py）"""
+    from worker_health import WorkerHeartbeat, clear_heartbeats, worker_health_config
+
+    heartbeat_dir = os.environ["WORKER_HEARTBEAT_DIR"]
+
+    def when_ready(server):
+        clear_heartbeats(heartbeat_dir)
+        # 把预加载产生的对象移出GC跟踪，避免worker中的垃圾回收写入这些页面破坏写时复制
+        gc.collect()
+        gc.freeze()
+        server.log.info(
+            f"主进程就绪（{config['app']}，预加载={'是' if config['preload'] else '否'}），"
+            f"启动 {config['workers']} 个worker，心跳目录: {heartbeat_dir}"
+        )
+
+    def post_fork(server, worker):
+        module = state["module"]
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            # 各worker平分CPU核，避免算子线程数超额订阅
+            threads = config["torch_threads"] or max(1, (os.cpu_count() or 1) // max(config["workers"], 1))
+            torch.set_num_threads(threads)
+        if not config["preload"] and config["app"] == "flask":
+            module.start_background_initialization()
+        worker.heartbeat = WorkerHeartbeat(
+            heartbeat_dir,
+            status_fn=module.worker_status,
+            interval=worker_health_config["interval"],
+            stale_after=worker_health_config["stale_after"]
+        ).start()
+
+    def worker_exit(server, worker):
+        heartbeat = getattr(worker, "heartbeat", None)
+        if heartbeat is not None:
+            heartbeat.stop()
+
+    def child_exit(server, worker):
+        # worker异常退出时由主进程清理其心跳文件
+        try:
+            os.remove(os.path.join(heartbeat_dir, f"worker-{worker.pid}.json"))
+        except FileNotFoundError:
+            pass
+
+    def on_reload(server):
+        server.log.info("收到HUP，平滑重启worker（复用主进程中已加载的模型）")
+
+    def on_exit(server):
+        clear_heartbeats(heartbeat_dir)
+
+    return {
+        "when_ready": when_ready,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+        "child_exit": child_exit,
+        "on_reload": on_reload,
+        "on_exit": on_exit,
+    }
+
+
+def build_options(config, hooks):
+    options = {
+        "bind": config["bind"],
+        "workers": config["workers"],
+        "worker_class": WORKER_CLASSES[config["app"]],
+        "threads": config["threads"],
+        "timeout": config["timeout"],
+        "graceful_timeout": config["graceful_timeout"],
+        "keepalive": config["keepalive"],
+        "max_requests": config["max_requests"],
+        "max_requests_jitter": config["max_requests_jitter"],
+        "preload_app": config["preload"],
+        "proc_name": f"rag-{config['app']}",
+        "pidfile": config["pid_file"],
+        "accesslog": config["access_log"],
+        **hooks
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+
+def run(config):
+    from gunicorn.app.base import BaseApplication
+
+    state = {}
+
+    class RAGApplication(BaseApplication):
+        def load_config(self):
+            for key, value in build_options(config, make_hooks(config, state)).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # preload 时在主进程中调用一次；否则在每个worker中调用
+            if "module" not in state:
+                state["module"], state["app"] = APP_LOADERS[config["app"]](config["preload"])
+                if config["preload"]:
+                    _check_fork_safe()
+            return state["app"]
+
+    if not config["preload"]:
+        # 钩子需要应用模块，但不在主进程中加载模型
+        state["module"], state["app"] = APP_LOADERS[config["app"]](False)
+
+    RAGApplication().run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="公共艺术RAG系统生产环境多worker启动器")
+    parser.add_argument("--app", choices=sorted(APP_LOADERS), default=production_config["app"])
+    parser.add_argument("--bind", default=production_config["bind"])
+    parser.add_argument("--workers", type=int, default=production_config["workers"])
+    parser.add_argument("--threads", type=int, default=production_config["threads"])
+    parser.add_argument("--timeout", type=int, default=production_config["timeout"])
+    parser.add_argument("--max-requests", type=int, default=production_config["max_requests"])
+    parser.add_argument("--pid", dest="pid_file", default=production_config["pid_file"])
+    parser.add_argument("--no-preload", dest="preload", action="store_false", default=production_config["preload"],
+                        help="每个worker各自加载模型（GPU且未使用推理核心进程时只能用1个worker）")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    config = {**production_config, **vars(args)}
+    config["bind"] = config["bind"] or DEFAULT_BINDS[config["app"]]
+    _prepare_environment(config)
+    logger.info(f"启动配置: {config}")
+    run(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,12 @@
 
 import os
 import json
+import random
+import shutil
 import logging
+import argparse
 from pathlib import Path
+from datetime import datetime
 from langchain.embeddings import OllamaEmbeddings
 from langchain.vectorstores import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -17,6 +21,16 @@ from langchain.document_loaders import (
 )
 from langchain.schema import Document
 
+from metrics import StageTimer, write_textfile
+from index_manager import (
+    list_versions,
+    version_directory,
+    read_current_version,
+    write_current_version,
+    read_build_info,
+    write_build_info
+)
+
 # 设置日志
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -24,6 +38,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger('VectorDB_Builder')
 
+# 版本化构建：新索引写入 versions/<时间戳>，校验通过后才切换 CURRENT，旧索引构建期间照常服务
+build_config = {
+    # 保留的已校验版本数（含当前版本），用于回滚
+    "keep_versions": int(os.environ.get("RAG_INDEX_KEEP_VERSIONS", 3)),
+    # 新版本片段数低于当前版本的该比例时视为构建异常，不切换（--allow-shrink 跳过此项）
+    "min_count_ratio": float(os.environ.get("RAG_INDEX_MIN_COUNT_RATIO", 0.5)),
+    # 示例查询，每个都必须有检索结果
+    "sample_queries": ["公共艺术", "什么是公共艺术？", "城市雕塑"],
+    # 随机抽取片段，用其开头检索，片段本身应出现在前 self_check_k 个结果中
+    "self_check_samples": 5,
+    "self_check_k": 5,
+    "min_self_hit_rate": 0.8
+}
+
 def get_project_root():
     """获取项目根目录"""
     return Path(__file__).parent
@@ -168,8 +196,111 @@ def split_documents(documents, chunk_size=1000, chunk_overlap=200):
     
     return split_docs
 
-def build_vector_database():
-    """构建向量数据库"""
+def new_version_name(db_directory):
+    """以构建开始时间命名，按名称排序即按时间排序"""
+    version = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if os.path.exists(version_directory(db_directory, version)):
+        version += datetime.now().strftime("-%f")
+    return version
+
+def validated_versions(db_directory):
+    """校验通过（有构建信息）的版本，从旧到新"""
+    return [version for version in list_versions(db_directory) if read_build_info(db_directory, version)]
+
+def validate_index(vector_store, split_docs, previous_info=None, allow_shrink=False):
+    """
+    校验新建的索引，返回 (校验报告, 问题列表)，问题列表为空表示通过
+    
+    检查片段数与写入数一致、没有比当前版本异常减少、示例查询有结果、抽样片段能检索到自身
+    """
+    problems = []
+    doc_count = vector_store._collection.count()
+    if doc_count != len(split_docs):
+        problems.append(f"索引片段数 {doc_count} 与写入的 {len(split_docs)} 不一致")
+    if previous_info and not allow_shrink:
+        minimum = previous_info["doc_count"] * build_config["min_count_ratio"]
+        if doc_count < minimum:
+            problems.append(f"片段数 {doc_count} 低于当前版本 {previous_info['doc_count']} 的 "
+                            f"{build_config['min_count_ratio']:.0%}，知识库可能加载不完整")
+    
+    for query in build_config["sample_queries"]:
+        if not vector_store.similarity_search(query, k=1):
+            problems.append(f"示例查询没有结果: {query}")
+    
+    samples = random.Random(0).sample(split_docs, min(build_config["self_check_samples"], len(split_docs)))
+    hits = 0
+    for doc in samples:
+        results = vector_store.similarity_search(doc.page_content[:200], k=build_config["self_check_k"])
+        if any(result.page_content == doc.page_content for result in results):
+            hits += 1
+    self_hit_rate = hits / len(samples) if samples else 0.0
+    if self_hit_rate < build_config["min_self_hit_rate"]:
+        problems.append(f"抽样片段自检索命中率 {self_hit_rate:.0%} 低于 {build_config['min_self_hit_rate']:.0%}")
+    
+    report = {
+        "doc_count": doc_count,
+        "sample_queries": build_config["sample_queries"],
+        "self_hit_rate": self_hit_rate
+    }
+    return report, problems
+
+def prune_versions(db_directory, keep):
+    """
+    保留最近 keep 个已校验的版本，删除更早的版本和中断残留的构建目录
+    
+    当前版本始终保留；比当前版本新的未完成目录可能是正在进行的构建，不删除
+    """
+    current = read_current_version(db_directory)
+    kept = set(validated_versions(db_directory)[-max(keep, 1):])
+    kept.add(current)
+    removed = []
+    for version in list_versions(db_directory):
+        if version in kept:
+            continue
+        if current is not None and version > current and read_build_info(db_directory, version) is None:
+            continue
+        shutil.rmtree(version_directory(db_directory, version))
+        removed.append(version)
+    if removed:
+        logger.info(f"已删除旧的索引版本: {', '.join(removed)}")
+    return removed
+
+def rollback(db_directory, version=None):
+    """把 CURRENT 切回指定版本，默认切回当前版本之前的一个已校验版本"""
+    current = read_current_version(db_directory)
+    versions = validated_versions(db_directory)
+    if version is None:
+        older = [name for name in versions if current is None or name < current]
+        if not older:
+            logger.error(f"没有比当前版本 {current} 更早的可用版本")
+            return False
+        version = older[-1]
+    elif version not in versions:
+        logger.error(f"版本 {version} 不存在或未通过校验，可用版本: {', '.join(versions) or '无'}")
+        return False
+    
+    write_current_version(str(db_directory), version)
+    logger.info(f"CURRENT 已切换: {current} -> {version}")
+    logger.info("运行中的服务会在 RAG_INDEX_WATCH_INTERVAL 秒内自动加载，或调用 /api/admin/reload-index 立即切换")
+    return True
+
+def print_versions(db_directory):
+    current = read_current_version(db_directory)
+    versions = list_versions(db_directory)
+    if not versions:
+        logger.info("没有版本化的索引")
+        return
+    for version in versions:
+        info = read_build_info(db_directory, version)
+        marker = "*" if version == current else " "
+        if info is None:
+            logger.info(f"{marker} {version}  未完成或未通过校验")
+        else:
+            logger.info(f"{marker} {version}  {info['doc_count']} 个片段，"
+                        f"自检索命中率 {info['self_hit_rate']:.0%}，构建于 {info['built_at']}")
+
+def build_vector_database(keep_versions=None, allow_shrink=False):
+    """构建新版本的向量数据库，校验通过后切换为当前版本"""
     project_root = get_project_root()
     
     # 知识库目录
@@ -183,19 +314,45 @@ def build_vector_database():
     logger.info(f"问答对目录: {qa_directory}")
     logger.info(f"文本资料目录: {text_directory}")
     logger.info(f"数据库目录: {db_directory}")
-    
-    # 1. 删除旧的数据库
-    if db_directory.exists():
-        logger.info("删除旧的向量数据库...")
-        import shutil
-        shutil.rmtree(db_directory)
+    version = new_version_name(db_directory)
+    build_directory = Path(version_directory(db_directory, version))
+    logger.info(f"新版本目录: {build_directory}（当前版本: {read_current_version(db_directory) or '无'}）")
+    timer = StageTimer("ingest")
+    succeeded = False
+    try:
+        succeeded = _build_vector_database(
+            timer, qa_directory, text_directory, db_directory, version, build_directory, allow_shrink
+        )
+        if succeeded:
+            keep = build_config["keep_versions"] if keep_versions is None else keep_versions
+            prune_versions(db_directory, keep)
+        return succeeded
+    finally:
+        if not succeeded and build_directory.exists():
+            logger.info(f"删除未通过的构建目录 {build_directory}，当前版本不变")
+            shutil.rmtree(build_directory)
+        logger.info("各阶段耗时: " + "，".join(f"{name} {seconds:.2f}s" for name, seconds in timer.timings.items()))
+        textfile = write_textfile()
+        if textfile:
+            logger.info(f"指标已写入 {textfile}")
+
+def _build_vector_database(timer, qa_directory, text_directory, db_directory, version, build_directory,
+                           allow_shrink=False):
+    """按阶段计时执行构建流程"""
+    # 1. 旧索引保留在原处继续服务，新索引写入新的版本目录
+    current = read_current_version(db_directory)
+    if current is None and db_directory.exists() and set(os.listdir(db_directory)) - {"versions"}:
+        logger.info("检测到旧布局的索引，新版本切换成功后可手动删除根目录下 versions 以外的旧文件")
+    build_directory.mkdir(parents=True)
     
     # 2. 加载文档
     logger.info("加载问答对文档...")
-    qa_documents = load_json_qa_files(qa_directory)
+    with timer.stage("load_qa"):
+        qa_documents = load_json_qa_files(qa_directory)
     
     logger.info("加载文本资料文档...")
-    text_documents = load_documents_from_directory(text_directory)
+    with timer.stage("load_text"):
+        text_documents = load_documents_from_directory(text_directory)
     
     all_documents = qa_documents + text_documents
     logger.info(f"总共加载了 {len(all_documents)} 个文档")
@@ -205,7 +362,8 @@ def build_vector_database():
         return False
     
     # 3. 分割文档
-    split_docs = split_documents(all_documents)
+    with timer.stage("split"):
+        split_docs = split_documents(all_documents)
     
     # 4. 初始化嵌入模型
     logger.info("初始化嵌入模型...")
@@ -220,28 +378,73 @@ def build_vector_database():
     # 5. 创建向量数据库
     logger.info("创建向量数据库...")
     try:
-        vector_store = Chroma.from_documents(
-            documents=split_docs,
-            embedding=embeddings,
-            persist_directory=str(db_directory),
-            collection_name="academic_papers_deepseek_1.5b"
-        )
+        # 嵌入计算在 from_documents 内完成，embed_index 即嵌入+写入索引的耗时
+        with timer.stage("embed_index"):
+            vector_store = Chroma.from_documents(
+                documents=split_docs,
+                embedding=embeddings,
+                persist_directory=str(build_directory),
+                collection_name="academic_papers_deepseek_1.5b"
+            )
         
         # 持久化数据库
-        vector_store.persist()
+        with timer.stage("persist"):
+            vector_store.persist()
         
         # 获取文档数量
         doc_count = vector_store._collection.count()
         logger.info(f"向量数据库创建成功！包含 {doc_count} 个文档片段")
         
-        return True
-        
     except Exception as e:
         logger.error(f"创建向量数据库失败: {e}")
         return False
+    
+    # 6. 校验新版本
+    logger.info("校验新版本索引...")
+    previous_info = read_build_info(db_directory, current) if current else None
+    try:
+        with timer.stage("validate"):
+            report, problems = validate_index(vector_store, split_docs, previous_info, allow_shrink)
+    except Exception as e:
+        logger.error(f"校验向量数据库失败: {e}")
+        return False
+    if problems:
+        for problem in problems:
+            logger.error(f"校验未通过: {problem}")
+        return False
+    logger.info(f"校验通过: {report['doc_count']} 个片段，抽样自检索命中率 {report['self_hit_rate']:.0%}")
+    
+    # 7. 记录构建信息后原子切换 CURRENT
+    write_build_info(str(db_directory), version, {
+        "version": version,
+        "built_at": datetime.now().isoformat(),
+        "source_documents": len(all_documents),
+        **report
+    })
+    write_current_version(str(db_directory), version)
+    logger.info(f"CURRENT 已切换: {current or '无'} -> {version}")
+    return True
 
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description="公共艺术RAG系统 - 向量数据库重建工具")
+    parser.add_argument("--rollback", nargs="?", const="", metavar="VERSION",
+                        help="不重建，把 CURRENT 切回指定版本（省略版本名时切回上一个版本）")
+    parser.add_argument("--list", action="store_true", help="列出已有的索引版本")
+    parser.add_argument("--keep", type=int, default=None,
+                        help=f"保留的版本数（默认 RAG_INDEX_KEEP_VERSIONS={build_config['keep_versions']}）")
+    parser.add_argument("--allow-shrink", action="store_true",
+                        help="允许新版本片段数明显少于当前版本（如有意删减了知识库）")
+    args = parser.parse_args()
+    db_directory = get_project_root() / "chroma_db_deepseek_1.5b"
+    
+    if args.list:
+        print_versions(db_directory)
+        return
+    if args.rollback is not None:
+        rollback(db_directory, args.rollback or None)
+        return
+    
     logger.info("=" * 60)
     logger.info("公共艺术RAG系统 - 向量数据库重建工具")
     logger.info("=" * 60)
@@ -260,15 +463,15 @@ def main():
         return
     
     # 构建数据库
-    success = build_vector_database()
+    success = build_vector_database(keep_versions=args.keep, allow_shrink=args.allow_shrink)
     
     if success:
         logger.info("=" * 60)
         logger.info("✅ 向量数据库重建完成！")
-        logger.info("现在可以启动后端服务了")
+        logger.info("运行中的服务会自动切换到新版本；未运行时现在可以启动后端服务了")
         logger.info("=" * 60)
     else:
-        logger.error("❌ 向量数据库重建失败")
+        logger.error("❌ 向量数据库重建失败，当前索引未受影响")
         logger.error("请检查错误信息并重试")
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+进程内采样分析器
+
+按固定间隔用 sys._current_frames() 采集所有线程的Python调用栈，输出折叠栈
+（collapsed stack）格式，每行 "线程;帧1;帧2;... 次数"，可直接交给 flamegraph.pl
+或 speedscope 生成火焰图。只在采样期间运行一个后台线程，空闲时没有开销。
+"""
+
+import sys
+import time
+import threading
+from collections import Counter
+
+# 单次采样的时长和频率上限，防止误操作拖慢生产进程
+MAX_DURATION = 60.0
+MIN_INTERVAL = 0.001
+
+
+class ProfilerBusyError(RuntimeError):
+    """已有采样在进行"""
+
+
+class SamplingProfiler:
+    """
+    定时采样所有线程的调用栈
+
+    用法:
+        profiler = SamplingProfiler()
+        collapsed = profiler.profile(duration=10, interval=0.005)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        filename = code.co_filename.replace("\\", "/").rsplit("/", 1)[-1]
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+    def _collapse(self, frame, thread_name):
+        labels = []
+        while frame is not None:
+            labels.append(self._frame_label(frame))
+            frame = frame.f_back
+        labels.append(thread_name)
+        labels.reverse()
+        # 折叠栈格式用 ";" 分隔帧，帧名中不能出现
+        return ";".join(label.replace(";", ":") for label in labels)
+
+    def _sample(self, stacks, exclude):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident in exclude:
+                continue
+            stacks[self._collapse(frame, names.get(ident, f"thread-{ident}"))] += 1
+
+    def profile(self, duration=10.0, interval=0.005):
+        """
+        采样 duration 秒，返回 (折叠栈文本, 统计信息)
+
+        调用线程和采样线程本身不计入。已有采样在进行时抛出 ProfilerBusyError。
+        """
+        duration = min(max(float(duration), 0.0), MAX_DURATION)
+        interval = max(float(interval), MIN_INTERVAL)
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("已有采样正在进行")
+
+        try:
+            stacks = Counter()
+            samples = [0]
+            caller = threading.get_ident()
+
+            def run():
+                exclude = {caller, threading.get_ident()}
+                deadline = time.perf_counter() + duration
+                next_tick = time.perf_counter()
+                while next_tick < deadline:
+                    self._sample(stacks, exclude)
+                    samples[0] += 1
+                    next_tick += interval
+                    delay = next_tick - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+            start = time.perf_counter()
+            sampler = threading.Thread(target=run, name="sampling-profiler", daemon=True)
+            sampler.start()
+            sampler.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            self._lock.release()
+
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+        return collapsed + "\n", {
+            "duration_seconds": elapsed,
+            "interval_seconds": interval,
+            "samples": samples[0],
+            "unique_stacks": len(stacks)
+        }
+
+
+profiler = SamplingProfiler()
@@ -7,9 +7,15 @@ from langchain.llms import Ollama
 from langchain.prompts import PromptTemplate
 from pathlib import Path
 import os
+import sys
 import subprocess
 from tqdm import tqdm
 
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_manager import resolve_index_directory
+
 # PDF文件目录
 pdf_directory = r"knowledge_base\相关文本资料汇总"
 
@@ -43,7 +49,8 @@ for model in [embedding_model_name, llm_model_name]:
         exit(1)
 
 # 加载文档并创建向量数据库（如果不存在）
-db_directory = r"chroma_db_deepseek_1.5b"
+# rebuild_vector_db.py 生成的版本化索引由 CURRENT 指向，旧布局时为根目录本身
+_, db_directory = resolve_index_directory(r"chroma_db_deepseek_1.5b")
 collection_name = "academic_papers_deepseek_1.5b"
 
 # 检查数据库是否存在
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线批量问答
+
+从JSONL读取问题（每行一个对象，问题取 question/message/instruction 字段，或 title/body
+拼成的工单式问题；编号取 id/request_id 字段，缺省为行号；编号重复的行只回答第一条），按批执行：
+    1. 整批问题一次向量化（embed_documents）
+    2. 整批向量一次检索（Chroma 支持多查询向量的单次查询）
+    3. 左侧填充后整批生成，每条序列遇到对话标记单独结束
+每批完成后把结果追加写入输出JSONL并落盘；中断后用同样的命令重新运行，会跳过
+输出文件中已有的编号，从中断处继续。
+
+--compare N 时取前N个问题分别用逐条调用 generate_response 和批量方式回答（结果不写入
+输出文件），报告两者的问题/秒、token/秒和加速比。
+
+用法:
+    python scripts/batch_qa.py questions.jsonl --output answers.jsonl --batch-size 4
+    python scripts/batch_qa.py questions.jsonl --output answers.jsonl --compare 16
+    RAG_FAKE_BACKEND=1 python scripts/batch_qa.py questions.jsonl --output /tmp/answers.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+from types import SimpleNamespace
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qa_corpus import record_question
+
+# 批量问答没有对话历史
+EMPTY_HISTORY = "这是对话的开始。\n"
+
+
+# ================== 输入输出 ==================
+def load_requests(path):
+    """
+    读取问题，返回 [{"id": ..., "question": ...}, ...]
+
+    编号重复的行只保留第一条（输出文件按编号续跑，重复编号会被回答两次）；
+    一条问题都没读到时抛出 ValueError，而不是静默地什么都不做。
+    """
+    requests = []
+    seen = set()
+    skipped = duplicated = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            question = record_question(record)
+            if not question:
+                print(f"第 {line_number} 行没有问题字段（question/message/instruction 或 title/body），已跳过")
+                skipped += 1
+                continue
+            request_id = str(record.get("id") or record.get("request_id") or f"line-{line_number}")
+            if request_id in seen:
+                print(f"第 {line_number} 行的编号 {request_id} 与前面重复，已跳过")
+                duplicated += 1
+                continue
+            seen.add(request_id)
+            requests.append({"id": request_id, "question": question})
+    if not requests:
+        raise ValueError(
+            f"{path} 中没有可用的问题（{skipped} 行缺少 question/message/instruction 或 title/body 字段）"
+        )
+    if duplicated:
+        print(f"共跳过 {duplicated} 条重复编号")
+    return requests
+
+
+def load_completed_ids(path):
+    """
+    读取输出文件中已完成的编号
+
+    上次运行在写入中途被中断时，末尾可能有半行，截掉后再继续追加
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb") as f:
+        data = f.read()
+    complete = data[:data.rfind(b"\n") + 1]
+    if len(complete) != len(data):
+        print(f"输出文件末尾有 {len(data) - len(complete)} 字节不完整的记录，已截断")
+        with open(path, "r+b") as f:
+            f.truncate(len(complete))
+    completed = set()
+    for line in complete.decode("utf-8").splitlines():
+        if line.strip():
+            completed.add(str(json.loads(line)["id"]))
+    return completed
+
+
+def append_results(path, records):
+    """追加一批结果并落盘"""
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# ================== 批量检索与生成 ==================
+def retrieve_batch(components, query_vectors):
+    """整批查询向量检索，返回与输入对应的文档列表"""
+    retriever = components["retriever"]
+    vector_store = retriever.vectorstore
+    k = retriever.search_kwargs["k"]
+    collection = getattr(vector_store, "_collection", None)
+    if collection is None:
+        return [vector_store.similarity_search_by_vector(vector, k=k) for vector in query_vectors]
+
+    result = collection.query(
+        query_embeddings=[list(vector) for vector in query_vectors],
+        n_results=k,
+        include=["documents", "metadatas"]
+    )
+    return [
+        [SimpleNamespace(page_content=text, metadata=meta or {}) for text, meta in zip(texts, metadatas)]
+        for texts, metadatas in zip(result["documents"], result["metadatas"])
+    ]
+
+
+def build_input_text(core, components, docs, question):
+    prompt = components["prompt_template"].format(
+        context=core.format_context(docs),
+        history=EMPTY_HISTORY,
+        question=question
+    )
+    return f"[|im_start|]user\n{prompt}\n[|im_end|]\n[|im_start|]assistant\n"
+
+
+def answer_batch(core, components, batch):
+    """回答一批问题，返回 (结果记录列表, 本批统计)"""
+    questions = [item["question"] for item in batch]
+    timings = {}
+
+    start = time.perf_counter()
+    query_vectors = components["embeddings"].embed_documents(questions)
+    timings["embed"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    docs_per_question = retrieve_batch(components, query_vectors)
+    timings["search"] = time.perf_counter() - start
+
+    input_texts = [
+        build_input_text(core, components, docs, question)
+        for docs, question in zip(docs_per_question, questions)
+    ]
+    start = time.perf_counter()
+    responses, stats = core.generate_text_batch(components, input_texts, **core.generation_config)
+    timings["generate"] = time.perf_counter() - start
+
+    records = []
+    for i, (item, docs, response) in enumerate(zip(batch, docs_per_question, responses)):
+        records.append({
+            "id": item["id"],
+            "question": item["question"],
+            "answer": response,
+            "sources": [os.path.basename(doc.metadata.get("source", "")) for doc in docs],
+            "prompt_tokens": stats["prompt_tokens"][i],
+            "completion_tokens": stats["completion_tokens"][i],
+        })
+    return records, {
+        "questions": len(batch),
+        "completion_tokens": sum(stats["completion_tokens"]),
+        "padded_prompt_tokens": stats["padded_prompt_tokens"],
+        "seconds": sum(timings.values()),
+        "stage_seconds": timings,
+    }
+
+
+def run_batches(core, components, requests, batch_size, output=None):
+    """按批回答，output 不为空时每批写入；返回汇总统计"""
+    totals = {"questions": 0, "completion_tokens": 0, "seconds": 0.0,
+              "stage_seconds": {"embed": 0.0, "search": 0.0, "generate": 0.0}}
+    for start in range(0, len(requests), batch_size):
+        batch = requests[start:start + batch_size]
+        records, stats = answer_batch(core, components, batch)
+        if output:
+            append_results(output, records)
+        totals["questions"] += stats["questions"]
+        totals["completion_tokens"] += stats["completion_tokens"]
+        totals["seconds"] += stats["seconds"]
+        for stage, seconds in stats["stage_seconds"].items():
+            totals["stage_seconds"][stage] += seconds
+        print(
+            f"[{start + len(batch)}/{len(requests)}] 批大小 {len(batch)}，{stats['seconds']:.2f}s，"
+            f"{stats['completion_tokens'] / stats['seconds']:.1f} tokens/s"
+        )
+    return totals
+
+
+def run_sequential(core, components, requests):
+    """逐条调用 generate_response 作为对照"""
+    totals = {"questions": 0, "completion_tokens": 0, "seconds": 0.0}
+    for item in requests:
+        stats = {}
+        start = time.perf_counter()
+        core.generate_response(components, [{"role": "user", "content": item["question"]}],
+                               item["question"], generation_stats=stats)
+        totals["seconds"] += time.perf_counter() - start
+        totals["questions"] += 1
+        totals["completion_tokens"] += stats.get("completion_tokens", 0)
+    return totals
+
+
+def throughput(totals):
+    seconds = totals["seconds"] or float("inf")
+    return totals["questions"] / seconds, totals["completion_tokens"] / seconds
+
+
+def print_throughput(name, totals):
+    questions_per_sec, tokens_per_sec = throughput(totals)
+    print(
+        f"{name:<10}{totals['questions']:>8}{totals['seconds']:>12.2f}"
+        f"{questions_per_sec:>12.3f}{tokens_per_sec:>14.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量问答")
+    parser.add_argument("input", help="问题JSONL文件")
+    parser.add_argument("--output", required=True, help="结果JSONL文件，已存在时从中断处继续")
+    parser.add_argument("--batch-size", type=int, default=4, help="每批问题数（受显存限制）")
+    parser.add_argument("--limit", type=int, default=0, help="最多回答的问题数，0 表示全部")
+    parser.add_argument("--compare", type=int, default=0,
+                        help="取前N个问题对比逐条与批量的吞吐，结果不写入输出文件")
+    args = parser.parse_args()
+
+    try:
+        requests = load_requests(args.input)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.limit:
+        requests = requests[:args.limit]
+    completed = load_completed_ids(args.output)
+    pending = [item for item in requests if item["id"] not in completed]
+    print(f"问题: {len(requests)}，已完成: {len(requests) - len(pending)}，待回答: {len(pending)}")
+
+    core = importlib.import_module("调用代码")
+    components = core.initialize_system()
+
+    if args.compare:
+        sample = requests[:args.compare]
+        print(f"\n对比逐条与批量（{len(sample)} 个问题，批大小 {args.batch_size}）...")
+        sequential = run_sequential(core, components, sample)
+        batched = run_batches(core, components, sample, args.batch_size)
+        print("\n" + "=" * 56)
+        print(f"{'方式':<10}{'问题数':>8}{'耗时(s)':>12}{'问题/s':>12}{'tokens/s':>14}")
+        print("-" * 56)
+        print_throughput("逐条", sequential)
+        print_throughput("批量", batched)
+        print(f"\n加速比: {throughput(batched)[0] / max(throughput(sequential)[0], 1e-9):.2f}x")
+        print("=" * 56 + "\n")
+
+    if not pending:
+        print("没有待回答的问题")
+        return 0
+
+    totals = run_batches(core, components, pending, args.batch_size, output=args.output)
+    questions_per_sec, tokens_per_sec = throughput(totals)
+    stages = "，".join(f"{stage} {seconds:.1f}s" for stage, seconds in totals["stage_seconds"].items())
+    print(f"\n完成 {totals['questions']} 个问题，耗时 {totals['seconds']:.1f}s（{stages}）")
+    print(f"吞吐: {questions_per_sec:.3f} 问题/s，{tokens_per_sec:.1f} tokens/s")
+    print(f"结果已写入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
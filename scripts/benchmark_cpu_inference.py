@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CPU推理基准测试
+
+在同一组提示上比较原有加载方式（device_map="auto" + bf16）与CPU优化模式
+（动态int8量化，可选torch.compile）的生成速度(tokens/sec)和峰值内存。
+每种模式在独立子进程中运行，保证内存统计互不干扰。
+
+用法:
+    python scripts/benchmark_cpu_inference.py
+    python scripts/benchmark_cpu_inference.py --modes baseline cpu_int8 --max-new-tokens 64
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# 添加项目根目录到Python路径
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_root)
+
+# 各模式对应的环境变量（调用代码.py 在导入时读取）
+BENCH_MODES = {
+    "baseline": {"RAG_INFERENCE_DEVICE": "auto"},
+    "cpu_int8": {"RAG_INFERENCE_DEVICE": "cpu", "RAG_CPU_INT8": "1", "RAG_CPU_COMPILE": "0"},
+    "cpu_int8_compile": {"RAG_INFERENCE_DEVICE": "cpu", "RAG_CPU_INT8": "1", "RAG_CPU_COMPILE": "1"},
+}
+
+BENCH_PROMPTS = [
+    "什么是公共艺术？",
+    "公共艺术如何塑造城市形象？",
+    "如何评价当代公共艺术中的社区参与式创作？",
+    "乡村公共艺术有哪些典型实践？",
+]
+
+def run_worker(max_new_tokens):
+    """子进程：加载模型并在固定提示上生成，输出JSON结果"""
+    import torch
+    import 调用代码 as core
+    from cpu_inference import peak_memory_mb
+
+    model, tokenizer, load_timings = core.load_chat_model()
+
+    total_tokens = 0
+    total_seconds = 0.0
+    for i, question in enumerate(BENCH_PROMPTS):
+        input_text = f"[|im_start|]user\n{question}\n[|im_end|]\n[|im_start|]assistant\n"
+        inputs = tokenizer(input_text, return_tensors="pt")
+        input_ids = inputs.input_ids.to(model.device)
+        attention_mask = inputs.attention_mask.to(model.device)
+
+        # 固定生成长度并关闭采样，保证各模式计算量一致
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs = model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id
+            )
+        elapsed = time.perf_counter() - start
+
+        # 第一条提示用于预热（含编译开销），不计入统计
+        if i == 0:
+            continue
+        total_tokens += outputs.shape[1] - input_ids.shape[1]
+        total_seconds += elapsed
+
+    result = {
+        "device": str(model.device),
+        "load_seconds": load_timings.get("total", 0.0),
+        "tokens": total_tokens,
+        "seconds": total_seconds,
+        "tokens_per_sec": total_tokens / total_seconds if total_seconds else 0.0,
+        "peak_memory_mb": peak_memory_mb()
+    }
+    print("BENCH_RESULT " + json.dumps(result))
+
+def run_mode(mode, max_new_tokens):
+    """在子进程中运行指定模式"""
+    env = dict(os.environ, **BENCH_MODES[mode])
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", "--max-new-tokens", str(max_new_tokens)],
+        env=env,
+        capture_output=True,
+        text=True,
+        encoding="utf-8"
+    )
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH_RESULT "):
+            return json.loads(line[len("BENCH_RESULT "):])
+    print(f"❌ 模式 {mode} 运行失败:\n{proc.stderr[-2000:]}")
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU推理基准测试")
+    parser.add_argument("--modes", nargs="+", default=list(BENCH_MODES), choices=list(BENCH_MODES))
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.max_new_tokens)
+        return
+
+    results = {}
+    for mode in args.modes:
+        print(f"⏳ 运行模式: {mode}")
+        result = run_mode(mode, args.max_new_tokens)
+        if result:
+            results[mode] = result
+
+    print("\n" + "=" * 72)
+    print(f"{'模式':<20}{'设备':<10}{'加载(s)':>10}{'tokens/s':>12}{'峰值内存(MB)':>16}")
+    print("-" * 72)
+    for mode, r in results.items():
+        print(f"{mode:<20}{r['device']:<10}{r['load_seconds']:>10.1f}"
+              f"{r['tokens_per_sec']:>12.2f}{r['peak_memory_mb']:>16.0f}")
+
+    baseline = results.get("baseline")
+    if baseline and baseline["tokens_per_sec"]:
+        print("-" * 72)
+        for mode, r in results.items():
+            if mode == "baseline":
+                continue
+            speedup = r["tokens_per_sec"] / baseline["tokens_per_sec"]
+            memory_ratio = r["peak_memory_mb"] / baseline["peak_memory_mb"] if baseline["peak_memory_mb"] else 0
+            print(f"{mode}: 速度 {speedup:.2f}x，内存 {memory_ratio:.2f}x（相对baseline）")
+
+if __name__ == "__main__":
+    main()
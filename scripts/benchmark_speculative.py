@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+投机解码基准测试
+
+比较常规贪婪解码与草稿模型投机解码的速度，并统计草稿token接受率。
+--tiny 模式使用随机初始化的小型Qwen2模型，可在无权重、无GPU的环境离线运行。
+
+用法:
+    python scripts/benchmark_speculative.py --tiny
+    python scripts/benchmark_speculative.py --target models/Qwen3-8B-merged --draft models/Qwen3-0.6B
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from speculative_decoding import SpeculativeMonitor, configure_lookahead, build_tiny_models
+
+BENCH_PROMPTS = [
+    "什么是公共艺术？",
+    "公共艺术如何塑造城市形象？",
+    "乡村公共艺术有哪些典型实践？",
+]
+
+def load_models(args):
+    """加载目标/草稿模型，返回 (target, draft, 输入序列列表)"""
+    if args.tiny:
+        target, draft = build_tiny_models()
+        generator = torch.Generator().manual_seed(0)
+        prompts = [
+            torch.randint(0, target.config.vocab_size, (1, 32), generator=generator)
+            for _ in BENCH_PROMPTS
+        ]
+        return target, draft, prompts
+
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    tokenizer = AutoTokenizer.from_pretrained(args.target, trust_remote_code=True, use_fast=False)
+    target = AutoModelForCausalLM.from_pretrained(
+        args.target, trust_remote_code=True, torch_dtype=dtype, low_cpu_mem_usage=True
+    ).to(device).eval()
+    draft = AutoModelForCausalLM.from_pretrained(
+        args.draft, trust_remote_code=True, torch_dtype=dtype, low_cpu_mem_usage=True
+    ).to(device).eval()
+    prompts = [
+        tokenizer(f"[|im_start|]user\n{q}\n[|im_end|]\n[|im_start|]assistant\n", return_tensors="pt").input_ids.to(device)
+        for q in BENCH_PROMPTS
+    ]
+    return target, draft, prompts
+
+def timed_generate(model, input_ids, max_new_tokens, **kwargs):
+    """固定长度贪婪生成，返回 (生成token数, 耗时)"""
+    start = time.perf_counter()
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+            **kwargs
+        )
+    return outputs.shape[1] - input_ids.shape[1], time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="投机解码基准测试")
+    parser.add_argument("--tiny", action="store_true", help="使用随机初始化的小模型离线测试")
+    parser.add_argument("--target", default="models/Qwen3-8B-merged")
+    parser.add_argument("--draft", default="models/Qwen3-0.6B")
+    parser.add_argument("--lookahead", type=int, nargs="+", default=[3, 5, 8], help="每轮草稿token数")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    target, draft, prompts = load_models(args)
+
+    # 预热
+    timed_generate(target, prompts[0], 4)
+
+    baseline_tokens, baseline_seconds = 0, 0.0
+    for input_ids in prompts:
+        tokens, seconds = timed_generate(target, input_ids, args.max_new_tokens)
+        baseline_tokens += tokens
+        baseline_seconds += seconds
+    baseline_tps = baseline_tokens / baseline_seconds
+    print(f"常规解码: {baseline_tps:.2f} tokens/s")
+
+    print("\n" + "=" * 72)
+    print(f"{'lookahead':>10}{'接受率':>10}{'tokens/目标前向':>18}{'tokens/s':>12}{'实测加速':>12}")
+    print("-" * 72)
+    for lookahead in args.lookahead:
+        configure_lookahead(draft, lookahead)
+        tokens_total, seconds_total = 0, 0.0
+        draft_total, accepted_total, steps_total = 0, 0, 0
+        for input_ids in prompts:
+            with SpeculativeMonitor(target, draft) as monitor:
+                tokens, seconds = timed_generate(target, input_ids, args.max_new_tokens, assistant_model=draft)
+            report = monitor.report(tokens)
+            tokens_total += tokens
+            seconds_total += seconds
+            draft_total += report["draft_tokens"]
+            accepted_total += report["accepted_tokens"]
+            steps_total += report["target_steps"]
+
+        acceptance = accepted_total / draft_total if draft_total else 0.0
+        per_step = tokens_total / steps_total if steps_total else 0.0
+        tps = tokens_total / seconds_total
+        print(f"{lookahead:>10}{acceptance:>10.1%}{per_step:>18.2f}{tps:>12.2f}{tps / baseline_tps:>11.2f}x")
+
+if __name__ == "__main__":
+    main()
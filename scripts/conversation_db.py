@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多轮对话历史存储（SQLite）
+
+每轮问答单独一行追加写入，会话元信息（创建/更新时间、轮数）单独一张小表，
+单轮写入代价与对话长度无关。数据库使用WAL模式，每个线程复用一个连接；
+写操作默认进入队列由后台线程批量提交，读取前先落盘待写数据。历史支持分页读取。
+
+HybridQA（api/main.py）通过 get_conversation_history / delete_conversation 使用本模块；
+自带其他历史存储的问答系统由 attach_conversation_db 包一层，每轮问答同时记入本库。
+"""
+
+import os
+import time
+import inspect
+import queue
+import sqlite3
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.environ.get("CONVERSATION_DB_PATH", "conversations.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    session_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    turn_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS conversation_turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    turn_index INTEGER NOT NULL,
+    user_query TEXT NOT NULL,
+    bot_response TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_turns_session ON conversation_turns(session_id, turn_index);
+"""
+
+
+@dataclass
+class ConversationHistory:
+    """一个会话的（一页）历史，user_queries 与 bot_responses 按时间顺序一一对应"""
+    session_id: str
+    user_queries: List[str] = field(default_factory=list)
+    bot_responses: List[str] = field(default_factory=list)
+    created_at: datetime = field(default_factory=datetime.now)
+    updated_at: datetime = field(default_factory=datetime.now)
+    total_turns: int = 0
+
+
+class ConversationDB:
+    """
+    对话历史数据库
+
+    write_behind=True 时 add_turn 只入队，由后台线程每 flush_interval 秒批量提交；
+    False 时同步写入。
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, write_behind=True, flush_interval=0.5):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+        self.write_behind = write_behind
+        self._flush_interval = flush_interval
+        self._pending = queue.Queue()
+        # 保证后台线程和 flush() 按入队顺序提交
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._writer = None
+        if write_behind:
+            self._start_writer()
+        # 多进程部署时 fork 出的子进程不能沿用父进程的连接、锁和写线程
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reinit_after_fork)
+
+    def _start_writer(self):
+        self._writer = threading.Thread(target=self._write_loop, name="conversation-db-writer", daemon=True)
+        self._writer.start()
+
+    def _reinit_after_fork(self):
+        """在子进程中重建连接、锁和写线程；父进程中待写的数据由父进程负责提交"""
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._pending = queue.Queue()
+        self._write_lock = threading.Lock()
+        closed = self._closed.is_set()
+        self._closed = threading.Event()
+        self._writer = None
+        if closed:
+            self._closed.set()
+        elif self.write_behind:
+            self._start_writer()
+
+    # ---------- 连接 ----------
+    def _connection(self):
+        """当前线程复用的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    # ---------- 写入 ----------
+    def add_turn(self, session_id, user_query, bot_response):
+        """追加一轮问答"""
+        op = ("append", session_id, user_query, bot_response, time.time())
+        if self.write_behind:
+            self._pending.put(op)
+        else:
+            with self._write_lock:
+                self._apply(self._connection(), [op])
+
+    def delete_conversation(self, session_id):
+        """删除会话及其全部历史"""
+        with self._write_lock:
+            ops = self._drain() + [("delete", session_id, None, None, None)]
+            self._apply(self._connection(), ops)
+
+    def _apply(self, conn, ops):
+        """在一个事务中按顺序执行写操作"""
+        with conn:
+            for op, session_id, user_query, bot_response, created_at in ops:
+                if op == "append":
+                    conn.execute(
+                        "INSERT INTO conversations (session_id, created_at, updated_at, turn_count) "
+                        "VALUES (?, ?, ?, 0) ON CONFLICT(session_id) DO NOTHING",
+                        (session_id, created_at, created_at)
+                    )
+                    (turn_index,) = conn.execute(
+                        "SELECT turn_count FROM conversations WHERE session_id = ?", (session_id,)
+                    ).fetchone()
+                    conn.execute(
+                        "INSERT INTO conversation_turns (session_id, turn_index, user_query, bot_response, created_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (session_id, turn_index, user_query, bot_response, created_at)
+                    )
+                    conn.execute(
+                        "UPDATE conversations SET turn_count = turn_count + 1, updated_at = ? WHERE session_id = ?",
+                        (created_at, session_id)
+                    )
+                elif op == "delete":
+                    conn.execute("DELETE FROM conversation_turns WHERE session_id = ?", (session_id,))
+                    conn.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+
+    def _drain(self):
+        ops = []
+        while True:
+            try:
+                ops.append(self._pending.get_nowait())
+            except queue.Empty:
+                return ops
+
+    def flush(self):
+        """立即提交所有待写操作"""
+        with self._write_lock:
+            ops = self._drain()
+            if ops:
+                self._apply(self._connection(), ops)
+
+    def _write_loop(self):
+        while not self._closed.wait(self._flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"写入对话历史失败: {e}")
+
+    # ---------- 读取 ----------
+    def get_conversation_history(self, session_id, limit=None, offset=0):
+        """
+        读取会话历史
+
+        limit/offset 按轮分页：offset 为从最新一轮往前跳过的轮数，
+        返回的一页按时间顺序排列；limit 为 None 时返回全部。
+        """
+        self.flush()
+        conn = self._connection()
+        meta = conn.execute(
+            "SELECT created_at, updated_at, turn_count FROM conversations WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+        if meta is None:
+            return ConversationHistory(session_id=session_id)
+
+        created_at, updated_at, turn_count = meta
+        end = max(turn_count - offset, 0)
+        start = 0 if limit is None else max(end - limit, 0)
+        rows = conn.execute(
+            "SELECT user_query, bot_response FROM conversation_turns "
+            "WHERE session_id = ? AND turn_index >= ? AND turn_index < ? ORDER BY turn_index",
+            (session_id, start, end)
+        ).fetchall()
+        return ConversationHistory(
+            session_id=session_id,
+            user_queries=[row[0] for row in rows],
+            bot_responses=[row[1] for row in rows],
+            created_at=datetime.fromtimestamp(created_at),
+            updated_at=datetime.fromtimestamp(updated_at),
+            total_turns=turn_count
+        )
+
+    def get_recent_turns(self, session_id, n):
+        """最近 n 轮问答，[(问题, 回答), ...]，用于构建提示词"""
+        history = self.get_conversation_history(session_id, limit=n)
+        return list(zip(history.user_queries, history.bot_responses))
+
+    def close(self):
+        """停止后台写线程，提交剩余数据并关闭所有连接"""
+        self._closed.set()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class RecordingQA:
+    """
+    包装一个问答系统，把每轮问答同时记入 ConversationDB
+
+    被包装的系统仍用自己的历史构建提示词；历史的分页读取走 self.db，
+    删除会话时两边一起删除。其余属性透传给被包装的系统。
+    """
+
+    def __init__(self, qa_system, db):
+        self.qa_system = qa_system
+        self.db = db
+
+    def ask(self, question, session_id, **kwargs):
+        answer = self.qa_system.ask(question, session_id, **kwargs)
+        self.db.add_turn(session_id, question, answer)
+        return answer
+
+    def get_conversation_history(self, session_id):
+        return self.db.get_conversation_history(session_id)
+
+    def delete_conversation(self, session_id):
+        inner_db = getattr(self.qa_system, "db", None)
+        if inner_db is not None and hasattr(inner_db, "delete_conversation"):
+            inner_db.delete_conversation(session_id)
+        self.db.delete_conversation(session_id)
+
+    def __getattr__(self, name):
+        return getattr(self.qa_system, name)
+
+
+def attach_conversation_db(qa_system, db_path=DEFAULT_DB_PATH):
+    """
+    让问答系统的历史读写使用 ConversationDB
+
+    qa_system.db 已是 ConversationDB 时原样返回；否则（如 llm_rag.HybridQA 自带的整行重写存储）
+    返回 RecordingQA 包装，/history 的分页读取和删除不再依赖旧存储。
+    """
+    if isinstance(getattr(qa_system, "db", None), ConversationDB):
+        return qa_system
+    logger.info(f"对话历史记录到 {db_path}")
+    return RecordingQA(qa_system, ConversationDB(db_path))
+
+
+def delete_history(qa_system, session_id):
+    """删除会话历史；RecordingQA 同时删除被包装系统自己的历史"""
+    if isinstance(qa_system, RecordingQA):
+        qa_system.delete_conversation(session_id)
+    else:
+        qa_system.db.delete_conversation(session_id)
+
+
+def _accepts_paging(fn):
+    """fn 是否接受 limit/offset 关键字参数"""
+    try:
+        parameters = inspect.signature(fn).parameters
+    except (TypeError, ValueError):
+        return False
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+        return True
+    return "limit" in parameters and "offset" in parameters
+
+
+def read_history(qa_system, session_id, limit=None, offset=0):
+    """
+    按轮分页读取 HybridQA 的会话历史，返回 ConversationHistory
+
+    未经 attach_conversation_db 包装的旧存储不支持 limit/offset 也没有 total_turns：
+    此时退回旧接口 qa_system.get_conversation_history(session_id)，读出全部历史后在内存中分页。
+    """
+    get_page = getattr(getattr(qa_system, "db", None), "get_conversation_history", None)
+    if get_page is not None and _accepts_paging(get_page):
+        history = get_page(session_id, limit=limit, offset=offset)
+        if hasattr(history, "total_turns"):
+            return history
+
+    history = qa_system.get_conversation_history(session_id)
+    total_turns = len(history.user_queries)
+    end = max(total_turns - offset, 0)
+    start = 0 if limit is None else max(end - limit, 0)
+    return ConversationHistory(
+        session_id=session_id,
+        user_queries=list(history.user_queries[start:end]),
+        bot_responses=list(history.bot_responses[start:end]),
+        created_at=history.created_at,
+        updated_at=history.updated_at,
+        total_turns=total_turns
+    )
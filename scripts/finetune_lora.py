@@ -1,11 +1,13 @@
 import os
+import time
 import torch
-from datasets import load_dataset
+from datasets import load_dataset, Dataset
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     TrainingArguments,
     Trainer,
+    TrainerCallback,
     DataCollatorForSeq2Seq,
     BitsAndBytesConfig,
     EarlyStoppingCallback,
@@ -14,6 +16,12 @@ from transformers import (
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training, PeftModel
 import numpy as np
 import gc
+import sys
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generation_stopping import generate_with_stop_markers
 
 # ================= 路径配置 ==================
 model_path = r"models\Qwen3-8B"
@@ -23,6 +31,34 @@ output_dir = r"models\Qwen3-8B-optimized"
 # 创建输出目录
 os.makedirs(output_dir, exist_ok=True)
 
+# ================= 序列组织方式 ==================
+# max_length:      每条样本填充到 max_length（原方式，短样本的大部分计算花在填充token上）
+# group_by_length: 动态填充，按长度分组使同一批样本长度相近，只填充到批内最长
+# packing:         把多条样本拼接成接近 max_length 的序列，position_ids 在每条样本处重新从0开始，
+#                  由 flash_attention_2 按样本边界隔离注意力；未安装 flash-attn 时退回 group_by_length
+sequence_config = {
+    "mode": os.environ.get("FINETUNE_SEQUENCE_MODE", "group_by_length"),
+    "max_length": int(os.environ.get("FINETUNE_MAX_LENGTH", 512)),
+    # group_by_length 的每批样本数，梯度累积步数随之调整
+    "batch_size": int(os.environ.get("FINETUNE_BATCH_SIZE", 4)),
+    # 每次参数更新的样本数，与原配置（批大小1 × 累积12）一致
+    "samples_per_update": 12
+}
+
+def flash_attention_available():
+    try:
+        import flash_attn  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+if sequence_config["mode"] not in ("max_length", "group_by_length", "packing"):
+    raise ValueError(f"未知的 FINETUNE_SEQUENCE_MODE: {sequence_config['mode']}")
+if sequence_config["mode"] == "packing" and not flash_attention_available():
+    print("packing 需要 flash-attn 按样本边界隔离注意力，未安装，改用 group_by_length")
+    sequence_config["mode"] = "group_by_length"
+print(f"序列组织方式: {sequence_config['mode']}，最大长度 {sequence_config['max_length']}")
+
 # ================= 量化配置 ==================
 bnb_config = BitsAndBytesConfig(
     load_in_4bit=True,
@@ -50,6 +86,8 @@ model = AutoModelForCausalLM.from_pretrained(
     device_map="auto",
     max_memory={0: "10GB"},
     low_cpu_mem_usage=True,
+    **({"attn_implementation": "flash_attention_2", "torch_dtype": torch.bfloat16}
+       if sequence_config["mode"] == "packing" else {})
 )
 model = prepare_model_for_kbit_training(model)
 model.gradient_checkpointing_enable()
@@ -94,48 +132,34 @@ dataset = dataset.filter(clean_data)
 dataset = dataset.train_test_split(test_size=0.15, seed=42)
 dataset = dataset.map(format_prompt).filter(lambda x: x["text"] is not None)
 
-# ================= 分词函数优化 ==================
+# ================= 分词与标签 ==================
 def tokenize_function(examples):
-    texts = examples["text"]
-    # 动态截断 - 保留更多上下文信息
-    tokenized = tokenizer(
-        texts,
-        max_length=512,  # 增加长度获取更多上下文
-        truncation=True,
-        padding="max_length",
-        return_tensors="pt",
-    )
-    
-    input_ids = tokenized["input_ids"]
-    attention_mask = tokenized["attention_mask"]
+    """
+    分词但不填充，填充由整理器按批完成（或在 packing 时不需要填充）
     
-    labels = input_ids.clone()
-    # 标记非助手部分为-100 (忽略loss计算)
-    for i, text in enumerate(texts):
-        try:
-            # 查找助手文本位置
-            assistant_idx = text.find("[|im_start|]assistant")
-            if assistant_idx == -1:
-                # 未找到则全部标记忽略
-                labels[i, :] = -100
-                continue
-            
-            # 计算助手token位置
-            prompt_text = text[:assistant_idx]
-            prompt_tokens = tokenizer(prompt_text, return_tensors="pt")["input_ids"][0]
-            
-            # 跳过特殊token
-            prompt_tokens = prompt_tokens[prompt_tokens != tokenizer.eos_token_id]
-            prompt_tokens = prompt_tokens[prompt_tokens != tokenizer.pad_token_id]
-            
-            # 设置标签 (仅助手部分计算loss)
-            labels[i, :len(prompt_tokens)] = -100
-        except Exception as e:
-            print(f"标签生成错误: {e}")
-            labels[i, :] = -100
-    
-    tokenized["labels"] = labels
-    return tokenized
+    提示部分和助手部分分别分词后拼接，标签中提示部分精确标记为-100；助手部分末尾追加EOS
+    并计入标签，模型学会在回答结束处停止（packing 时回答后紧接下一条样本，没有EOS会学着续写）。
+    超长时从左侧截断，截掉的是提示开头，助手回答尽量完整保留
+    """
+    max_length = sequence_config["max_length"]
+    batch = {"input_ids": [], "attention_mask": [], "labels": []}
+    for text in examples["text"]:
+        assistant_idx = text.find("[|im_start|]assistant")
+        if assistant_idx == -1:
+            # 未找到助手部分，整条不计算loss
+            prompt_ids = tokenizer(text)["input_ids"]
+            response_ids = []
+        else:
+            prompt_ids = tokenizer(text[:assistant_idx])["input_ids"]
+            response_ids = tokenizer(text[assistant_idx:], add_special_tokens=False)["input_ids"]
+            response_ids = response_ids + [tokenizer.eos_token_id]
+        
+        input_ids = (prompt_ids + response_ids)[-max_length:]
+        labels = ([-100] * len(prompt_ids) + response_ids)[-max_length:]
+        batch["input_ids"].append(input_ids)
+        batch["attention_mask"].append([1] * len(input_ids))
+        batch["labels"].append(labels)
+    return batch
 
 tokenized_dataset = dataset.map(
     tokenize_function,
@@ -143,12 +167,96 @@ tokenized_dataset = dataset.map(
     batch_size=8,  # 减少批大小避免OOM
     remove_columns=dataset["train"].column_names
 )
+# 没有任何可训练token的样本（助手回答被完全截断）不参与训练
+tokenized_dataset = tokenized_dataset.filter(lambda x: any(label != -100 for label in x["labels"]))
+
+# ================= 序列打包 ==================
+def pack_dataset(tokenized, max_length):
+    """
+    按首次适应递减把样本装入长度不超过 max_length 的序列
+    
+    每条样本的 position_ids 从0开始，flash_attention_2 据此划分样本边界；
+    每条样本第一个token的标签置为-100，不让模型用上一条样本预测下一条的开头
+    """
+    all_input_ids = tokenized["input_ids"]
+    all_labels = tokenized["labels"]
+    order = sorted(range(len(all_input_ids)), key=lambda i: len(all_input_ids[i]), reverse=True)
+    bins = []  # [剩余长度, 样本下标列表]
+    for i in order:
+        length = len(all_input_ids[i])
+        for packed in bins:
+            if packed[0] >= length:
+                packed[0] -= length
+                packed[1].append(i)
+                break
+        else:
+            bins.append([max_length - length, [i]])
+    
+    rows = {"input_ids": [], "labels": [], "position_ids": []}
+    for _, members in bins:
+        input_ids, labels, position_ids = [], [], []
+        for i in members:
+            input_ids.extend(all_input_ids[i])
+            labels.extend([-100] + all_labels[i][1:])
+            position_ids.extend(range(len(all_input_ids[i])))
+        rows["input_ids"].append(input_ids)
+        rows["labels"].append(labels)
+        rows["position_ids"].append(position_ids)
+    return Dataset.from_dict(rows)
+
+def packed_collator(features):
+    """把一批打包序列再拼接成一行，不填充；样本边界完全由 position_ids 表示"""
+    return {
+        key: torch.tensor([[value for feature in features for value in feature[key]]])
+        for key in ("input_ids", "labels", "position_ids")
+    }
+
+# 原方式下每个epoch实际处理的token数，用于对比
+train_examples = len(tokenized_dataset["train"])
+train_real_tokens = sum(len(ids) for ids in tokenized_dataset["train"]["input_ids"])
+baseline_processed_tokens = train_examples * sequence_config["max_length"]
+
+if sequence_config["mode"] == "packing":
+    tokenized_dataset = {
+        split: pack_dataset(tokenized_dataset[split], sequence_config["max_length"])
+        for split in ("train", "test")
+    }
+    examples_per_row = train_examples / len(tokenized_dataset["train"])
+    per_device_batch_size = 1
+    gradient_accumulation_steps = max(1, round(sequence_config["samples_per_update"] / examples_per_row))
+    data_collator = packed_collator
+    print(f"打包: {train_examples} 条样本 -> {len(tokenized_dataset['train'])} 条序列，"
+          f"平均每条 {examples_per_row:.1f} 个样本")
+elif sequence_config["mode"] == "group_by_length":
+    per_device_batch_size = sequence_config["batch_size"]
+    gradient_accumulation_steps = max(1, sequence_config["samples_per_update"] // per_device_batch_size)
+    data_collator = DataCollatorForSeq2Seq(
+        tokenizer,
+        pad_to_multiple_of=8,
+        padding=True,
+        return_tensors="pt",
+        label_pad_token_id=-100
+    )
+else:
+    per_device_batch_size = 1
+    gradient_accumulation_steps = sequence_config["samples_per_update"]
+    data_collator = DataCollatorForSeq2Seq(
+        tokenizer,
+        padding="max_length",
+        max_length=sequence_config["max_length"],
+        return_tensors="pt",
+        label_pad_token_id=-100
+    )
+print(f"训练样本 {train_examples} 条，平均 {train_real_tokens / max(train_examples, 1):.0f} token；"
+      f"原方式填充后每epoch {baseline_processed_tokens} token，其中有效 {train_real_tokens / max(baseline_processed_tokens, 1):.0%}")
 
 # ================= 训练参数优化 ==================
 training_args = TrainingArguments(
     output_dir=output_dir,
-    per_device_train_batch_size=1,
-    gradient_accumulation_steps=12,  # 平衡内存和更新频率
+    per_device_train_batch_size=per_device_batch_size,
+    per_device_eval_batch_size=per_device_batch_size,
+    gradient_accumulation_steps=gradient_accumulation_steps,  # 每次更新约 samples_per_update 条样本
+    group_by_length=sequence_config["mode"] == "group_by_length",
     num_train_epochs=6,  # 减少训练轮次
     learning_rate=3e-5,  # 优化学习率
     warmup_ratio=0.1,  # 使用预热
@@ -169,27 +277,73 @@ training_args = TrainingArguments(
     remove_unused_columns=False
 )
 
-# ================= 训练器配置 ==================
-data_collator = DataCollatorForSeq2Seq(
-    tokenizer,
-    pad_to_multiple_of=8,
-    padding=True,
-    return_tensors="pt",
-    label_pad_token_id=-100
-)
+# ================= 吞吐统计 ==================
+class ThroughputTrainer(Trainer):
+    """统计训练中处理的token数（含填充）和有效token数（不含填充），评估不计入"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_counts = {"processed": 0, "real": 0}
+    
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        if model.training:
+            self.token_counts["processed"] += inputs["input_ids"].numel()
+            attention_mask = inputs.get("attention_mask")
+            self.token_counts["real"] += (
+                int(attention_mask.sum()) if attention_mask is not None else inputs["input_ids"].numel()
+            )
+        return super().compute_loss(model, inputs, *args, **kwargs)
+
+class TrainStepTimer(TrainerCallback):
+    """累计训练步耗时，不含评估和保存检查点"""
+    
+    def __init__(self):
+        self.seconds = 0.0
+        self._start = None
+    
+    def on_step_begin(self, args, state, control, **kwargs):
+        if self._start is None:
+            self._start = time.perf_counter()
+    
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._start is not None:
+            self.seconds += time.perf_counter() - self._start
+            self._start = None
 
-trainer = Trainer(
+def report_throughput(trainer, step_timer):
+    counts = trainer.token_counts
+    seconds = max(step_timer.seconds, 1e-9)
+    processed_per_sec = counts["processed"] / seconds
+    effective_per_sec = counts["real"] / seconds
+    # 按处理token的速度估算原方式的有效吞吐；注意力计算随长度超线性增长，实际原方式只会更慢
+    baseline_per_sec = processed_per_sec * train_real_tokens / max(baseline_processed_tokens, 1)
+    print("\n" + "=" * 50)
+    print(f"序列组织方式: {sequence_config['mode']}")
+    print(f"训练步耗时: {step_timer.seconds:.1f}s")
+    print(f"处理token: {counts['processed']}，有效token: {counts['real']}，"
+          f"填充占比 {1 - counts['real'] / max(counts['processed'], 1):.1%}")
+    print(f"有效吞吐: {effective_per_sec:.1f} tokens/s")
+    if sequence_config["mode"] != "max_length":
+        print(f"原方式（填充到 {sequence_config['max_length']}）估算有效吞吐: {baseline_per_sec:.1f} tokens/s，"
+              f"提升约 {effective_per_sec / max(baseline_per_sec, 1e-9):.1f}x")
+        print("精确对比可用 FINETUNE_SEQUENCE_MODE=max_length 再运行一次")
+    print("=" * 50)
+
+# ================= 训练器配置 ==================
+step_timer = TrainStepTimer()
+trainer = ThroughputTrainer(
     model=model,
     args=training_args,
     train_dataset=tokenized_dataset["train"],
     eval_dataset=tokenized_dataset["test"],
     data_collator=data_collator,
-    callbacks=[EarlyStoppingCallback(early_stopping_patience=3)]
+    callbacks=[EarlyStoppingCallback(early_stopping_patience=3), step_timer]
 )
 
 # ================= 训练与保存 ==================
 print("开始训练...")
 trainer.train()
+report_throughput(trainer, step_timer)
 
 print("保存模型...")
 model.save_pretrained(output_dir)
@@ -228,25 +382,18 @@ def test_model(model, tokenizer, test_cases):
                 max_length=256
             )
             
-            # 显式指定input_ids作为输入
-            outputs = model.generate(
-                input_ids=inputs["input_ids"].to(model.device),
+            # 显式指定input_ids作为输入，检测到对话标记即停止
+            response, stats = generate_with_stop_markers(
+                model,
+                tokenizer,
+                inputs["input_ids"].to(model.device),
                 attention_mask=inputs["attention_mask"].to(model.device),
                 generation_config=generation_config
             )
             
-            # 解码并清理响应
-            full_response = tokenizer.decode(outputs[0], skip_special_tokens=False)
-            
-            # 提取助手回答
-            if "[|im_start|]assistant" in full_response:
-                response = full_response.split("[|im_start|]assistant")[-1]
-                response = response.replace("[|im_end|]", "").split("]")[0].strip()
-            else:
-                response = full_response
-            
             print(f"\n问题：{q}")
             print(f"回答：{response}")
+            print(f"生成token数：{stats['completion_tokens']}，节省token数：{stats['tokens_saved']}")
             print("-"*50)
     
     # 内存清理
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP接口压测与流量回放
+
+按固定并发（闭环）或固定到达率（开环，泊松到达）回放问题，压测 Flask 的 /api/chat
+或 FastAPI 的 /api/ask，报告延迟 p50/p95/p99、首token延迟、吞吐和错误率。
+接口不是流式的，首token延迟由响应头 Server-Timing 推算：客户端延迟减去服务端 decode 耗时。
+--stub 启动进程内的模拟服务（固定首token延迟和解码速度，单槽位排队），无需模型权重即可在CI中运行。
+
+用法:
+    python scripts/load_test.py --stub --concurrency 4 --requests 40
+    python scripts/load_test.py --url http://localhost:5000 --api chat --rate 0.5 --duration 300
+    python scripts/load_test.py --url http://localhost:8000 --api ask --questions questions.jsonl --concurrency 2
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 添加scripts目录到Python路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from qa_corpus import load_questions
+
+API_PATHS = {"chat": "/api/chat", "ask": "/api/ask"}
+
+
+# ================== 模拟服务 ==================
+class StubHandler(BaseHTTPRequestHandler):
+    """模拟 /api/chat 和 /api/ask：排队 + 首token延迟 + 按解码速度生成"""
+
+    protocol_version = "HTTP/1.1"
+    slots = None
+    ttft = 0.2
+    tokens_per_sec = 50.0
+    response_tokens = 100
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path in ("/api/health", "/health"):
+            self._send_json(200, {"status": "healthy", "stub": True})
+        else:
+            self._send_json(404, {"success": False})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+        question = data.get("message") or data.get("question") or ""
+
+        arrived = time.perf_counter()
+        with self.slots:
+            queued = time.perf_counter() - arrived
+            time.sleep(self.ttft)
+            decode = self.response_tokens / self.tokens_per_sec
+            time.sleep(decode)
+        answer = f"模拟回答：{question}" + "。" * self.response_tokens
+        timing = f"queue;dur={queued * 1000:.1f}, prefill;dur={self.ttft * 1000:.1f}, decode;dur={decode * 1000:.1f}"
+
+        if self.path == "/api/chat":
+            self._send_json(200, {"success": True, "response": answer}, {"Server-Timing": timing})
+        elif self.path == "/api/ask":
+            self._send_json(200, {"success": True, "answer": answer}, {"Server-Timing": timing})
+        else:
+            self._send_json(404, {"success": False})
+
+
+def start_stub_server(args):
+    handler = type("ConfiguredStubHandler", (StubHandler,), {
+        "slots": threading.Semaphore(args.stub_slots),
+        "ttft": args.stub_ttft,
+        "tokens_per_sec": args.stub_tokens_per_sec,
+        "response_tokens": args.stub_response_tokens,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ================== 请求与统计 ==================
+def parse_server_timing(header):
+    """Server-Timing 头 -> {阶段: 秒}"""
+    timings = {}
+    for part in (header or "").split(","):
+        fields = [f.strip() for f in part.split(";")]
+        if not fields[0]:
+            continue
+        for field in fields[1:]:
+            if field.startswith("dur="):
+                try:
+                    timings[fields[0]] = float(field[4:]) / 1000
+                except ValueError:
+                    pass
+    return timings
+
+
+def send_request(base_url, api, question, session_id, timeout):
+    """发送一个请求，返回结果记录"""
+    if api == "chat":
+        payload = {"message": question, "session_id": session_id}
+    else:
+        payload = {"question": question, "session_id": session_id}
+    request = urllib.request.Request(
+        base_url.rstrip("/") + API_PATHS[api],
+        data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+        headers={"Content-Type": "application/json; charset=utf-8"},
+        method="POST"
+    )
+
+    start = time.perf_counter()
+    record = {"start": start, "status": None, "error": None, "ttft": None, "chars": 0}
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            body = json.loads(resp.read().decode("utf-8"))
+            record["status"] = resp.status
+            timing_header = resp.headers.get("Server-Timing")
+        answer = body.get("response") or body.get("answer") or ""
+        record["chars"] = len(answer)
+        if not body.get("success", True):
+            record["error"] = body.get("error", "success=false")
+    except urllib.error.HTTPError as e:
+        record["status"] = e.code
+        record["error"] = f"HTTP {e.code}"
+        timing_header = None
+    except Exception as e:
+        record["error"] = type(e).__name__
+        timing_header = None
+
+    record["latency"] = time.perf_counter() - start
+    decode = parse_server_timing(timing_header).get("decode")
+    if record["error"] is None and decode is not None:
+        record["ttft"] = max(record["latency"] - decode, 0.0)
+    return record
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(int(round(q * (len(values) - 1))), len(values) - 1)
+    return values[idx]
+
+
+def summarize(records, wall_seconds):
+    ok = [r for r in records if r["error"] is None]
+    errors = {}
+    for r in records:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    return {
+        "requests": len(records),
+        "succeeded": len(ok),
+        "error_rate": (len(records) - len(ok)) / len(records) if records else 0.0,
+        "errors": errors,
+        "wall_seconds": wall_seconds,
+        "throughput_rps": len(ok) / wall_seconds if wall_seconds else 0.0,
+        "throughput_chars_per_sec": sum(r["chars"] for r in ok) / wall_seconds if wall_seconds else 0.0,
+        "latency": {q: percentile(latencies, p) for q, p in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+        "ttft": {q: percentile(ttfts, p) for q, p in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+    }
+
+
+# ================== 负载模式 ==================
+class QuestionFeed:
+    """按顺序循环取问题，并轮换会话ID"""
+
+    def __init__(self, questions, sessions, shuffle, seed):
+        self.questions = list(questions)
+        if shuffle:
+            random.Random(seed).shuffle(self.questions)
+        self.sessions = sessions
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            i = self._index
+            self._index += 1
+        return self.questions[i % len(self.questions)], f"load-{i % self.sessions}"
+
+
+def run_closed_loop(args, base_url, feed):
+    """固定并发：每个工作线程收到响应后立即发下一个请求"""
+    records = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    remaining = [args.requests]
+
+    def worker():
+        while True:
+            with lock:
+                if deadline is None and remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            question, session_id = feed.next()
+            record = send_request(base_url, args.api, question, session_id, args.timeout)
+            with lock:
+                records.append(record)
+
+    threads = [threading.Thread(target=worker, name=f"load-{i}") for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+
+def run_open_loop(args, base_url, feed):
+    """固定到达率：按泊松过程发请求，不等待前一个请求完成"""
+    rng = random.Random(args.seed)
+    futures = []
+    start = time.perf_counter()
+    next_arrival = start
+    count = 0
+    with ThreadPoolExecutor(max_workers=args.max_in_flight, thread_name_prefix="load") as executor:
+        while True:
+            if args.duration and next_arrival - start >= args.duration:
+                break
+            if not args.duration and count >= args.requests:
+                break
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            question, session_id = feed.next()
+            futures.append(executor.submit(send_request, base_url, args.api, question, session_id, args.timeout))
+            count += 1
+            next_arrival += rng.expovariate(args.rate)
+    return [future.result() for future in futures]
+
+
+def print_report(report, args):
+    def fmt(value):
+        return f"{value * 1000:8.0f}ms" if value is not None else "       -"
+
+    mode = f"到达率 {args.rate}/s" if args.rate else f"并发 {args.concurrency}"
+    print("\n" + "=" * 60)
+    print(f"压测结果（{args.api}，{mode}）")
+    print("=" * 60)
+    print(f"请求数: {report['requests']}，成功: {report['succeeded']}，错误率: {report['error_rate']:.1%}")
+    if report["errors"]:
+        print(f"错误分布: {report['errors']}")
+    print(f"耗时: {report['wall_seconds']:.1f}s，吞吐: {report['throughput_rps']:.2f} req/s，"
+          f"{report['throughput_chars_per_sec']:.0f} 字/s")
+    print(f"{'':8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    print(f"{'延迟':6}{fmt(report['latency']['p50'])}{fmt(report['latency']['p95'])}{fmt(report['latency']['p99'])}")
+    print(f"{'首token':5}{fmt(report['ttft']['p50'])}{fmt(report['ttft']['p95'])}{fmt(report['ttft']['p99'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="问答接口压测与流量回放")
+    parser.add_argument("--url", default="http://localhost:5000", help="服务地址")
+    parser.add_argument("--api", choices=sorted(API_PATHS), default="chat",
+                        help="chat: Flask /api/chat；ask: FastAPI /api/ask")
+    parser.add_argument("--questions", default=None,
+                        help="问题文件（.jsonl 取 question/message/instruction 或 title/body，其他文件每行一个问题），"
+                             "默认使用问答对语料中的问题")
+    parser.add_argument("--concurrency", type=int, default=1, help="闭环模式的并发数")
+    parser.add_argument("--rate", type=float, default=None, help="开环模式的到达率（请求/秒）")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="开环模式同时在途请求上限")
+    parser.add_argument("--requests", type=int, default=20, help="请求总数（未设置 --duration 时）")
+    parser.add_argument("--duration", type=float, default=None, help="压测时长（秒）")
+    parser.add_argument("--sessions", type=int, default=8, help="轮换使用的会话数")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--shuffle", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="把结果写入JSON文件")
+    parser.add_argument("--stub", action="store_true", help="启动进程内模拟服务，无需模型")
+    parser.add_argument("--stub-slots", type=int, default=1, help="模拟服务同时生成的请求数")
+    parser.add_argument("--stub-ttft", type=float, default=0.2, help="模拟首token延迟（秒）")
+    parser.add_argument("--stub-tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--stub-response-tokens", type=int, default=20)
+    args = parser.parse_args()
+
+    base_url = args.url
+    if args.stub:
+        server, base_url = start_stub_server(args)
+        print(f"模拟服务已启动: {base_url}")
+
+    questions = load_questions(args.questions)
+    if not questions:
+        parser.error("没有可用的问题")
+    feed = QuestionFeed(questions, args.sessions, args.shuffle, args.seed)
+    print(f"共 {len(questions)} 个问题，目标: {base_url}{API_PATHS[args.api]}")
+
+    start = time.perf_counter()
+    if args.rate:
+        records = run_open_loop(args, base_url, feed)
+    else:
+        records = run_closed_loop(args, base_url, feed)
+    report = summarize(records, time.perf_counter() - start)
+
+    print_report(report, args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "report": report}, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+
+    if args.stub:
+        server.shutdown()
+    # 全部失败时返回非零退出码，便于CI判断
+    return 0 if report["succeeded"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
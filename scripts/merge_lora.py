@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LoRA适配器合并导出工具
+
+将 models/Qwen3-8B-optimized 中的LoRA适配器合并进 Qwen3-8B 基础权重，
+以分片safetensors格式保存到 models/Qwen3-8B-merged。
+调用代码.py 检测到合并目录后会直接加载它，不再需要先加载基础模型再挂载适配器。
+"""
+
+import os
+import json
+import time
+import logging
+from datetime import datetime
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from peft import PeftModel
+
+# 设置日志
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger('LoRA_Merger')
+
+# ================= 路径配置 ==================
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+base_model_path = os.path.join(project_root, "models", "Qwen3-8B")
+adapter_path = os.path.join(project_root, "models", "Qwen3-8B-optimized")
+output_dir = os.path.join(project_root, "models", "Qwen3-8B-merged")
+
+# ================= 导出配置 ==================
+max_shard_size = "2GB"   # 分片大小，便于内存映射按需加载
+save_dtype = torch.bfloat16
+
+def merge_lora():
+    """合并LoRA适配器并保存为分片safetensors"""
+    if not os.path.exists(os.path.join(adapter_path, "adapter_config.json")):
+        logger.error(f"找不到LoRA适配器: {adapter_path}")
+        return False
+
+    timings = {}
+
+    logger.info(f"加载基础模型: {base_model_path}")
+    start = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model_path,
+        trust_remote_code=True,
+        torch_dtype=save_dtype,
+        low_cpu_mem_usage=True
+    )
+    timings["base_model"] = time.perf_counter() - start
+
+    logger.info(f"加载LoRA适配器: {adapter_path}")
+    start = time.perf_counter()
+    model = PeftModel.from_pretrained(model, adapter_path)
+    timings["lora_adapter"] = time.perf_counter() - start
+
+    logger.info("合并LoRA权重...")
+    start = time.perf_counter()
+    model = model.merge_and_unload()
+    timings["merge"] = time.perf_counter() - start
+
+    logger.info(f"保存合并模型到: {output_dir}")
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(
+        output_dir,
+        safe_serialization=True,
+        max_shard_size=max_shard_size
+    )
+
+    # 分词器与适配器一起保存，合并目录可独立加载
+    tokenizer = AutoTokenizer.from_pretrained(
+        adapter_path,
+        trust_remote_code=True,
+        use_fast=False
+    )
+    tokenizer.save_pretrained(output_dir)
+    timings["save"] = time.perf_counter() - start
+
+    # 记录合并来源，便于排查模型版本
+    merge_info = {
+        "base_model": base_model_path,
+        "adapter": adapter_path,
+        "dtype": str(save_dtype),
+        "max_shard_size": max_shard_size,
+        "merged_at": datetime.now().isoformat(),
+        "timings": timings
+    }
+    with open(os.path.join(output_dir, "merge_info.json"), "w", encoding="utf-8") as f:
+        json.dump(merge_info, f, ensure_ascii=False, indent=2)
+
+    timing_str = "，".join(f"{phase}: {seconds:.2f}s" for phase, seconds in timings.items())
+    logger.info(f"合并完成，耗时 {timing_str}")
+    return True
+
+def main():
+    """主函数"""
+    logger.info("=" * 60)
+    logger.info("公共艺术RAG系统 - LoRA合并导出工具")
+    logger.info("=" * 60)
+
+    if merge_lora():
+        logger.info("✅ 合并模型已导出，重启服务后将自动加载")
+    else:
+        logger.error("❌ LoRA合并失败")
+
+if __name__ == "__main__":
+    main()
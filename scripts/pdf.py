@@ -4,9 +4,15 @@ from langchain.embeddings import OllamaEmbeddings
 from langchain.vectorstores import Chroma
 from pathlib import Path
 import os
+import sys
 import subprocess
 from tqdm import tqdm
 
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_manager import resolve_index_directory
+
 # PDF文件目录
 pdf_directory = r"knowledge_base\相关文本资料汇总"
 
@@ -105,7 +111,8 @@ except Exception as e:
 
 # 创建/连接Chroma数据库
 try:
-    db_directory = r"chroma_db_deepseek_1.5b"
+    # 已有版本化索引时连接 CURRENT 指向的版本，否则使用旧布局的根目录
+    _, db_directory = resolve_index_directory(r"chroma_db_deepseek_1.5b")
     collection_name = "academic_papers_deepseek_1.5b"
     
     if os.path.exists(db_directory) and os.listdir(db_directory):
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+问答对语料读取
+
+数据库-公共艺术领域/问答对 下每个文件名为 alpaca_<论文题目>_<作者>_coze_response.json，
+内容为 [{"instruction": ..., "output": ...}, ...]。压测、检索评测和批量问答脚本共用。
+"""
+
+import json
+import os
+import re
+from dataclasses import dataclass
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QA_DIRECTORY = os.path.join(PROJECT_ROOT, "数据库-公共艺术领域", "问答对")
+
+_FILENAME_PATTERN = re.compile(r"^alpaca_(?P<title>.+)_(?P<author>[^_]+)_coze_response\.json$")
+
+
+@dataclass
+class QAPair:
+    question: str
+    answer: str
+    title: str      # 来源论文题目（取自文件名）
+    author: str
+    source: str     # 问答对文件路径
+
+
+def parse_qa_filename(filename):
+    """从文件名解析 (论文题目, 作者)，不符合命名规则时返回 (去掉扩展名的文件名, "")"""
+    match = _FILENAME_PATTERN.match(os.path.basename(filename))
+    if not match:
+        return os.path.splitext(os.path.basename(filename))[0], ""
+    return match.group("title"), match.group("author")
+
+
+def iter_qa_pairs(directory=QA_DIRECTORY):
+    """按文件名顺序遍历全部问答对"""
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(directory, filename)
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = [data]
+        title, author = parse_qa_filename(filename)
+        for item in data:
+            if isinstance(item, dict) and item.get("instruction"):
+                yield QAPair(
+                    question=item["instruction"].strip(),
+                    answer=item.get("output", ""),
+                    title=title,
+                    author=author,
+                    source=path
+                )
+
+
+def record_question(record):
+    """
+    从一条JSONL记录中取问题
+
+    依次取 question/message/instruction 字段；工单式记录（title/body，如 requests.jsonl）
+    取 "标题\n正文"。都没有时返回 None。
+    """
+    question = record.get("question") or record.get("message") or record.get("instruction")
+    if question:
+        return question
+    title, body = (record.get("title") or "").strip(), (record.get("body") or "").strip()
+    if title or body:
+        return f"{title}\n{body}".strip()
+    return None
+
+
+def load_questions(path=None):
+    """
+    读取问题列表
+
+    path 为空时使用问答对语料；.jsonl 文件每行取 question/message/instruction 字段，
+    或 title/body 拼成的工单式问题（见 record_question）；其他文本文件每行一个问题。
+    """
+    if path is None:
+        return [pair.question for pair in iter_qa_pairs()]
+    if os.path.isdir(path):
+        return [pair.question for pair in iter_qa_pairs(path)]
+
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                question = record_question(json.loads(line))
+                if question:
+                    questions.append(question)
+            else:
+                questions.append(line)
+    return questions
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+检索质量与延迟离线评测
+
+用 数据库-公共艺术领域/问答对 中的问题作为查询，问题所在文件对应的论文作为标准答案：
+检索结果中任一片段来自该论文（来源文件名包含论文题目）即为命中。对每种检索配置
+统计 recall@k、MRR 和单次查询延迟，性能优化前后可以在自己的数据上对比质量。
+
+检索配置:
+    dense      Chroma 向量检索（与 调用代码.py 一致）
+    quantized  int8 量化的文档向量矩阵上做精确检索
+    hybrid     向量检索 + 字符二元组BM25，RRF融合
+    reranked   hybrid 候选经交叉编码器重排（需要 sentence-transformers）
+
+用法:
+    python scripts/retrieval_benchmark.py --limit 300
+    python scripts/retrieval_benchmark.py --configs dense hybrid --include-qa --output retrieval.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import importlib
+from collections import Counter, defaultdict
+
+import numpy as np
+
+# 添加项目根目录和scripts目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from qa_corpus import iter_qa_pairs
+
+ALL_CONFIGS = ("dense", "quantized", "hybrid", "reranked")
+RECALL_AT = (1, 3, 5, 10)
+
+
+# ================== 标注 ==================
+def title_fragments(title):
+    """文件名中过长的题目被截断为 "前半...后半"，两段都出现才算匹配"""
+    return [part for part in title.replace("…", "...").split("...") if part]
+
+
+def matches_paper(source, fragments):
+    name = os.path.basename(source or "")
+    return all(fragment in name for fragment in fragments)
+
+
+def build_queries(corpus, limit, seed):
+    """每篇论文轮流取问题，保证抽样覆盖所有论文"""
+    by_paper = defaultdict(list)
+    for pair in iter_qa_pairs():
+        by_paper[pair.title].append(pair)
+
+    queries = []
+    rng = random.Random(seed)
+    for pairs in by_paper.values():
+        rng.shuffle(pairs)
+    rounds = max(len(pairs) for pairs in by_paper.values())
+    for i in range(rounds):
+        for title in sorted(by_paper):
+            if i < len(by_paper[title]):
+                queries.append(by_paper[title][i])
+    if limit:
+        queries = queries[:limit]
+
+    labeled = []
+    for pair in queries:
+        fragments = title_fragments(pair.title)
+        relevant = {idx for idx, meta in enumerate(corpus["metadatas"]) if matches_paper(meta.get("source"), fragments)}
+        labeled.append({"question": pair.question, "title": pair.title, "relevant": relevant})
+    return labeled
+
+
+# ================== 语料 ==================
+def load_corpus(include_qa):
+    """从Chroma读出全部片段及其向量"""
+    from langchain.embeddings import OllamaEmbeddings
+    from langchain.vectorstores import Chroma
+
+    from index_manager import resolve_index_directory
+
+    core = importlib.import_module("调用代码")
+    # 与 initialize_system 相同：读取 CURRENT 指向的版本，旧布局时为根目录本身
+    index_version, index_directory = resolve_index_directory(core.db_directory)
+    print(f"索引版本: {index_version or '旧布局'}（{index_directory}）")
+    embeddings = OllamaEmbeddings(model=core.embedding_model_name)
+    vector_store = Chroma(
+        embedding_function=embeddings,
+        persist_directory=index_directory,
+        collection_name=core.collection_name
+    )
+    data = vector_store._collection.get(include=["embeddings", "documents", "metadatas"])
+
+    keep = [
+        i for i, meta in enumerate(data["metadatas"])
+        if include_qa or (meta or {}).get("type") != "qa_pair"
+    ]
+    corpus = {
+        "ids": [data["ids"][i] for i in keep],
+        "documents": [data["documents"][i] for i in keep],
+        "metadatas": [data["metadatas"][i] or {} for i in keep],
+        "embeddings": np.asarray([data["embeddings"][i] for i in keep], dtype=np.float32),
+    }
+    return vector_store, embeddings, corpus
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+# ================== 检索器 ==================
+class DenseRetriever:
+    """
+    Chroma 向量检索，按文档ID映射回语料下标
+
+    不用 where 过滤问答对（{"$ne": ...} 会把没有 type 字段的片段一起排除），而是多取一些结果，
+    只保留语料中的片段；不足 k 个时加倍重取，直到取完整个集合。
+    """
+
+    def __init__(self, vector_store, corpus, overfetch=4):
+        self.vector_store = vector_store
+        self.index = {doc_id: i for i, doc_id in enumerate(corpus["ids"])}
+        self.total = vector_store._collection.count()
+        self.overfetch = 1 if len(self.index) >= self.total else overfetch
+
+    def search(self, query_vector, query_text, k):
+        n_results = min(k * self.overfetch, self.total)
+        while True:
+            result = self.vector_store._collection.query(
+                query_embeddings=[query_vector.tolist()],
+                n_results=n_results,
+                include=[]
+            )
+            hits = [self.index[doc_id] for doc_id in result["ids"][0] if doc_id in self.index]
+            if len(hits) >= k or n_results >= self.total:
+                return hits[:k]
+            n_results = min(n_results * 2, self.total)
+
+
+class QuantizedRetriever:
+    """逐向量对称int8量化，内积检索"""
+
+    def __init__(self, corpus):
+        vectors = normalize(corpus["embeddings"])
+        self.scales = np.abs(vectors).max(axis=1) / 127.0
+        self.codes = np.round(vectors / np.maximum(self.scales[:, None], 1e-12)).astype(np.int8)
+        self.memory_ratio = self.codes.nbytes / vectors.nbytes
+
+    def search(self, query_vector, query_text, k):
+        query = normalize(query_vector)
+        scores = (self.codes.astype(np.float32) @ query) * self.scales
+        top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
+        return top[np.argsort(-scores[top])].tolist()
+
+
+class BM25:
+    """字符二元组BM25，中文无需分词"""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self.doc_terms = [Counter(self.tokenize(doc)) for doc in documents]
+        self.doc_len = np.array([sum(terms.values()) for terms in self.doc_terms], dtype=np.float32)
+        self.avg_len = float(self.doc_len.mean()) if len(self.doc_len) else 0.0
+        self.postings = defaultdict(list)
+        for i, terms in enumerate(self.doc_terms):
+            for term, tf in terms.items():
+                self.postings[term].append((i, tf))
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in self.postings.items()}
+
+    @staticmethod
+    def tokenize(text):
+        text = "".join(text.split())
+        return [text[i:i + 2] for i in range(len(text) - 1)]
+
+    def search(self, query, k):
+        scores = defaultdict(float)
+        for term in set(self.tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self.postings[term]:
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[i] / self.avg_len)
+                scores[i] += idf * tf * (self.k1 + 1) / norm
+        return [i for i, _ in sorted(scores.items(), key=lambda item: -item[1])[:k]]
+
+
+class HybridRetriever:
+    """向量检索与BM25结果用倒数排名融合（RRF）"""
+
+    def __init__(self, dense, bm25, candidates=50, rrf_k=60):
+        self.dense = dense
+        self.bm25 = bm25
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+
+    def search(self, query_vector, query_text, k):
+        fused = defaultdict(float)
+        for ranking in (self.dense.search(query_vector, query_text, self.candidates),
+                        self.bm25.search(query_text, self.candidates)):
+            for rank, idx in enumerate(ranking):
+                fused[idx] += 1.0 / (self.rrf_k + rank + 1)
+        return [idx for idx, _ in sorted(fused.items(), key=lambda item: -item[1])[:k]]
+
+
+class RerankedRetriever:
+    """对融合候选做交叉编码器重排"""
+
+    def __init__(self, hybrid, documents, model_name, candidates=30):
+        from sentence_transformers import CrossEncoder
+        self.hybrid = hybrid
+        self.documents = documents
+        self.model = CrossEncoder(model_name, max_length=512)
+        self.candidates = candidates
+
+    def search(self, query_vector, query_text, k):
+        candidates = self.hybrid.search(query_vector, query_text, self.candidates)
+        if not candidates:
+            return []
+        scores = self.model.predict([(query_text, self.documents[i]) for i in candidates])
+        order = np.argsort(-np.asarray(scores))
+        return [candidates[i] for i in order[:k]]
+
+
+# ================== 评测 ==================
+def evaluate(retriever, queries, query_vectors, max_k):
+    hits = {k: 0 for k in RECALL_AT if k <= max_k}
+    reciprocal_ranks = []
+    latencies = []
+    for query, vector in zip(queries, query_vectors):
+        start = time.perf_counter()
+        ranking = retriever.search(vector, query["question"], max_k)
+        latencies.append(time.perf_counter() - start)
+
+        first = next((rank for rank, idx in enumerate(ranking) if idx in query["relevant"]), None)
+        reciprocal_ranks.append(1.0 / (first + 1) if first is not None else 0.0)
+        for k in hits:
+            if first is not None and first < k:
+                hits[k] += 1
+
+    n = len(queries)
+    latencies.sort()
+    return {
+        **{f"recall@{k}": hits[k] / n for k in hits},
+        f"mrr@{max_k}": sum(reciprocal_ranks) / n,
+        "latency_ms_p50": latencies[n // 2] * 1000,
+        "latency_ms_p95": latencies[min(int(n * 0.95), n - 1)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检索质量与延迟评测")
+    parser.add_argument("--configs", nargs="+", choices=ALL_CONFIGS, default=list(ALL_CONFIGS))
+    parser.add_argument("--limit", type=int, default=300, help="查询数，0 表示全部问题")
+    parser.add_argument("--k", type=int, default=10, help="检索深度")
+    parser.add_argument("--include-qa", action="store_true",
+                        help="保留索引中的问答对片段（问题原文在索引中，会高估召回）")
+    parser.add_argument("--reranker", default=os.environ.get("RAG_RERANKER_MODEL", "BAAI/bge-reranker-base"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="把结果写入JSON文件")
+    args = parser.parse_args()
+
+    print("正在读取向量库...")
+    vector_store, embeddings, corpus = load_corpus(args.include_qa)
+    print(f"语料片段: {len(corpus['ids'])}{'（含问答对）' if args.include_qa else '（不含问答对）'}")
+
+    queries = build_queries(corpus, args.limit, args.seed)
+    answerable = [q for q in queries if q["relevant"]]
+    print(f"查询: {len(queries)}，来源论文在索引中的: {len(answerable)}")
+    if not answerable:
+        print("没有可评测的查询：检查知识库文件名是否包含论文题目")
+        return 1
+
+    # 查询向量只计算一次，各配置共享；向量化耗时单独统计
+    start = time.perf_counter()
+    query_vectors = np.asarray([embeddings.embed_query(q["question"]) for q in answerable], dtype=np.float32)
+    embed_ms = (time.perf_counter() - start) / len(answerable) * 1000
+    print(f"查询向量化平均耗时: {embed_ms:.1f}ms")
+
+    dense = DenseRetriever(vector_store, corpus)
+    builders = {
+        "dense": lambda: dense,
+        "quantized": lambda: QuantizedRetriever(corpus),
+        "hybrid": lambda: HybridRetriever(dense, BM25(corpus["documents"])),
+        "reranked": lambda: RerankedRetriever(
+            HybridRetriever(dense, BM25(corpus["documents"])), corpus["documents"], args.reranker
+        ),
+    }
+
+    results = {}
+    for name in args.configs:
+        try:
+            retriever = builders[name]()
+        except ImportError as e:
+            print(f"跳过 {name}: 缺少依赖 ({e})")
+            continue
+        results[name] = evaluate(retriever, answerable, query_vectors, args.k)
+        if isinstance(retriever, QuantizedRetriever):
+            results[name]["memory_ratio"] = retriever.memory_ratio
+
+    metric_names = [f"recall@{k}" for k in RECALL_AT if k <= args.k] + [f"mrr@{args.k}"]
+    print("\n" + "=" * 90)
+    print(f"{'配置':<12}" + "".join(f"{m:>11}" for m in metric_names) + f"{'p50(ms)':>10}{'p95(ms)':>10}")
+    print("-" * 90)
+    for name, result in results.items():
+        print(f"{name:<12}" + "".join(f"{result[m]:>11.3f}" for m in metric_names)
+              + f"{result['latency_ms_p50']:>10.1f}{result['latency_ms_p95']:>10.1f}")
+    print(f"\n以上延迟不含查询向量化（平均 {embed_ms:.1f}ms）")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "config": vars(args),
+                "corpus_chunks": len(corpus["ids"]),
+                "queries": len(answerable),
+                "embed_ms": embed_ms,
+                "results": results
+            }, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,12 @@ import torch
 import logging
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import os
+import sys
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generation_stopping import generate_with_stop_markers
 
 # 设置日志配置
 logging.basicConfig(
@@ -72,20 +78,12 @@ def chat_with_history(messages):
         "pad_token_id": tokenizer.pad_token_id,
         "eos_token_id": tokenizer.eos_token_id
     }
-    with torch.no_grad():
-        outputs = model.generate(
-            input_ids=input_ids,
-            **generation_config
-        )
-    full_response = tokenizer.decode(outputs[0], skip_special_tokens=False)
-    if "[|im_start|]assistant" in full_response:
-        response = full_response.split("[|im_start|]assistant")[-1]
-        special_tokens = ["[|im_end|]", "<|im_end|>", "]", "|im_end|", "<|im_start|>", "|im_start|"]
-        for token in special_tokens:
-            response = response.split(token)[0].strip()
-        response = response.strip()
-    else:
-        response = full_response
+    response, _ = generate_with_stop_markers(
+        model,
+        tokenizer,
+        input_ids,
+        **generation_config
+    )
     return response
 
 # 多轮会话循环
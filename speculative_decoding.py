@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+投机解码（assisted generation）
+
+用同分词器的小型Qwen草稿模型一次提出若干候选token，由8B模型一次前向验证，
+减少大模型的解码步数。统计草稿token接受率和每次大模型前向产出的token数。
+"""
+
+import time
+import logging
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from generation_stopping import generate_with_stop_markers
+
+logger = logging.getLogger(__name__)
+
+
+def load_draft_model(draft_model_path, target_model, num_assistant_tokens=5):
+    """加载草稿模型，放到与目标模型相同的设备和精度上"""
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        draft_model_path,
+        trust_remote_code=True,
+        torch_dtype=target_model.dtype,
+        low_cpu_mem_usage=True
+    ).to(target_model.device)
+    draft_model.eval()
+    configure_lookahead(draft_model, num_assistant_tokens)
+    logger.info(f"草稿模型加载完成: {draft_model_path}，每轮候选token数: {num_assistant_tokens}")
+    return draft_model
+
+
+def configure_lookahead(draft_model, num_assistant_tokens):
+    """固定每轮草稿token数，不使用transformers默认的动态调整"""
+    draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+    draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+
+
+def _forward_module(model):
+    """PeftModel 的前向实际发生在底层 transformers 模型上"""
+    get_base_model = getattr(model, "get_base_model", None)
+    return get_base_model() if get_base_model else model
+
+
+class SpeculativeMonitor:
+    """
+    通过前向钩子统计一次生成中目标模型和草稿模型的前向次数
+
+    每轮验证目标模型前向一次，产出 (接受的草稿token数 + 1) 个token，
+    因此 接受数 = 生成token数 - 目标模型前向次数。
+    """
+
+    def __init__(self, target_model, draft_model):
+        self.target_module = _forward_module(target_model)
+        self.draft_module = _forward_module(draft_model)
+        self.target_steps = 0
+        self.draft_tokens = 0
+        self.seconds = 0.0
+        self._handles = []
+        self._start = None
+
+    def _count_target(self, module, inputs, output):
+        self.target_steps += 1
+
+    def _count_draft(self, module, inputs, output):
+        self.draft_tokens += 1
+
+    def __enter__(self):
+        self._handles = [
+            self.target_module.register_forward_hook(self._count_target),
+            self.draft_module.register_forward_hook(self._count_draft),
+        ]
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._start
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        return False
+
+    def report(self, completion_tokens):
+        """根据生成token数计算接受率等指标"""
+        accepted = max(completion_tokens - self.target_steps, 0)
+        return {
+            "draft_tokens": self.draft_tokens,
+            "accepted_tokens": accepted,
+            "target_steps": self.target_steps,
+            "acceptance_rate": accepted / self.draft_tokens if self.draft_tokens else 0.0,
+            # 常规解码每次前向产出1个token，此值即解码步数上的加速比
+            "tokens_per_target_step": completion_tokens / self.target_steps if self.target_steps else 0.0,
+            "tokens_per_sec": completion_tokens / self.seconds if self.seconds else 0.0,
+        }
+
+
+def generate_with_draft(model, tokenizer, input_ids, draft_model, attention_mask=None, **generate_kwargs):
+    """
+    使用草稿模型做投机解码，其余行为与 generate_with_stop_markers 一致
+
+    输出: (清理后的回复文本, 生成统计信息，包含投机解码指标)
+    """
+    with SpeculativeMonitor(model, draft_model) as monitor:
+        response, stats = generate_with_stop_markers(
+            model,
+            tokenizer,
+            input_ids,
+            attention_mask=attention_mask,
+            assistant_model=draft_model,
+            **generate_kwargs
+        )
+
+    speculative_stats = monitor.report(stats["completion_tokens"])
+    stats.update(speculative_stats)
+    logger.info(
+        f"投机解码: 接受率 {speculative_stats['acceptance_rate']:.1%}，"
+        f"每次目标前向产出 {speculative_stats['tokens_per_target_step']:.2f} 个token，"
+        f"{speculative_stats['tokens_per_sec']:.1f} tokens/s"
+    )
+    return response, stats
+
+
+def build_tiny_models(vocab_size=512, seed=0):
+    """
+    构造随机初始化的小型Qwen2目标/草稿模型，用于离线CPU测试
+
+    草稿模型复制目标模型的词嵌入，共享同一词表。
+    """
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+
+    torch.manual_seed(seed)
+    target_config = Qwen2Config(
+        vocab_size=vocab_size,
+        hidden_size=256,
+        intermediate_size=512,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=1024
+    )
+    draft_config = Qwen2Config(
+        vocab_size=vocab_size,
+        hidden_size=256,
+        intermediate_size=256,
+        num_hidden_layers=1,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=1024
+    )
+    target_model = Qwen2ForCausalLM(target_config).eval()
+    draft_model = Qwen2ForCausalLM(draft_config).eval()
+    draft_model.model.embed_tokens.load_state_dict(target_model.model.embed_tokens.state_dict())
+    draft_model.lm_head.load_state_dict(target_model.lm_head.state_dict())
+    return target_model, draft_model
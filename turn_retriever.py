@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+长对话中相关历史轮次的检索
+
+每轮问答保存时只做一次向量化，向量存放在每个会话一个的NumPy矩阵中（已归一化）。
+生成回复前用当前问题的向量与矩阵做一次矩阵乘法，取相似度最高的若干早前轮次，
+与最新几轮一起放进提示词，长会话的提示词长度保持有界。
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class _SessionTurns:
+    """一个会话的轮次文本和向量矩阵，矩阵按容量翻倍扩展"""
+
+    __slots__ = ("queries", "texts", "vectors", "size")
+
+    def __init__(self):
+        self.queries = []
+        self.texts = []
+        self.vectors = None
+        self.size = 0
+
+    def append(self, query, text, vector, max_turns):
+        if self.vectors is None:
+            self.vectors = np.empty((8, vector.shape[0]), dtype=np.float32)
+        if self.size >= max_turns:
+            # 超出上限时丢弃最早的一半（至少一轮），摊销后仍为 O(1)
+            drop = max(max_turns // 2, 1)
+            self.vectors[:self.size - drop] = self.vectors[drop:self.size]
+            del self.queries[:drop]
+            del self.texts[:drop]
+            self.size -= drop
+        if self.size == self.vectors.shape[0]:
+            grown = np.empty((min(self.size * 2, max_turns), self.vectors.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.vectors[:self.size]
+            self.vectors = grown
+        self.vectors[self.size] = vector
+        self.queries.append(query)
+        self.texts.append(text)
+        self.size += 1
+
+
+class TurnRetriever:
+    """
+    会话轮次检索器
+
+    embeddings 需提供 embed_query(text) -> list[float]（如 OllamaEmbeddings）。
+    recent_turns 条最新轮次总会原样出现在提示词中，不参与检索。
+    """
+
+    def __init__(self, embeddings, top_k=3, recent_turns=2, min_similarity=0.3,
+                 max_turns=256, max_chars=600, max_sessions=1000):
+        self.embeddings = embeddings
+        self.top_k = top_k
+        self.recent_turns = recent_turns
+        self.min_similarity = min_similarity
+        if max_turns < 1:
+            raise ValueError(f"max_turns 至少为1: {max_turns}")
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        self.max_sessions = max_sessions
+
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        # 新轮次的向量化在后台串行执行，不占用请求路径
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="turn-embed")
+
+    def _embed(self, text):
+        return self._normalize(self.embeddings.embed_query(text))
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _format_turn(self, question, response):
+        return f"用户: {question[:self.max_chars]}\n助手: {response[:self.max_chars]}\n"
+
+    # ---------- 写入 ----------
+    def add_turn(self, session_id, question, response):
+        """向量化并保存一轮问答"""
+        text = self._format_turn(question, response)
+        vector = self._embed(text)
+        with self._lock:
+            turns = self._sessions.get(session_id)
+            if turns is None:
+                turns = self._sessions[session_id] = _SessionTurns()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            if turns.vectors is not None and turns.vectors.shape[1] != vector.shape[0]:
+                logger.warning(f"会话 {session_id} 向量维度变化，重置轮次索引")
+                turns = self._sessions[session_id] = _SessionTurns()
+            turns.append(question, text, vector, self.max_turns)
+
+    def schedule_add(self, session_id, question, response):
+        """回复生成后在后台保存该轮"""
+        def run():
+            try:
+                self.add_turn(session_id, question, response)
+            except Exception as e:
+                logger.warning(f"会话 {session_id} 轮次向量化失败: {e}")
+        return self._executor.submit(run)
+
+    def reset(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    # ---------- 检索 ----------
+    def relevant_turns(self, session_id, question, exclude_queries=(), query_vector=None):
+        """
+        返回与问题最相关的早前轮次文本（按时间顺序）
+
+        最新 recent_turns 轮和问题出现在 exclude_queries 中的轮次（已在提示词中）不参与检索；
+        早前轮次不足时不做向量化，短会话没有额外开销。query_vector 为已算好的问题向量
+        （如文献检索用的查询向量），传入时不再重复向量化。
+        """
+        with self._lock:
+            turns = self._sessions.get(session_id)
+            if turns is None or turns.size <= self.recent_turns:
+                return []
+            candidates = turns.size - self.recent_turns
+            vectors = turns.vectors[:candidates].copy()
+            queries = turns.queries[:candidates]
+            texts = turns.texts[:candidates]
+
+        if query_vector is None:
+            query_vector = self._embed(question)
+        else:
+            query_vector = self._normalize(query_vector)
+        if query_vector.shape[0] != vectors.shape[1]:
+            return []
+        scores = vectors @ query_vector
+        order = np.argsort(-scores)
+        selected = []
+        for idx in order:
+            if scores[idx] < self.min_similarity or len(selected) >= self.top_k:
+                break
+            if queries[idx] in exclude_queries:
+                continue
+            selected.append(int(idx))
+        if selected:
+            logger.info(
+                f"会话 {session_id} 检索到 {len(selected)} 个相关早前轮次，"
+                f"相似度 {', '.join(f'{scores[i]:.2f}' for i in selected)}"
+            )
+        return [texts[i] for i in sorted(selected)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "turns": sum(turns.size for turns in self._sessions.values())
+            }
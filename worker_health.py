@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多worker部署的心跳与健康汇总
+
+每个worker进程启动一个后台线程，按固定间隔把自身状态（PID、是否就绪、处理中的
+请求数、排队深度等）原子写入心跳目录下的 worker-<pid>.json。任意worker的健康检查
+接口读取整个目录，就能汇报所有worker的状态；超过 stale_after 秒未更新或进程已
+不存在的worker标记为不健康。由 production_server.py 在 fork 后启动。
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 心跳参数，均可用环境变量覆盖
+worker_health_config = {
+    "directory": os.environ.get("WORKER_HEARTBEAT_DIR"),                        # 未设置时不启用
+    "interval": float(os.environ.get("WORKER_HEARTBEAT_INTERVAL", 5)),          # 心跳间隔（秒）
+    "stale_after": float(os.environ.get("WORKER_HEARTBEAT_STALE_AFTER", 20)),   # 超过该时长未更新视为失联
+}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WorkerHeartbeat:
+    """
+    worker心跳
+
+    status_fn 返回当前worker的状态字典，每次心跳时调用，不能阻塞太久。
+    """
+
+    def __init__(self, directory, status_fn=None, interval=5.0, stale_after=20.0):
+        self.directory = directory
+        self.status_fn = status_fn
+        self.interval = interval
+        self.stale_after = stale_after
+        self.pid = os.getpid()
+        self.started_at = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"worker-{self.pid}.json")
+
+    def beat(self):
+        """写入一次心跳"""
+        record = {"pid": self.pid, "started_at": self.started_at, "updated_at": time.time()}
+        if self.status_fn is not None:
+            try:
+                record.update(self.status_fn())
+            except Exception as e:
+                record["status_error"] = str(e)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _loop(self):
+        while True:
+            try:
+                self.beat()
+            except OSError as e:
+                logger.warning(f"写入worker心跳失败: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="worker-heartbeat", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止心跳并删除本worker的心跳文件"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def read_workers(directory, stale_after=20.0):
+    """读取心跳目录，返回按PID排序的worker状态列表，每项带 healthy 和 heartbeat_age"""
+    workers = []
+    if not directory or not os.path.isdir(directory):
+        return workers
+    now = time.time()
+    for filename in os.listdir(directory):
+        if not (filename.startswith("worker-") and filename.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(directory, filename), "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            continue
+        age = now - record.get("updated_at", 0)
+        alive = _pid_alive(record.get("pid", 0))
+        record["heartbeat_age"] = round(age, 3)
+        record["healthy"] = alive and age <= stale_after and record.get("ready", True)
+        if not alive:
+            record["state"] = "exited"
+        elif age > stale_after:
+            record["state"] = "stale"
+        workers.append(record)
+    workers.sort(key=lambda record: record["pid"])
+    return workers
+
+
+def clear_heartbeats(directory):
+    """删除心跳目录下的全部心跳文件（主进程启动时调用）"""
+    if not directory or not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        if filename.startswith("worker-"):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+def workers_summary(directory=None, stale_after=None):
+    """健康检查接口使用：所有worker的状态和健康数量，未启用心跳时返回 None"""
+    directory = directory or worker_health_config["directory"]
+    if not directory:
+        return None
+    workers = read_workers(directory, stale_after or worker_health_config["stale_after"])
+    return {
+        "total": len(workers),
+        "healthy": sum(1 for worker in workers if worker["healthy"]),
+        "workers": workers
+    }
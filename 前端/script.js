@@ -216,16 +216,21 @@ document.addEventListener('DOMContentLoaded', function() {
             chatBox.appendChild(loadingDiv);
             chatBox.scrollTop = chatBox.scrollHeight;
 
-            // 调用后端API
+            // 调用后端API；超时后中止请求，后端检测到连接断开会停止生成
+            const controller = new AbortController();
+            const timeoutId = setTimeout(() => controller.abort(), 300000);
             const response = await fetch('http://localhost:5000/api/chat', {
                 method: 'POST',
+                signal: controller.signal,
                 headers: {
                     'Content-Type': 'application/json',
                 },
                 body: JSON.stringify({
-                    message: userMsg
+                    message: userMsg,
+                    // 每个前端对话对应后端一个独立会话
+                    session_id: currentChatId ? `chat-${currentChatId}` : undefined
                 })
-            });
+            }).finally(() => clearTimeout(timeoutId));
 
             // 移除加载状态
             const loadingMessage = document.getElementById('loading-message');
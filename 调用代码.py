@@ -1,13 +1,15 @@
-import torch
 import logging
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from langchain.embeddings import OllamaEmbeddings
-from langchain.vectorstores import Chroma
-from langchain.prompts import PromptTemplate
 import os
 import subprocess
 import re
 import shutil
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+# torch、transformers、langchain 等重量级依赖在函数内按需导入，
+# 后端进程可以先启动HTTP服务，模型和向量库在后台并行加载
 
 # 设置日志配置
 logging.basicConfig(
@@ -28,11 +30,46 @@ pdf_directory = os.path.join(project_root, "knowledge_base", "相关文本资料
 db_directory = os.path.join(project_root, "chroma_db_deepseek_1.5b")
 collection_name = "academic_papers_deepseek_1.5b"
 
+# 索引热切换：rebuild_vector_db.py 在 db_directory/versions 下生成新版本并切换 CURRENT，
+# 运行中的服务每隔 watch_interval 秒检查一次并在后台加载新版本（0为只通过管理接口切换）
+index_config = {
+    "watch_interval": float(os.environ.get("RAG_INDEX_WATCH_INTERVAL", 10))
+}
+
 # Ollama嵌入模型配置
 embedding_model_name = "deepseek-r1:1.5b"
 
 # 微调模型配置
 model_path = os.path.join(project_root, "models", "Qwen3-8B-optimized").replace("\\", "/")
+base_model_path = os.path.join(project_root, "models", "Qwen3-8B").replace("\\", "/")
+
+# 合并后的模型目录（由 scripts/merge_lora.py 生成，存在时优先加载）
+merged_model_path = os.path.join(project_root, "models", "Qwen3-8B-merged").replace("\\", "/")
+
+# 离线模拟后端：RAG_FAKE_BACKEND=1 时使用 fake_backend.py 的模拟嵌入、模型和小型索引，
+# 无需Ollama、模型权重和向量库即可端到端压测（模拟参数见 fake_backend.fake_backend_config）
+use_fake_backend = os.environ.get("RAG_FAKE_BACKEND", "0") == "1"
+
+# 推理设备配置：auto 按 device_map="auto" 加载bf16模型，cpu 启用CPU优化推理
+inference_device = os.environ.get("RAG_INFERENCE_DEVICE", "auto")
+
+# CPU推理配置（仅 inference_device 为 cpu 时生效）
+cpu_inference_config = {
+    "num_threads": int(os.environ.get("RAG_CPU_THREADS", os.cpu_count() or 1)),
+    "interop_threads": int(os.environ.get("RAG_CPU_INTEROP_THREADS", 1)),
+    "quantize_int8": os.environ.get("RAG_CPU_INT8", "1") == "1",   # 线性层动态int8量化
+    "compile": os.environ.get("RAG_CPU_COMPILE", "0") == "1"       # torch.compile 编译解码步
+}
+
+# 投机解码配置：小型同分词器Qwen草稿模型提出候选token，由8B模型验证
+speculative_config = {
+    "enabled": os.environ.get("RAG_SPECULATIVE", "0") == "1",
+    "draft_model_path": os.environ.get(
+        "RAG_DRAFT_MODEL",
+        os.path.join(project_root, "models", "Qwen3-0.6B").replace("\\", "/")
+    ),
+    "num_assistant_tokens": int(os.environ.get("RAG_DRAFT_LOOKAHEAD", 5))  # 每轮草稿token数
+}
 
 # RAG检索配置
 retrieval_config = {
@@ -53,6 +90,26 @@ generation_config = {
     "length_penalty": 1.0    # 长度惩罚
 }
 
+# 对话历史压缩配置：提示词中的历史按token预算拼接，较早的轮次在后台折叠为摘要
+history_config = {
+    "token_budget": int(os.environ.get("RAG_HISTORY_TOKENS", 1024)),      # 历史（含摘要）token上限
+    "summary_tokens": int(os.environ.get("RAG_SUMMARY_TOKENS", 256)),     # 摘要最大长度
+    "keep_recent_messages": int(os.environ.get("RAG_KEEP_RECENT_MESSAGES", 4)),  # 始终原样保留的最新消息数
+    "fold_tokens": int(os.environ.get("RAG_SUMMARY_FOLD_TOKENS", 1024))   # 每次摘要新增消息的token上限
+}
+
+# 整个提示词（模板 + 历史 + 文献 + 问题）的token上限，超出部分会被分词器截断
+max_input_tokens = int(os.environ.get("RAG_MAX_INPUT_TOKENS", 2048))
+
+# 长对话相关轮次检索配置：每轮保存时向量化，按与当前问题的相似度选取早前轮次
+turn_retrieval_config = {
+    "enabled": os.environ.get("RAG_TURN_RETRIEVAL", "1") == "1",
+    "top_k": int(os.environ.get("RAG_RELEVANT_TURNS", 3)),   # 最多补充的相关早前轮次
+    "recent_turns": history_config["keep_recent_messages"] // 2,  # 最新轮次总会原样保留，不参与检索
+    "min_similarity": 0.3,
+    "max_turns": 256         # 每个会话保留的轮次向量数
+}
+
 # ================== 辅助函数 ==================
 def check_ollama_model(model_name):
     """检查Ollama模型是否已安装"""
@@ -74,6 +131,31 @@ def check_ollama_model(model_name):
         logger.error("请确保Ollama已正确安装并可在命令行中使用")
         return False
 
+def build_input_text(prompt_template, context, history_str, question):
+    """把文献、历史和问题填入模板并加上对话标记"""
+    prompt = prompt_template.format(context=context, history=history_str, question=question)
+    return f"[|im_start|]user\n{prompt}\n[|im_end|]\n[|im_start|]assistant\n"
+
+def fit_prompt_budget(components, docs, question, reserve_tokens=16):
+    """
+    计算提示词中对话历史可用的token预算
+    
+    分词器从左侧截断超过 max_input_tokens 的输入，历史位于文献之前，会最先被截掉。
+    这里先扣除模板、文献和问题占用的token（放不下时从排名最后的文献开始丢弃，至少保留一篇），
+    剩余部分作为历史预算。reserve_tokens 预留给分词器添加的特殊标记。
+    输出: (保留的文献, 历史token预算)
+    """
+    tokenizer = components["tokenizer"]
+    limit = max_input_tokens - reserve_tokens
+    docs = list(docs)
+    while True:
+        input_text = build_input_text(components["prompt_template"], format_context(docs), "", question)
+        fixed = len(tokenizer.encode(input_text, add_special_tokens=False))
+        if fixed <= limit or len(docs) <= 1:
+            break
+        docs.pop()
+    return docs, max(limit - fixed, 0)
+
 def format_context(docs):
     """格式化检索到的上下文文档"""
     formatted = []
@@ -89,34 +171,180 @@ def format_context(docs):
         formatted.append(f"【文献 {i+1}】《{doc_name}》 (第{page}页)\n{content[:800]}{'...' if len(content) > 800 else ''}")
     return "\n\n".join(formatted)
 
+# ================== 模型加载 ==================
+def has_merged_model(path=merged_model_path):
+    """检查合并后的模型目录是否完整"""
+    if not os.path.exists(os.path.join(path, "config.json")):
+        return False
+    return any(name.endswith(".safetensors") for name in os.listdir(path))
+
+def load_chat_model():
+    """
+    加载分词器和对话模型，返回 (model, tokenizer, 各阶段耗时)
+    
+    优先加载合并后的safetensors检查点（内存映射加载，无LoRA额外计算），
+    否则加载基础模型并挂载LoRA适配器。
+    """
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from cpu_inference import configure_cpu_threads, prepare_cpu_model
+    
+    load_timings = {}
+    total_start = time.perf_counter()
+    use_merged = has_merged_model()
+    
+    # CPU模式下以float32加载到CPU，随后量化；否则按原方式自动分配设备
+    use_cpu = inference_device == "cpu"
+    if use_cpu:
+        configure_cpu_threads(
+            cpu_inference_config["num_threads"],
+            cpu_inference_config["interop_threads"]
+        )
+        load_kwargs = {"device_map": None, "torch_dtype": torch.float32}
+    else:
+        load_kwargs = {"device_map": "auto", "torch_dtype": torch.bfloat16}
+    
+    # 合并目录中保存了分词器，否则从适配器目录加载
+    tokenizer_path = merged_model_path if use_merged else model_path
+    logger.info(f"正在加载分词器: {tokenizer_path}")
+    start = time.perf_counter()
+    tokenizer = AutoTokenizer.from_pretrained(
+        tokenizer_path,
+        trust_remote_code=True,
+        padding_side="right",
+        use_fast=False
+    )
+    tokenizer.truncation_side = "left"
+    tokenizer.pad_token = tokenizer.eos_token
+    load_timings["tokenizer"] = time.perf_counter() - start
+    
+    if use_merged:
+        logger.info(f"正在加载合并模型: {merged_model_path}")
+        start = time.perf_counter()
+        model = AutoModelForCausalLM.from_pretrained(
+            merged_model_path,
+            trust_remote_code=True,
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+            **load_kwargs
+        )
+        load_timings["merged_model"] = time.perf_counter() - start
+    else:
+        logger.info(f"未找到合并模型，使用基础模型路径: {base_model_path}")
+        start = time.perf_counter()
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model_path,
+            trust_remote_code=True,
+            low_cpu_mem_usage=True,
+            **load_kwargs
+        )
+        load_timings["base_model"] = time.perf_counter() - start
+        
+        # 加载LoRA适配器
+        if os.path.exists(os.path.join(model_path, "adapter_model.safetensors")):
+            logger.info("正在加载LoRA适配器...")
+            start = time.perf_counter()
+            from peft import PeftModel
+            model = PeftModel.from_pretrained(model, model_path)
+            load_timings["lora_adapter"] = time.perf_counter() - start
+            logger.info("LoRA适配器加载完成")
+    
+    if use_cpu:
+        model, cpu_timings = prepare_cpu_model(model, cpu_inference_config)
+        load_timings.update(cpu_timings)
+    
+    model.eval()
+    load_timings["total"] = time.perf_counter() - total_start
+    
+    timing_str = "，".join(f"{phase}: {seconds:.2f}s" for phase, seconds in load_timings.items())
+    logger.info(f"模型加载完成，使用的设备: {model.device}，耗时 {timing_str}")
+    return model, tokenizer, load_timings
+
+# ================== 初始化状态 ==================
+# 各组件的加载状态：pending / loading / ready / failed，供健康检查接口读取
+_status_lock = threading.Lock()
+system_status = {
+    "vector_store": {"state": "pending", "seconds": None, "error": None},
+    "model": {"state": "pending", "seconds": None, "error": None},
+    "warmup": {"state": "pending", "seconds": None, "error": None}
+}
+
+def _set_status(component, state, seconds=None, error=None):
+    with _status_lock:
+        system_status[component] = {"state": state, "seconds": seconds, "error": error}
+
+def get_system_status():
+    """返回各组件加载状态的副本"""
+    with _status_lock:
+        return {name: dict(status) for name, status in system_status.items()}
+
+def _run_component(name, init_fn):
+    """执行一个初始化步骤并记录状态和耗时"""
+    _set_status(name, "loading")
+    start = time.perf_counter()
+    try:
+        result = init_fn()
+    except Exception as e:
+        _set_status(name, "failed", time.perf_counter() - start, str(e))
+        raise
+    seconds = time.perf_counter() - start
+    _set_status(name, "ready", seconds)
+    logger.info(f"组件 {name} 就绪，耗时 {seconds:.2f}s")
+    return result
+
 # ================== 初始化系统 ==================
-def initialize_system():
-    """初始化所有组件"""
+def _make_retriever(vector_store):
+    return vector_store.as_retriever(
+        search_kwargs={
+            "k": retrieval_config["k"],
+            "score_threshold": retrieval_config["score_threshold"]
+        }
+    )
+
+def _open_retriever(directory, embeddings):
+    """打开一个Chroma索引目录并创建检索器"""
+    from langchain.vectorstores import Chroma
+    
+    vector_store = Chroma(
+        embedding_function=embeddings,
+        persist_directory=directory,
+        collection_name=collection_name
+    )
+    # 尝试获取文档数量
+    doc_count = vector_store._collection.count()
+    logger.info(f"向量数据库加载成功（{directory}），包含 {doc_count} 个文档")
+    return _make_retriever(vector_store)
+
+def _warmup_retriever(retriever):
+    """预热：首次查询时Ollama需要把嵌入模型载入内存，Chroma需要载入HNSW索引"""
+    retriever.get_relevant_documents("公共艺术")
+
+def _init_vector_store():
+    """检查Ollama、加载嵌入模型和向量数据库"""
+    from langchain.embeddings import OllamaEmbeddings
+    from langchain.vectorstores import Chroma
+    from index_manager import IndexManager, resolve_index_directory
+    
     # 检查Ollama模型
     if not check_ollama_model(embedding_model_name):
-        logger.error("必要的Ollama模型未安装，系统退出")
-        exit(1)
+        raise RuntimeError(f"必要的Ollama模型未安装: {embedding_model_name}")
     
-    # 加载向量数据库
-    if not os.path.exists(db_directory) or not os.listdir(db_directory):
-        logger.error(f"向量数据库目录不存在或为空: {db_directory}")
+    # 加载向量数据库（CURRENT 指向的版本，旧布局时为根目录本身）
+    index_version, index_directory = resolve_index_directory(db_directory)
+    if not os.path.exists(index_directory) or not os.listdir(index_directory):
         logger.error("请先创建向量数据库")
-        exit(1)
+        raise RuntimeError(f"向量数据库目录不存在或为空: {index_directory}")
     
-    logger.info("正在加载嵌入模型和向量数据库...")
+    logger.info(f"正在加载嵌入模型和向量数据库（版本: {index_version or '旧布局'}）...")
     embeddings = OllamaEmbeddings(model=embedding_model_name)
     
     # 尝试加载向量数据库，如果失败则重新创建
     try:
-        vector_store = Chroma(
-            embedding_function=embeddings,
-            persist_directory=db_directory,
-            collection_name=collection_name
-        )
-        # 尝试获取文档数量
-        doc_count = vector_store._collection.count()
-        logger.info(f"向量数据库加载成功，包含 {doc_count} 个文档")
+        retriever = _open_retriever(index_directory, embeddings)
     except Exception as e:
+        if index_version is not None:
+            # 版本化索引损坏时不自动删除，可用 rebuild_vector_db.py --rollback 切回上一个版本
+            raise
         logger.warning(f"向量数据库加载失败: {e}")
         logger.info("尝试重新创建向量数据库...")
         
@@ -131,50 +359,145 @@ def initialize_system():
             collection_name=collection_name
         )
         logger.info("向量数据库重新创建成功")
+        retriever = _make_retriever(vector_store)
     
-    retriever = vector_store.as_retriever(
-        search_kwargs={
-            "k": retrieval_config["k"],
-            "score_threshold": retrieval_config["score_threshold"]
-        }
-    )
+    _warmup_retriever(retriever)
     
-    # 加载微调模型
-    logger.info(f"正在加载微调模型: {model_path}")
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_path,
-        trust_remote_code=True,
-        padding_side="right",
-        use_fast=False
+    index_manager = IndexManager(
+        db_directory,
+        open_fn=lambda directory: _open_retriever(directory, embeddings),
+        warmup_fn=_warmup_retriever,
+        version=index_version,
+        directory=index_directory,
+        retriever=retriever,
+        watch_interval=index_config["watch_interval"]
     )
-    tokenizer.truncation_side = "left"
-    tokenizer.pad_token = tokenizer.eos_token
+    return {"retriever": retriever, "embeddings": embeddings, "index_manager": index_manager}
 
-    # 使用基础模型路径加载模型
-    base_model_path = os.path.join(project_root, "models", "Qwen3-8B").replace("\\", "/")
-    logger.info(f"基础模型路径: {base_model_path}")
+def _init_model():
+    """加载分词器、对话模型和可选的草稿模型"""
+    # 加载微调模型
+    model, tokenizer, load_timings = load_chat_model()
     
-    model = AutoModelForCausalLM.from_pretrained(
-        base_model_path,
-        trust_remote_code=True,
-        device_map="auto",
-        torch_dtype=torch.bfloat16
-    )
+    # 加载投机解码草稿模型
+    draft_model = None
+    if speculative_config["enabled"]:
+        from speculative_decoding import load_draft_model
+        start = time.perf_counter()
+        draft_model = load_draft_model(
+            speculative_config["draft_model_path"],
+            model,
+            speculative_config["num_assistant_tokens"]
+        )
+        load_timings["draft_model"] = time.perf_counter() - start
     
-    # 加载LoRA适配器
-    if os.path.exists(os.path.join(model_path, "adapter_model.safetensors")):
-        logger.info("正在加载LoRA适配器...")
-        from peft import PeftModel
-        model = PeftModel.from_pretrained(model, model_path)
-        logger.info("LoRA适配器加载完成")
+    return {
+        "model": model,
+        "tokenizer": tokenizer,
+        "draft_model": draft_model,
+        "load_timings": load_timings
+    }
+
+def generate_text(components, input_ids, attention_mask=None, **generate_kwargs):
+    """
+    用已加载的模型生成，返回 (回复文本, 生成统计信息)
     
-    model.eval()
-    logger.info(f"模型加载完成，使用的设备: {model.device}")
+    模拟后端使用 components["generate_fn"]；启用草稿模型时使用投机解码；
+    否则检测到对话标记即停止解码
+    """
+    if components.get("generate_fn") is not None:
+        return components["generate_fn"](input_ids, attention_mask=attention_mask, **generate_kwargs)
+    
+    from generation_stopping import generate_with_stop_markers
+    from speculative_decoding import generate_with_draft
     
-    # 定义提示模板
-    prompt_template = PromptTemplate(
-        input_variables=["context", "history", "question"],
-        template="""
+    if components.get("draft_model") is not None:
+        return generate_with_draft(
+            components["model"],
+            components["tokenizer"],
+            input_ids,
+            components["draft_model"],
+            attention_mask=attention_mask,
+            **generate_kwargs
+        )
+    return generate_with_stop_markers(
+        components["model"],
+        components["tokenizer"],
+        input_ids,
+        attention_mask=attention_mask,
+        **generate_kwargs
+    )
+
+def generate_text_batch(components, input_texts, max_length=2048, **generate_kwargs):
+    """
+    批量生成，返回 (回复文本列表, 生成统计信息)，供 scripts/batch_qa.py 使用
+
+    输入左侧填充后一次前向处理整批；投机解码只支持单条，批量时不使用草稿模型
+    """
+    if components.get("generate_batch_fn") is not None:
+        return components["generate_batch_fn"](input_texts, max_length=max_length, **generate_kwargs)
+
+    from generation_stopping import generate_batch_with_stop_markers
+
+    tokenizer = components["tokenizer"]
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        inputs = tokenizer(
+            list(input_texts),
+            return_tensors="pt",
+            max_length=max_length,
+            truncation=True,
+            padding=True,
+            add_special_tokens=True
+        )
+    finally:
+        tokenizer.padding_side = padding_side
+
+    device = components["model"].device
+    return generate_batch_with_stop_markers(
+        components["model"],
+        tokenizer,
+        inputs.input_ids.to(device),
+        inputs.attention_mask.to(device),
+        **generate_kwargs
+    )
+
+def warmup_generation(components):
+    """用短提示跑一次生成，提前完成CUDA内核/编译图等首次调用开销"""
+    inputs = components["tokenizer"](
+        "[|im_start|]user\n你好\n[|im_end|]\n[|im_start|]assistant\n",
+        return_tensors="pt"
+    )
+    generate_text(
+        components,
+        inputs.input_ids.to(components["model"].device),
+        attention_mask=inputs.attention_mask.to(components["model"].device),
+        max_new_tokens=4,
+        do_sample=False
+    )
+
+def initialize_system():
+    """初始化所有组件：向量库与模型两条互不依赖的加载路径并行执行"""
+    total_start = time.perf_counter()
+    if use_fake_backend:
+        from fake_backend import init_fake_vector_store, init_fake_model
+        logger.warning("使用离线模拟后端（RAG_FAKE_BACKEND=1），回答内容不具参考意义")
+        init_vector_store = lambda: init_fake_vector_store(retrieval_config["k"])
+        init_model = init_fake_model
+    else:
+        init_vector_store, init_model = _init_vector_store, _init_model
+    
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="rag-init") as executor:
+        vector_future = executor.submit(_run_component, "vector_store", init_vector_store)
+        model_future = executor.submit(_run_component, "model", init_model)
+        vector_parts = vector_future.result()
+        model_parts = model_future.result()
+    
+    # 定义提示模板（模拟后端不依赖langchain，直接用字符串的 format）
+    prompt_text = """
 [系统提示]
 你是一位精通公共艺术领域的专业学术助手，请严格使用中文回答问题。
 
@@ -210,36 +533,107 @@ def initialize_system():
 
 请基于上述文献资料回答，必须明确引用文献名称：
         """
-    )
+    if use_fake_backend:
+        prompt_template = prompt_text
+    else:
+        from langchain.prompts import PromptTemplate
+        prompt_template = PromptTemplate(
+            input_variables=["context", "history", "question"],
+            template=prompt_text
+        )
     
-    return {
-        "retriever": retriever,
-        "model": model,
-        "tokenizer": tokenizer,
-        "prompt_template": prompt_template
+    components = {
+        "retriever": vector_parts["retriever"],
+        "embeddings": vector_parts["embeddings"],
+        "index_manager": vector_parts.get("index_manager"),
+        "model": model_parts["model"],
+        "tokenizer": model_parts["tokenizer"],
+        "prompt_template": prompt_template,
+        "draft_model": model_parts["draft_model"],
+        "generate_fn": model_parts.get("generate_fn"),
+        "generate_batch_fn": model_parts.get("generate_batch_fn"),
+        "load_timings": model_parts["load_timings"],
+        # 同一时间只有一个生成（回复或摘要）占用模型
+        "generation_lock": threading.Lock()
     }
+    
+    # 索引热切换后同步更新组件中的检索器（batch_qa 等直接使用 components["retriever"]）
+    if components["index_manager"] is not None:
+        components["index_manager"].on_swap = lambda retriever: components.__setitem__("retriever", retriever)
+    
+    from history_compactor import HistoryCompactor
+    components["history_compactor"] = HistoryCompactor(
+        components["tokenizer"],
+        lambda previous, messages, max_new_tokens: summarize_history(
+            components, previous, messages, max_new_tokens
+        ),
+        **history_config
+    )
+    
+    if turn_retrieval_config["enabled"]:
+        try:
+            from turn_retriever import TurnRetriever
+        except ImportError as e:
+            logger.warning(f"相关轮次检索不可用（{e}），已跳过")
+        else:
+            components["turn_retriever"] = TurnRetriever(
+                components["embeddings"],
+                **{key: value for key, value in turn_retrieval_config.items() if key != "enabled"}
+            )
+    
+    # 预热生成失败不影响服务可用
+    try:
+        _run_component("warmup", lambda: warmup_generation(components))
+    except Exception as e:
+        logger.warning(f"预热生成失败: {e}")
+    
+    logger.info(f"系统初始化完成，总耗时 {time.perf_counter() - total_start:.2f}s")
+    return components
 
 # ================== 核心聊天功能 ==================
-def generate_response(components, history, question):
-    """生成RAG增强的响应"""
-    # 1. 构建对话历史 - 修复历史记录处理
-    history_str = ""
-    for i, msg in enumerate(history):
-        if msg["role"] == "system":
-            # 跳过系统消息，因为已经在模板中包含了
-            continue
-        elif msg["role"] == "user":
-            history_str += f"用户: {msg['content']}\n"
-        elif msg["role"] == "assistant":
-            history_str += f"助手: {msg['content']}\n"
+def summarize_history(components, previous_summary, messages, max_new_tokens):
+    """用对话模型把旧摘要和新移出窗口的消息合并成新摘要"""
+    from history_compactor import format_message
     
-    # 如果历史为空，添加默认提示
-    if not history_str.strip():
-        history_str = "这是对话的开始。\n"
+    dialogue = "".join(format_message(msg) for msg in messages)
+    prompt = (
+        "请将以下对话内容压缩为简洁的中文摘要，保留用户关注的问题、涉及的文献名称和关键结论，"
+        "不要添加对话中没有的内容。\n\n"
+        f"已有摘要：{previous_summary or '无'}\n\n"
+        f"新增对话：\n{dialogue}\n"
+        "请直接输出合并后的摘要："
+    )
+    inputs = components["tokenizer"](
+        f"[|im_start|]user\n{prompt}\n[|im_end|]\n[|im_start|]assistant\n",
+        return_tensors="pt"
+    )
+    with components["generation_lock"]:
+        summary, _ = generate_text(
+            components,
+            inputs.input_ids.to(components["model"].device),
+            attention_mask=inputs.attention_mask.to(components["model"].device),
+            max_new_tokens=max_new_tokens,
+            do_sample=False
+        )
+    return summary
+
+def generate_response(components, history, question, generation_stats=None, session_id=None, cancel_token=None):
+    """
+    生成RAG增强的响应
     
-    logger.info(f"对话历史长度: {len(history_str)} 字符")
+    generation_stats 传入字典时会写入本次生成的统计信息（prompt/completion token数、
+    各阶段耗时 stage_seconds 等）；传入 session_id 时对话历史按token预算压缩
+    （摘要 + 最新消息），回复后在后台更新摘要。cancel_token（见 cancellation.py）
+    在等待模型或解码期间被取消时抛出 GenerationCancelled，不更新摘要
+    """
+    from metrics import StageTimer, record_generation, record_cancellation
+    from cancellation import GenerationCancelled, acquire_cancellable
+    
+    timer = StageTimer("rag")
+    compactor = components.get("history_compactor") if session_id else None
+    turn_retriever = components.get("turn_retriever") if session_id else None
     
-    # 2. 智能检索 - 结合对话历史和当前问题
+    # 1. 智能检索 - 结合对话历史和当前问题
     # 如果当前问题很短（少于10个字符），结合最近的对话历史进行检索
     if len(question.strip()) < 10:
         # 获取最近的用户问题和助手回答
@@ -256,61 +650,142 @@ def generate_response(components, history, question):
     else:
         search_query = question
     
-    # 执行检索
-    retrieved_docs = components["retriever"].get_relevant_documents(search_query)
-    context = format_context(retrieved_docs)
-    
+    # 执行检索：查询向量化和向量库搜索分开计时；检索期间持有索引租约，热切换后旧索引在此之后才释放
+    index_manager = components.get("index_manager")
+    with timer.stage("embed"):
+        query_vector = components["embeddings"].embed_query(search_query)
+    with (index_manager.lease() if index_manager is not None else nullcontext(components["retriever"])) as retriever, \
+            timer.stage("search"):
+        retrieved_docs = retriever.vectorstore.similarity_search_by_vector(
+            query_vector, k=retriever.search_kwargs["k"]
+        )
     logger.info(f"检索到 {len(retrieved_docs)} 个相关文档")
     
-    # 3. 构建提示
-    prompt = components["prompt_template"].format(
-        context=context,
-        history=history_str,
-        question=question
-    )
+    # 2. 构建对话历史 - 历史预算为提示词上限扣除模板、文献和问题之后的剩余
+    history_str = ""
+    if compactor is not None:
+        with timer.stage("history"):
+            retrieved_docs, history_budget = fit_prompt_budget(components, retrieved_docs, question)
+            history_str, history_info = compactor.render(session_id, history, token_budget=history_budget)
+        logger.info(
+            f"历史压缩: 摘要 {history_info['summary_tokens']} tokens，"
+            f"原文 {history_info['verbatim_messages']} 条消息，共 {history_info['history_tokens']} tokens"
+        )
+        
+        # 补充与当前问题相关、但不在最新消息中的早前轮次（复用文献检索的查询向量）
+        if turn_retriever is not None:
+            dialogue = [msg for msg in history if msg["role"] in ("user", "assistant")]
+            verbatim = dialogue[len(dialogue) - history_info["verbatim_messages"]:]
+            with timer.stage("turn_retrieval"):
+                relevant = turn_retriever.relevant_turns(
+                    session_id,
+                    question,
+                    exclude_queries={msg["content"] for msg in verbatim if msg["role"] == "user"},
+                    query_vector=query_vector
+                )
+            if relevant:
+                # 相关轮次同样计入历史预算，最多占一半（放不下时先舍弃较早的轮次），
+                # 摘要和最新消息按剩余预算重新拼接
+                relevant_budget = history_budget // 2
+                relevant_tokens = 0
+                kept = []
+                for text in reversed(relevant):
+                    tokens = compactor.count_tokens(text)
+                    if relevant_tokens + tokens > relevant_budget:
+                        break
+                    kept.append(text)
+                    relevant_tokens += tokens
+                if kept:
+                    header = "相关的早前对话:\n"
+                    relevant_tokens += compactor.count_tokens(header)
+                    history_str, history_info = compactor.render(
+                        session_id, history, token_budget=max(history_budget - relevant_tokens, 0)
+                    )
+                    history_str = header + "".join(reversed(kept)) + "\n" + history_str
+    else:
+        for i, msg in enumerate(history):
+            if msg["role"] == "system":
+                # 跳过系统消息，因为已经在模板中包含了
+                continue
+            elif msg["role"] == "user":
+                history_str += f"用户: {msg['content']}\n"
+            elif msg["role"] == "assistant":
+                history_str += f"助手: {msg['content']}\n"
     
-    # 4. 添加特殊标记
-    input_text = f"[|im_start|]user\n{prompt}\n[|im_end|]\n[|im_start|]assistant\n"
+    # 如果历史为空，添加默认提示
+    if not history_str.strip():
+        history_str = "这是对话的开始。\n"
     
-    # 5. 生成响应
-    inputs = components["tokenizer"](
-        input_text,
-        return_tensors="pt",
-        max_length=2048,     # 增加输入长度以支持更长的对话历史
-        truncation=True,
-        padding=True,        # 启用padding
-        add_special_tokens=True
-    )
+    logger.info(f"对话历史长度: {len(history_str)} 字符")
+    
+    context = format_context(retrieved_docs)
+    
+    # 3. 构建提示
+    with timer.stage("prompt"):
+        # 4. 添加特殊标记
+        input_text = build_input_text(components["prompt_template"], context, history_str, question)
+        
+        # 5. 生成响应
+        inputs = components["tokenizer"](
+            input_text,
+            return_tensors="pt",
+            max_length=max_input_tokens,
+            truncation=True,
+            padding=True,        # 启用padding
+            add_special_tokens=True
+        )
     
     input_ids = inputs.input_ids.to(components["model"].device)
     attention_mask = inputs.attention_mask.to(components["model"].device)
     
-    with torch.no_grad():
-        outputs = components["model"].generate(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            **generation_config
+    # 6. 生成响应，检测到对话标记即停止解码；启用草稿模型时使用投机解码
+    #    客户端断开或超过截止时间时，等待模型和解码都会提前结束
+    try:
+        with timer.stage("lock_wait"):
+            acquire_cancellable(components["generation_lock"], cancel_token)
+    except GenerationCancelled as e:
+        record_cancellation(e.reason)
+        raise
+    try:
+        if cancel_token is not None and cancel_token.cancelled:
+            record_cancellation(cancel_token.reason)
+            raise GenerationCancelled(cancel_token.reason)
+        response, stats = generate_text(
+            components, input_ids, attention_mask=attention_mask, cancel_token=cancel_token, **generation_config
         )
+    finally:
+        components["generation_lock"].release()
     
-    # 6. 解码并清理响应
-    full_response = components["tokenizer"].decode(outputs[0], skip_special_tokens=False)
+    timer.add("prefill", stats.get("prefill_seconds"))
+    timer.add("decode", stats.get("decode_seconds"))
+    record_generation(stats)
+    if stats.get("cancelled"):
+        logger.info(f"生成已取消（{stats['cancelled']}），浪费 {stats['completion_tokens']} 个token")
+        record_cancellation(stats["cancelled"], stats["completion_tokens"])
+        raise GenerationCancelled(stats["cancelled"], stats["completion_tokens"])
+    stats["stage_seconds"] = dict(timer.timings)
     
-    if "[|im_start|]assistant" in full_response:
-        response = full_response.split("[|im_start|]assistant")[-1]
-    else:
-        response = full_response
+    if generation_stats is not None:
+        generation_stats.update(stats)
     
-    # 移除特殊标记
-    special_tokens = ["[|im_end|]", "<|im_end|>", "]", "|im_end|", "<|im_start|>", "|im_start|"]
-    for token in special_tokens:
-        response = response.split(token)[0].strip()
+    # 7. 后台更新历史摘要，不阻塞本次回复
+    if compactor is not None:
+        compactor.schedule_update(session_id, history + [{"role": "assistant", "content": response}])
+    if turn_retriever is not None:
+        turn_retriever.schedule_add(session_id, question, response)
     
-    return response.strip()
+    return response
 
 # ================== 主程序 ==================
 def main():
+    from cpu_inference import empty_device_cache
+    
     # 初始化系统
-    components = initialize_system()
+    try:
+        components = initialize_system()
+    except RuntimeError as e:
+        logger.error(f"系统初始化失败: {e}")
+        exit(1)
     
     # 初始化对话历史
     messages = [
@@ -337,7 +812,7 @@ def main():
         
         try:
             # 生成响应
-            response = generate_response(components, messages, user_input)
+            response = generate_response(components, messages, user_input, session_id="cli")
             print("\n助手: " + response)
             
             # 添加助手响应到历史
@@ -353,8 +828,8 @@ def main():
             logger.error(f"生成响应时出错: {e}")
             print("抱歉，处理您的请求时出现问题，请重新提问。")
         
-        # 清理GPU内存
-        torch.cuda.empty_cache()
+        # 清理GPU内存（CPU模式下跳过）
+        empty_device_cache()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file